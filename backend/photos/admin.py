@@ -1,7 +1,57 @@
 from django.contrib import admin
 
-from photos.models import Photo, PhotoTag, PhotoShare
+from photos.models import AutoTag, Photo, PhotoDeadLetter, PhotoTag, PhotoShare
+from photos.reaper import reprocess_dead_letter
+from photos.retag import schedule_retag
 
 admin.site.register(Photo)
 admin.site.register(PhotoTag)
-admin.site.register(PhotoShare)
\ No newline at end of file
+admin.site.register(PhotoShare)
+
+
+# Vocabulary edits queue a retag of every photo from its stored embedding
+@admin.register(AutoTag)
+class AutoTagAdmin(admin.ModelAdmin):
+    list_display = ("name", "active", "embedding_model", "updated_at")
+    list_editable = ("active",)
+    list_filter = ("active",)
+    search_fields = ("name",)
+    readonly_fields = ("embedding_model",)
+    actions = ("retag_library",)
+
+    def save_model(self, request, obj, form, change):
+        if change and "name" in form.changed_data:
+            # the cached text embedding belongs to the old name
+            obj.text_embedding = None
+            obj.embedding_model = ""
+        super().save_model(request, obj, form, change)
+        if not change or {"name", "active"} & set(form.changed_data):
+            schedule_retag()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        schedule_retag()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        schedule_retag()
+
+    @admin.action(description="Retag all photos with the current vocabulary")
+    def retag_library(self, request, queryset):
+        schedule_retag()
+        self.message_user(request, "Retag queued.")
+
+
+@admin.register(PhotoDeadLetter)
+class PhotoDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ("photo", "reason", "attempts", "created_at")
+    list_filter = ("reason",)
+    readonly_fields = ("photo", "reason", "attempts", "history", "created_at")
+    actions = ("reprocess",)
+
+    @admin.action(description="Reprocess the selected photos")
+    def reprocess(self, request, queryset):
+        dead_letters = list(queryset)
+        for dead_letter in dead_letters:
+            reprocess_dead_letter(dead_letter)
+        self.message_user(request, f"{len(dead_letters)} photos queued for reprocessing.")
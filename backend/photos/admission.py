@@ -0,0 +1,136 @@
+# Upload admission control: uploads are refused (503, or 429 over the photographer's own limit) while
+# the photo queues or the photos in flight are over their limits. Photos in flight are Redis sorted sets
+# scored by admission time, so photos the broker lost expire after PHOTO_ADMISSION_IN_FLIGHT_TTL.
+# The limits are soft, and uploads are admitted when Redis is unreachable
+
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException, Throttled
+
+from photos.queues import photo_queues
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT_KEY = "photos:in-flight"
+USER_IN_FLIGHT_KEY = "photos:in-flight:user:{}"
+
+
+class PipelineBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Photo processing is backed up, please retry later."
+    default_code = "pipeline_busy"
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        # DRF's exception handler turns this into the Retry-After header
+        self.wait = wait
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    settings.PHOTO_ADMISSION_REDIS_URL,
+                    socket_timeout=settings.PHOTO_ADMISSION_REDIS_TIMEOUT,
+                    socket_connect_timeout=settings.PHOTO_ADMISSION_REDIS_TIMEOUT,
+                )
+    return _client
+
+
+# the Redis lists holding each photo queue, one per priority step (see CELERY_BROKER_TRANSPORT_OPTIONS)
+def _queue_keys():
+    options = settings.CELERY_BROKER_TRANSPORT_OPTIONS
+    sep = options.get("sep", "\x06\x16")
+    steps = options.get("priority_steps", [0])
+    return [queue if not step else f"{queue}{sep}{step}" for queue in photo_queues() for step in steps]
+
+
+_backlog = (0.0, None)  # (read at, (queued, in flight))
+
+
+# (messages waiting in the photo queues, photos in flight), cached for PHOTO_ADMISSION_CACHE_SECONDS
+def backlog():
+    global _backlog
+    read_at, cached = _backlog
+    if cached is not None and time.monotonic() - read_at < settings.PHOTO_ADMISSION_CACHE_SECONDS:
+        return cached
+
+    keys = _queue_keys()
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+    pipe.zremrangebyscore(IN_FLIGHT_KEY, 0, time.time() - settings.PHOTO_ADMISSION_IN_FLIGHT_TTL)
+    pipe.zcard(IN_FLIGHT_KEY)
+    results = pipe.execute()
+
+    cached = (sum(results[:len(keys)]), results[-1])
+    _backlog = (time.monotonic(), cached)
+    return cached
+
+
+def user_in_flight(user_id):
+    key = USER_IN_FLIGHT_KEY.format(user_id)
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.zremrangebyscore(key, 0, time.time() - settings.PHOTO_ADMISSION_IN_FLIGHT_TTL)
+    pipe.zcard(key)
+    return pipe.execute()[-1]
+
+
+# raise PipelineBusy (503) or Throttled (429) if count more photos from user should wait
+def check_admission(user, count=1, bulk=False):
+    if not settings.PHOTO_ADMISSION_ENABLED:
+        return
+    try:
+        queued, in_flight = backlog()
+        own = user_in_flight(user.id)
+    except redis.RedisError as e:
+        logger.warning(f"Admission control unavailable, admitting upload - {str(e)}")
+        return
+
+    retry_after = settings.PHOTO_ADMISSION_RETRY_AFTER
+    max_queued = settings.PHOTO_ADMISSION_MAX_BULK_QUEUED if bulk else settings.PHOTO_ADMISSION_MAX_QUEUED
+    if queued >= max_queued or in_flight >= settings.PHOTO_ADMISSION_MAX_IN_FLIGHT:
+        logger.info(f"Upload of {count} photos by user {user.id} refused: {queued} queued, {in_flight} in flight")
+        raise PipelineBusy(retry_after)
+    # a batch larger than the limit is still let in when none of the user's photos are in flight
+    if own and own + count > settings.PHOTO_ADMISSION_MAX_IN_FLIGHT_PER_USER:
+        raise Throttled(wait=retry_after, detail=f"{own} of your photos are still being processed.")
+
+
+def track_in_flight(photo_ids, user_id):
+    if not settings.PHOTO_ADMISSION_ENABLED or not photo_ids:
+        return
+    now = time.time()
+    members = {str(photo_id): now for photo_id in photo_ids}
+    user_key = USER_IN_FLIGHT_KEY.format(user_id)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zadd(IN_FLIGHT_KEY, members)
+        pipe.zadd(user_key, members)
+        pipe.expire(user_key, settings.PHOTO_ADMISSION_IN_FLIGHT_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Could not track {len(members)} photos in flight - {str(e)}")
+
+
+def release_in_flight(photo_id, user_id):
+    if not settings.PHOTO_ADMISSION_ENABLED:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.zrem(IN_FLIGHT_KEY, str(photo_id))
+        pipe.zrem(USER_IN_FLIGHT_KEY.format(user_id), str(photo_id))
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Photo {photo_id}: Could not release in-flight slot - {str(e)}")
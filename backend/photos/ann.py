@@ -0,0 +1,262 @@
+# "More like this" search: an IVF-PQ index in NumPy, saved as .npy files under PHOTO_ANN_INDEX_PATH and
+# memory-mapped by every process. Photos saved after the build are scored exactly from the database
+# until the next build (manage.py build_similarity_index or build_similarity_index_task)
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from photos.models import Photo
+from photos.semantic import get_embedding_index, max_candidates, search_queryset
+
+logger = logging.getLogger(__name__)
+
+PQ_CENTROIDS = 256
+ARRAYS = ("centroids", "codebooks", "offsets", "ids", "codes", "vectors")
+
+
+# index of the nearest centroid (L2) for each row of x, in chunks to bound memory
+def _nearest(x, centroids, chunk_size=16384):
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    result = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        block = x[start:start + chunk_size]
+        # argmin |x - c|^2 == argmax x.c - |c|^2 / 2
+        result[start:start + chunk_size] = np.argmax(block @ centroids.T - half_norms, axis=1)
+    return result
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # restart empty clusters on random points
+        centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+    return centroids
+
+
+class IVFPQIndex:
+
+    def __init__(self, centroids, codebooks, offsets, ids, codes, vectors=None, built_at=None):
+        self.centroids = centroids  # (nlist, dim) float32
+        self.codebooks = codebooks  # (m, 256, dim / m) float32
+        self.offsets = offsets  # (nlist + 1,) row range of each inverted list
+        self.ids = ids  # (n, 16) uint8 photo UUIDs, sorted by list
+        self.codes = codes  # (n, m) uint8
+        self.vectors = vectors  # (n, dim) float16, for re-ranking
+        self.built_at = built_at
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    # built_at is when the vectors were read; anything saved after it is scored from the database instead
+    @classmethod
+    def build(cls, photo_ids, vectors, nlist=None, m=None, train_size=50000, iterations=20, seed=0, built_at=None):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        m = m or settings.PHOTO_ANN_PQ_M
+        if dim % m:
+            raise ValueError(f"Embedding size {dim} is not divisible into {m} sub-vectors")
+
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, train_size), replace=False)]
+        centroids = kmeans(sample, min(nlist, len(sample)), iterations, seed)
+
+        residuals = sample - centroids[_nearest(sample, centroids)]
+        sub = residuals.reshape(len(sample), m, dim // m)
+        codebooks = np.stack([
+            kmeans(np.ascontiguousarray(sub[:, j]), PQ_CENTROIDS, iterations, seed + j) for j in range(m)
+        ])
+
+        assignment = _nearest(vectors, centroids)
+        order = np.argsort(assignment, kind="stable")
+        assignment = assignment[order]
+        vectors = vectors[order]
+        offsets = np.searchsorted(assignment, np.arange(len(centroids) + 1)).astype(np.int64)
+
+        residuals = (vectors - centroids[assignment]).reshape(n, m, dim // m)
+        codes = np.empty((n, m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = _nearest(np.ascontiguousarray(residuals[:, j]), codebooks[j])
+
+        ids = np.array([photo_id.bytes for photo_id in photo_ids], dtype="V16")[order]
+        return cls(
+            centroids, codebooks, offsets, ids.view(np.uint8).reshape(n, 16), codes,
+            vectors.astype(np.float16), built_at or timezone.now(),
+        )
+
+    # [(photo id, score)] of about the k most similar vectors, best first
+    def search(self, query, k, nprobe=None, rerank=None):
+        nprobe = min(nprobe or settings.PHOTO_ANN_NPROBE, self.nlist)
+        rerank = settings.PHOTO_ANN_RERANK if rerank is None else rerank
+        query = np.asarray(query, dtype=np.float32)
+        if not len(self):
+            return []
+
+        coarse = self.centroids @ query
+        probed = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+        starts, ends = self.offsets[probed], self.offsets[probed + 1]
+        lengths = ends - starts
+        if not lengths.sum():
+            return []
+        rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+        # q.(c + r) = q.c + sum over sub-vectors of q_j . codebook_j[code_j]
+        m, _, sub_dim = self.codebooks.shape
+        table = np.einsum("jkd,jd->jk", self.codebooks, query.reshape(m, sub_dim))
+        scores = np.repeat(coarse[probed], lengths) + table[np.arange(m), self.codes[rows]].sum(axis=1)
+
+        shortlist = min(len(rows), k * 10 if rerank and self.vectors is not None else k)
+        best = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        rows, scores = rows[best], scores[best]
+        if rerank and self.vectors is not None:
+            scores = self.vectors[rows].astype(np.float32) @ query
+
+        top = np.argsort(-scores)[:k]
+        return [(uuid.UUID(bytes=self.ids[rows[i]].tobytes()), float(scores[i])) for i in top]
+
+    # write the index to a fresh directory and swap it in, so readers never see a partial index
+    def save(self, path):
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in ARRAYS:
+            value = getattr(self, name)
+            if value is not None:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), value)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"built_at": self.built_at.isoformat(), "count": len(self), "nlist": self.nlist}, f)
+
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        arrays = {}
+        for name in ARRAYS:
+            file = os.path.join(path, f"{name}.npy")
+            arrays[name] = np.load(file, mmap_mode="r") if os.path.exists(file) else None
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(**arrays, built_at=parse_datetime(meta["built_at"]))
+
+
+def build_similarity_index(path=None):
+    path = path or settings.PHOTO_ANN_INDEX_PATH
+    started = time.perf_counter()
+    built_at = timezone.now()
+
+    rows = Photo.objects.filter(embedding__isnull=False).values_list("id", "embedding")
+    photo_ids, vectors = [], []
+    for photo_id, embedding in rows.iterator(chunk_size=5000):
+        photo_ids.append(photo_id)
+        vectors.append(np.frombuffer(bytes(embedding), dtype=np.float16))
+    if not vectors:
+        raise ValueError("No photo embeddings to index")
+
+    index = IVFPQIndex.build(photo_ids, np.stack(vectors), nlist=settings.PHOTO_ANN_NLIST or None, built_at=built_at)
+    index.save(path)
+    logger.info(
+        "Similarity index: %d photos in %d lists built in %.1fs", len(index), index.nlist,
+        time.perf_counter() - started,
+    )
+    return index
+
+
+# The on-disk index of this process, reloaded when a rebuild replaces it
+class _LoadedIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._mtime = None
+        self._delta = ([], None)
+        self._delta_checked = None
+
+    def get(self):
+        meta = os.path.join(settings.PHOTO_ANN_INDEX_PATH, "meta.json")
+        try:
+            mtime = os.stat(meta).st_mtime
+        except FileNotFoundError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._index = IVFPQIndex.load(settings.PHOTO_ANN_INDEX_PATH)
+                    self._mtime = mtime
+                    self._delta_checked = None
+        return self._index
+
+    # embeddings saved since the index was built, refreshed every PHOTO_SEMANTIC_SYNC_SECONDS
+    def delta(self, index):
+        now = time.monotonic()
+        if self._delta_checked is None or now - self._delta_checked >= settings.PHOTO_SEMANTIC_SYNC_SECONDS:
+            rows = Photo.objects.filter(embedding__isnull=False, embedded_at__gte=index.built_at) \
+                .values_list("id", "embedding")
+            photo_ids, vectors = [], []
+            for photo_id, embedding in rows.iterator(chunk_size=2000):
+                photo_ids.append(photo_id)
+                vectors.append(np.frombuffer(bytes(embedding), dtype=np.float16))
+            self._delta = (photo_ids, np.stack(vectors).astype(np.float32) if vectors else None)
+            self._delta_checked = now
+        return self._delta
+
+
+_loaded = _LoadedIndex()
+
+
+def _candidates(vector, k):
+    index = _loaded.get()
+    if index is None:
+        # no index built yet: exact search over the in-memory embeddings
+        ids, scores = get_embedding_index().search(vector, k)
+        return list(zip(ids, scores)), len(get_embedding_index())
+
+    results = dict(index.search(vector, k))
+    delta_ids, delta_vectors = _loaded.delta(index)
+    if delta_vectors is not None:
+        # exact scores for photos newer than the index; they replace stale entries of re-embedded photos
+        results.update(zip(delta_ids, (delta_vectors @ vector).tolist()))
+    ranked = sorted(results.items(), key=lambda item: item[1], reverse=True)[:k]
+    return ranked, len(index) + len(delta_ids)
+
+
+# queryset is already filtered to what the user may read; widening is capped like in semantic_search
+def similar_photos(photo, queryset, k=20):
+    vector = np.frombuffer(bytes(photo.embedding), dtype=np.float16).astype(np.float32)
+
+    candidates = k * 4
+    while True:
+        ranked, total = _candidates(vector, candidates + 1)
+        ranked = [(photo_id, score) for photo_id, score in ranked if photo_id != photo.id]
+        visible = set(queryset.filter(id__in=[photo_id for photo_id, _ in ranked]).values_list("id", flat=True))
+        results = [(photo_id, score) for photo_id, score in ranked if photo_id in visible][:k]
+        if len(results) >= k or candidates >= total:
+            return results
+        limit = max_candidates(k, total)
+        if candidates >= limit:
+            return search_queryset(vector, queryset.exclude(id=photo.id), k)
+        candidates = min(candidates * 4, limit)
@@ -1,7 +1,9 @@
 import os
 
 import firebase_admin
+from PIL import Image
 from django.apps import AppConfig
+from django.conf import settings
 from dotenv import load_dotenv
 from firebase_admin import credentials
 
@@ -11,7 +13,14 @@ class PhotosConfig(AppConfig):
     name = 'photos'
 
     def ready(self):
+        from photos import signals  # noqa: F401
+
         load_dotenv()
+        # Pillow warns above this many pixels and refuses to open images over twice as large
+        Image.MAX_IMAGE_PIXELS = settings.PHOTO_MAX_IMAGE_PIXELS
+        if settings.PHOTO_STORAGE_BACKEND != "firebase":
+            return
+
         if not firebase_admin._apps:
             cred = credentials.Certificate('pixel-i.json')
             firebase_admin.initialize_app(cred, {
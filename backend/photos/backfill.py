@@ -0,0 +1,27 @@
+# Photos whose pipeline stages are behind STAGE_VERSIONS (or that never finished), for manage.py backfill_photos
+
+from django.db.models import Q
+
+from photos.models import Photo
+from photos.tasks import STAGE_VERSIONS
+
+
+# the stages (of stages, default all) a photo has not gone through at their current version
+def missing_stages(stage_versions, stages=None):
+    stage_versions = stage_versions or {}
+    return [
+        stage for stage in (stages or STAGE_VERSIONS)
+        if stage_versions.get(stage, 0) < STAGE_VERSIONS[stage]
+    ]
+
+
+# photos still pending upload or in the pipeline are left alone
+def behind_photos(stages=None, include_failed=True):
+    behind = Q()
+    for stage in stages or STAGE_VERSIONS:
+        behind |= ~Q(stage_versions__has_key=stage) | Q(**{f"stage_versions__{stage}__lt": STAGE_VERSIONS[stage]})
+
+    statuses = [Photo.PhotoStatus.COMPLETED]
+    if include_failed:
+        statuses.append(Photo.PhotoStatus.FAILED)
+    return Photo.objects.filter(behind, status__in=statuses)
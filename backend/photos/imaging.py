@@ -0,0 +1,344 @@
+import base64
+import logging
+import os
+from functools import cached_property, lru_cache
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from photos.services import (
+    downscale_image,
+    encode_variant,
+    pillow_to_content_file,
+    variant_format_supported,
+    read_exif_data,
+    thumbnail_from_image,
+    watermark_from_image,
+    analyze_image,
+    VARIANT_FORMATS,
+    _logo_position,
+    _logo_width,
+    _scaled_logo
+)
+from photos.large_images import ImageTooLarge, check_pixels, is_large
+from photos.similarity import perceptual_hash
+
+try:
+    # optional, for PHOTO_IMAGE_ENGINE = "vips"; also needs libvips itself
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+logger = logging.getLogger(__name__)
+
+
+# (width, height, placeholder) cheap enough for the request: dimensions from the header, and the image
+# fitted in PHOTO_PLACEHOLDER_SIZE as a small JPEG data: URI ("" if the pixels cannot be decoded)
+def image_preview(image_file, size=None):
+    size = size or settings.PHOTO_PLACEHOLDER_SIZE
+    image_file.seek(0)
+    try:
+        with Image.open(image_file) as img:
+            width, height = img.size
+            try:
+                small = downscale_image(img, (size, size), "fast")
+            except Exception as e:
+                logger.warning(f"Could not build placeholder for {getattr(image_file, 'name', 'upload')} - {str(e)}")
+                return width, height, ""
+    finally:
+        image_file.seek(0)
+
+    buffer = BytesIO()
+    small.save(buffer, "JPEG", quality=settings.PHOTO_PLACEHOLDER_QUALITY, optimize=True)
+    return width, height, "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+# Decodes an original once, on first use, and derives every variant from a shared downscaled copy
+class ImagePipeline:
+    def __init__(self, image_file, base_size=None, downscale_mode=None, img_format=None):
+        if isinstance(image_file, (str, os.PathLike)):
+            # opening by path lets Pillow read (or memory-map) the file instead of a Python buffer
+            self._source = Image.open(image_file)
+        else:
+            image_file.seek(0)
+            self._source = Image.open(image_file)
+        # output format of the legacy variants; overridden when opening a working copy of the original
+        self.format = img_format or self._source.format
+        self.width, self.height = self._source.size
+        try:
+            check_pixels(self.width, self.height)
+        except ImageTooLarge:
+            self._source.close()
+            raise
+        self.exif = read_exif_data(self._source, decode=not is_large(self._source))
+        self.base_size = base_size or max([1200, *settings.PHOTO_VARIANT_SIZES])
+        self.downscale_mode = downscale_mode
+
+    @cached_property
+    def base(self) -> Image.Image:
+        base = downscale_image(self._source, (self.base_size, self.base_size), self.downscale_mode)
+        self._source.close()
+        self._source = None
+        return base
+
+    def metadata(self):
+        return self.width, self.height, self.exif
+
+    # the decoded base as a high-quality JPEG, for pipeline stages that run on other workers
+    def working_copy(self):
+        return pillow_to_content_file(self.base, "working.jpg", "JPEG", quality=95)
+
+    def watermarked(self, size=1200):
+        return watermark_from_image(self.base, self.format, size)
+
+    def thumbnail(self, size=(300, 300)):
+        return thumbnail_from_image(self.base, self.format, size)
+
+    # largest rung first, each resized from the one above; rungs larger than the original are skipped
+    def variant_ladder(self, sizes=None, formats=None):
+        sizes = sorted(set(sizes or settings.PHOTO_VARIANT_SIZES), reverse=True)
+        supported = []
+        for img_format in formats or settings.PHOTO_VARIANT_FORMATS:
+            if variant_format_supported(img_format):
+                supported.append(img_format)
+            else:
+                logger.warning("Skipping variant format %s: not supported by this Pillow build", img_format)
+
+        longest = max(self.width, self.height)
+        rungs = [size for size in sizes if size <= longest] or [longest]
+
+        img = self.base
+        for size in rungs:
+            if img is self.base:
+                img = img.copy()
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+            watermark = size >= settings.PHOTO_VARIANT_WATERMARK_MIN_SIZE
+
+            for img_format in supported:
+                file = encode_variant(img, img_format, str(size), watermark)
+                descriptor = {
+                    "size": size,
+                    "width": img.width,
+                    "height": img.height,
+                    "format": img_format.lower(),
+                    "bytes": file.size,
+                    "watermarked": watermark,
+                }
+                yield descriptor, file
+
+    def perceptual_hash(self):
+        return perceptual_hash(self.base)
+
+    def analyze(self, tags=None):
+        return analyze_image(self.base, tags)
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        self.__dict__.pop("base", None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Pillow's default encoder qualities, so both engines write comparable files when none is given
+PILLOW_DEFAULT_QUALITY = {"JPEG": 75, "WEBP": 80, "AVIF": 75}
+# vips savers by Pillow format name; others are encoded with Pillow
+VIPS_SAVERS = {
+    "JPEG": ("jpegsave_buffer", {"subsample_mode": "on"}),
+    "PNG": ("pngsave_buffer", {}),
+    "WEBP": ("webpsave_buffer", {}),
+    "AVIF": ("heifsave_buffer", {"compression": "av1"}),
+}
+
+
+# 8-bit sRGB without alpha, like Image.convert("RGB")
+def _vips_rgb(img):
+    if img.hasalpha():
+        img = img.extract_band(0, n=img.bands - 1)
+    if img.interpretation != "srgb":
+        img = img.colourspace("srgb")
+    if img.format != "uchar":
+        img = img.cast("uchar")
+    return img
+
+
+def _vips_to_pil(img):
+    return Image.fromarray(img.numpy())
+
+
+# encoded bytes of img in a Pillow format name, with the metadata stripped as Pillow does
+def _vips_encode(img, img_format, quality=None):
+    quality = quality or PILLOW_DEFAULT_QUALITY.get(img_format)
+    if img_format not in VIPS_SAVERS:
+        buffer = BytesIO()
+        _vips_to_pil(img).save(buffer, format=img_format)
+        return buffer.getvalue()
+    saver, options = VIPS_SAVERS[img_format]
+    options = {**options, **({"keep": "none"} if pyvips.at_least_libvips(8, 15) else {"strip": True})}
+    if quality is not None:
+        options["Q"] = quality
+    return getattr(img, saver)(**options)
+
+
+@lru_cache(maxsize=16)
+def _vips_logo(logo_path, width):
+    logo = pyvips.Image.new_from_array(np.asarray(_scaled_logo(logo_path, width)))
+    return logo.copy(interpretation="srgb")
+
+
+def _vips_watermark(img):
+    width = _logo_width(int(img.width * settings.PHOTO_WATERMARK_SCALE))
+    logo = _vips_logo(str(settings.PHOTO_WATERMARK_LOGO_PATH), width)
+    x, y = _logo_position(
+        (img.width, img.height),
+        (logo.width, logo.height),
+        settings.PHOTO_WATERMARK_POSITION,
+        settings.PHOTO_WATERMARK_PADDING,
+    )
+    return _vips_rgb(img.composite2(logo, "over", x=x, y=y))
+
+
+def vips_format_supported(img_format):
+    if img_format not in VARIANT_FORMATS or img_format not in VIPS_SAVERS:
+        return False
+    return pyvips.type_find("VipsOperation", VIPS_SAVERS[img_format][0]) != 0
+
+
+# ImagePipeline on libvips (PHOTO_IMAGE_ENGINE=vips), same interface and outputs. The base comes from
+# vips thumbnail, which shrinks on load or streams in strips, so the full-size original is never in
+# memory. Metadata is read with Pillow; downscale_mode is ignored
+class VipsImagePipeline:
+    def __init__(self, image_file, base_size=None, downscale_mode=None, img_format=None):
+        if isinstance(image_file, (str, os.PathLike)):
+            self._path, self._buffer = str(image_file), None
+            header = Image.open(self._path)
+        else:
+            image_file.seek(0)
+            self._path, self._buffer = None, image_file.read()
+            header = Image.open(BytesIO(self._buffer))
+        with header:
+            self.format = img_format or header.format
+            self.width, self.height = header.size
+            check_pixels(self.width, self.height)
+            self.exif = read_exif_data(header, decode=not is_large(header))
+        self.base_size = base_size or max([1200, *settings.PHOTO_VARIANT_SIZES])
+        self.downscale_mode = downscale_mode
+
+    @cached_property
+    def base(self):
+        # no_rotate: like the Pillow engine, pixels are kept in stored orientation
+        options = {"height": self.base_size, "size": "down", "no_rotate": True}
+        if self._path is not None:
+            base = pyvips.Image.thumbnail(self._path, self.base_size, **options)
+        else:
+            base = pyvips.Image.thumbnail_buffer(self._buffer, self.base_size, **options)
+        base = _vips_rgb(base).copy_memory()
+        self._buffer = None
+        return base
+
+    # the base as a Pillow image, for perceptual hashing and CLIP
+    @cached_property
+    def pil_base(self) -> Image.Image:
+        return _vips_to_pil(self.base)
+
+    def metadata(self):
+        return self.width, self.height, self.exif
+
+    def working_copy(self):
+        return ContentFile(_vips_encode(self.base, "JPEG", quality=95), name="working.jpg")
+
+    def _fit(self, img, size):
+        return img.thumbnail_image(size[0], height=size[1], size="down")
+
+    def watermarked(self, size=1200):
+        img = _vips_watermark(self._fit(self.base, (size, size)))
+        return ContentFile(_vips_encode(img, self.format.upper()), name=f"watermarked.{self.format.lower()}")
+
+    def thumbnail(self, size=(300, 300)):
+        img = self._fit(self.base, size)
+        return ContentFile(_vips_encode(img, self.format.upper()), name=f"thumbnail.{self.format.lower()}")
+
+    # same rungs, descriptors and names as ImagePipeline.variant_ladder
+    def variant_ladder(self, sizes=None, formats=None):
+        sizes = sorted(set(sizes or settings.PHOTO_VARIANT_SIZES), reverse=True)
+        supported = []
+        for img_format in formats or settings.PHOTO_VARIANT_FORMATS:
+            if vips_format_supported(img_format):
+                supported.append(img_format)
+            else:
+                logger.warning("Skipping variant format %s: not supported by this libvips build", img_format)
+
+        longest = max(self.width, self.height)
+        rungs = [size for size in sizes if size <= longest] or [longest]
+
+        img = self.base
+        for size in rungs:
+            # rendered, so the next rung and every encode start from this one instead of the base
+            img = self._fit(img, (size, size)).copy_memory()
+            watermark = size >= settings.PHOTO_VARIANT_WATERMARK_MIN_SIZE
+            stamped = _vips_watermark(img) if watermark else img
+
+            for img_format in supported:
+                file = ContentFile(
+                    _vips_encode(stamped, img_format, settings.PHOTO_VARIANT_QUALITY),
+                    name=f"{size}.{VARIANT_FORMATS[img_format][1]}",
+                )
+                descriptor = {
+                    "size": size,
+                    "width": img.width,
+                    "height": img.height,
+                    "format": img_format.lower(),
+                    "bytes": file.size,
+                    "watermarked": watermark,
+                }
+                yield descriptor, file
+
+    def perceptual_hash(self):
+        return perceptual_hash(self.pil_base)
+
+    def analyze(self, tags=None):
+        return analyze_image(self.pil_base, tags)
+
+    def close(self):
+        self._buffer = None
+        self.__dict__.pop("base", None)
+        self.__dict__.pop("pil_base", None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_vips_ready = None
+
+
+def _vips_available():
+    global _vips_ready
+    if _vips_ready is None:
+        _vips_ready = pyvips is not None
+        if not _vips_ready:
+            logger.warning("PHOTO_IMAGE_ENGINE is vips but pyvips/libvips is not installed, using Pillow")
+        else:
+            # every original is different, so cached operations would only hold on to memory
+            pyvips.cache_set_max(0)
+    return _vips_ready
+
+
+# an ImagePipeline or VipsImagePipeline over image_file, per PHOTO_IMAGE_ENGINE
+def open_image_pipeline(image_file, **kwargs):
+    engine = settings.PHOTO_IMAGE_ENGINE
+    if engine not in ("pillow", "vips"):
+        raise ValueError(f"Unknown image engine {engine}")
+    if engine == "vips" and _vips_available():
+        return VipsImagePipeline(image_file, **kwargs)
+    return ImagePipeline(image_file, **kwargs)
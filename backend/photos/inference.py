@@ -0,0 +1,245 @@
+# Shared CLIP inference server: workers send preprocessed input tensors over a Unix socket, and the
+# server runs them through encode_image in micro-batches (CLIP_INFERENCE_MAX_BATCH, CLIP_INFERENCE_MAX_WAIT_MS).
+#
+# Frames in both directions are a 4-byte big-endian length followed by the payload:
+#   image request: JSON header {"kind": "image", "shape", "dtype", "top_k", "tags"}, then the raw
+#                  float16 input tensor
+#   text request:  JSON header {"kind": "text", "text"}; encoded directly, without batching
+#   response:      JSON {"tags": [[tag, score], ...]} ({} for text), then the normalized float16
+#                  embedding; or only JSON {"error": "..."}
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+import torch
+from django.conf import settings
+
+from photos.services import encode_image_tensors, encode_text, rank_tags, warm_clip_model
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct("!I")
+
+
+def _send_frame(sock, payload: bytes):
+    sock.sendall(_LENGTH.pack(len(payload)))
+    sock.sendall(payload)
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Connection closed mid-frame")
+        received += n
+    return buffer
+
+
+# next frame, or None when the peer closed the connection between frames
+def _recv_frame(sock):
+    header = sock.recv(_LENGTH.size, socket.MSG_WAITALL)
+    if not header:
+        return None
+    if len(header) < _LENGTH.size:
+        raise ConnectionError("Connection closed mid-frame")
+    return _recv_exact(sock, _LENGTH.unpack(header)[0])
+
+
+@lru_cache(maxsize=1)
+def _preprocess():
+    # the CLIP input transform alone, so clients never have to load the model weights
+    from clip.clip import _transform
+    return _transform(settings.CLIP_INPUT_RESOLUTION)
+
+
+class InferenceClient:
+
+    def __init__(self, socket_path=None, timeout=None):
+        self.socket_path = socket_path or settings.CLIP_INFERENCE_SOCKET
+        self.timeout = timeout or settings.CLIP_INFERENCE_TIMEOUT
+
+    # ([(tag, score), ...], float16 embedding) for a PIL image
+    def analyze(self, image, tags=None, top_k=10):
+        tensor = _preprocess()(image).to(torch.float16).numpy()
+        return self.analyze_tensor(tensor, tags, top_k)
+
+    def analyze_tensor(self, tensor: np.ndarray, tags=None, top_k=10):
+        header = {"kind": "image", "shape": list(tensor.shape), "dtype": "float16", "top_k": top_k, "tags": tags}
+        response, embedding = self._request(header, np.ascontiguousarray(tensor, dtype=np.float16).tobytes())
+        return [(tag, score) for tag, score in response["tags"]], embedding
+
+    def encode_text(self, text):
+        return self._request({"kind": "text", "text": text})[1]
+
+    def _request(self, header, body=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            _send_frame(sock, json.dumps(header).encode())
+            if body is not None:
+                _send_frame(sock, body)
+
+            response = _recv_frame(sock)
+            if response is None:
+                raise ConnectionError("Inference server closed the connection")
+            response = json.loads(response)
+            if "error" in response:
+                raise RuntimeError(f"Inference server error: {response['error']}")
+
+            embedding = _recv_frame(sock)
+            if embedding is None:
+                raise ConnectionError("Inference server closed the connection")
+        return response, np.frombuffer(embedding, dtype=np.float16)
+
+
+@dataclass
+class _Request:
+    tensor: torch.Tensor
+    tags: tuple
+    top_k: int
+    future: Future
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                header = _recv_frame(sock)
+                if header is None:
+                    return
+                header = json.loads(header)
+                body = None
+                if header.get("kind", "image") == "image":
+                    body = _recv_frame(sock)
+                    if body is None:
+                        return
+            except (ConnectionError, ValueError) as e:
+                logger.warning("Dropping inference connection - %s", e)
+                return
+
+            try:
+                if body is None:
+                    response, embedding = {}, encode_text(header["text"])
+                else:
+                    tensor = torch.frombuffer(body, dtype=torch.float16).reshape(header["shape"]).float()
+                    tags = tuple(header["tags"]) if header.get("tags") else None
+                    future = self.server.inference.submit(tensor, tags, int(header.get("top_k", 10)))
+                    ranked, embedding = future.result()
+                    response = {"tags": ranked}
+            except Exception as e:
+                _send_frame(sock, json.dumps({"error": str(e)}).encode())
+                continue
+            _send_frame(sock, json.dumps(response).encode())
+            _send_frame(sock, np.asarray(embedding, dtype=np.float16).tobytes())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # every tagging worker on the host may connect at once; the default backlog of 5 refuses them
+    request_queue_size = 128
+
+
+class InferenceServer:
+
+    def __init__(self, socket_path=None, max_batch=None, max_wait_ms=None):
+        self.socket_path = socket_path or settings.CLIP_INFERENCE_SOCKET
+        self.max_batch = max_batch or settings.CLIP_INFERENCE_MAX_BATCH
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else settings.CLIP_INFERENCE_MAX_WAIT_MS) / 1000
+        self._queue = queue.Queue()
+        self._server = None
+        self._batcher = None
+        self.batches = 0
+        self.batched_requests = 0
+
+    def submit(self, tensor, tags=None, top_k=10):
+        future = Future()
+        self._queue.put(_Request(tensor, tags, top_k, future))
+        return future
+
+    def start(self):
+        warm_clip_model()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._batcher = threading.Thread(target=self._batch_loop, name="clip-batcher", daemon=True)
+        self._batcher.start()
+        self._server = _UnixServer(self.socket_path, _Handler)
+        self._server.inference = self
+        logger.info(
+            "CLIP inference server on %s (max batch %d, max wait %.1fms)",
+            self.socket_path, self.max_batch, self.max_wait * 1000,
+        )
+
+    def serve_forever(self):
+        if self._server is None:
+            self.start()
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self._queue.put(None)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _batch_loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        # requests with a different vocabulary or top_k cannot share a similarity matrix
+        groups = {}
+        for item in batch:
+            groups.setdefault((item.tags, item.top_k), []).append(item)
+
+        for (tags, top_k), items in groups.items():
+            try:
+                image_features = encode_image_tensors(torch.stack([item.tensor for item in items]))
+                results = rank_tags(image_features, tags, top_k)
+                embeddings = image_features.cpu().numpy().astype(np.float16)
+            except Exception as e:
+                logger.error("CLIP batch of %d failed - %s", len(items), e)
+                for item in items:
+                    item.future.set_exception(e)
+                continue
+            for item, result, embedding in zip(items, results, embeddings):
+                item.future.set_result((result, embedding))
+
+        self.batches += 1
+        self.batched_requests += len(batch)
@@ -0,0 +1,216 @@
+# Very large originals: refused above PHOTO_MAX_IMAGE_PIXELS (ImageTooLarge). From PHOTO_LARGE_IMAGE_PIXELS
+# up they are decoded within PHOTO_IMAGE_MEMORY_LIMIT: JPEGs at reduced scale, uncompressed TIFF/PPM/BMP
+# a band of strips at a time, box-reduced as they go, anything else only if a whole decode fits
+
+import logging
+
+from PIL import Image
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# decoder buffers and allocator slack on top of the pixel buffers, measured with benchmark_large_images
+DECODE_OVERHEAD = 1.2
+# Pillow's recommendation for a reduce-then-resample result indistinguishable from a full resample;
+# used in large-image mode when the downscale mode does not reduce ("quality")
+LARGE_IMAGE_REDUCING_GAP = 3.0
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def check_pixels(width, height):
+    if width * height > settings.PHOTO_MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(
+            f"Image of {width}x{height} pixels is over the limit of {settings.PHOTO_MAX_IMAGE_PIXELS} pixels"
+        )
+
+
+def is_large(img: Image.Image):
+    return img.width * img.height > settings.PHOTO_LARGE_IMAGE_PIXELS
+
+
+# memory Pillow allocates for the pixels: 1 byte per pixel for 1/L/P, 2 for I;16, otherwise 4
+def decoded_bytes(width, height, mode):
+    if mode in ("1", "L", "P"):
+        pixel_size = 1
+    elif mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    return width * height * pixel_size
+
+
+def _reducible(img):
+    return img.mode in ("L", "LA", "RGB", "RGBA", "CMYK", "YCbCr", "I", "F")
+
+
+# mode of the bands decoded from img: other modes are converted to RGB so they can be reduced
+def _band_mode(img):
+    return img.mode if _reducible(img) else "RGB"
+
+
+# bits per pixel of the raw layouts whose rows can be located in the file without decoding
+RAW_BITS = {
+    "1": 1, "L": 8, "P": 8, "LA": 16, "I;16": 16, "I;16B": 16, "RGB": 24, "BGR": 24, "BGR;24": 24,
+    "RGBA": 32, "RGBX": 32, "BGRA": 32, "BGRX": 32, "CMYK": 32, "I": 32, "F": 32,
+}
+# rows per strip when a single raw tile is split into strips
+SPLIT_ROWS = 64
+
+
+# (rawmode, stride, orientation) of a raw tile width pixels wide, or None for a layout not in RAW_BITS
+def _raw_args(tile, width):
+    args = (tile.args,) if isinstance(tile.args, str) else tuple(tile.args)
+    rawmode, stride, orientation = (args + (0, 1))[:3]
+    if rawmode not in RAW_BITS:
+        return None
+    return rawmode, stride or (RAW_BITS[rawmode] * width + 7) // 8, orientation
+
+
+# strips of a raw tile covering the whole image, a multiple of factor rows high so bands need no carried rows
+def _split_raw_tile(tile, width, height, factor):
+    args = _raw_args(tile, width)
+    if args is None or tile.extents != (0, 0, width, height):
+        return None
+    rawmode, stride, orientation = args
+    rows = max(factor, SPLIT_ROWS - SPLIT_ROWS % factor)
+    strips = []
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        # bottom-up images (orientation -1) store the last row first
+        first_row = top if orientation > 0 else height - bottom
+        strips.append(tile._replace(
+            extents=(0, top, width, bottom), offset=tile.offset + first_row * stride,
+            args=(rawmode, stride, orientation),
+        ))
+    return strips
+
+
+# the image's tiles as full-width strips, top to bottom, or None if it has to be decoded whole
+def _strips(img, factor):
+    tiles = img.tile
+    # tiles are named tuples from Pillow 11 on; older versions decode whole
+    if not tiles or any(getattr(tile, "codec_name", None) != "raw" for tile in tiles):
+        return None
+    if len(tiles) == 1:
+        return _split_raw_tile(tiles[0], img.width, img.height, factor)
+    if any(_raw_args(tile, tile.extents[2] - tile.extents[0]) is None for tile in tiles):
+        return None
+    rows = sorted({(tile.extents[1], tile.extents[3]) for tile in tiles})
+    # strips must not overlap, or a band could not be decoded without its neighbours
+    if any(bottom > next_top for (_, bottom), (next_top, _) in zip(rows, rows[1:])):
+        return None
+    return sorted(tiles, key=lambda tile: (tile.extents[1], tile.extents[0]))
+
+
+# decode rows [top, bottom) of an unloaded image, reading only their strips from the file and unpacking
+# each with Image.frombytes, so the image itself is never loaded
+def _decode_band(img, strips, top, bottom):
+    band = Image.new(img.mode, (img.width, bottom - top))
+    for strip in strips:
+        left, strip_top, right, strip_bottom = strip.extents
+        if strip_top < top or strip_bottom > bottom:
+            continue
+        rawmode, stride, orientation = _raw_args(strip, right - left)
+        img.fp.seek(strip.offset)
+        data = img.fp.read(stride * (strip_bottom - strip_top))
+        size = (right - left, strip_bottom - strip_top)
+        band.paste(Image.frombytes(img.mode, size, data, "raw", rawmode, stride, orientation), (left, strip_top - top))
+    if img.mode == "P":
+        rawmode, palette = img.palette.getdata()
+        band.putpalette(palette, rawmode)
+    if not _reducible(band):
+        band = band.convert("RGB")
+    return band
+
+
+# img box-reduced by factor, decoded in bands of strips of at most band_budget bytes each
+def _reduce_in_strips(img, strips, factor, band_budget):
+    width, height = img.size
+    band_mode = _band_mode(img)
+    out = None
+    carry = None  # rows left over from the previous band that do not fill a block of factor rows
+    y_out = 0
+
+    bands = []
+    top = bottom = 0
+    for strip in strips:
+        strip_top, strip_bottom = strip.extents[1], strip.extents[3]
+        if strip_top >= bottom and bottom > top \
+                and decoded_bytes(width, strip_bottom - top, band_mode) > band_budget:
+            bands.append((top, bottom))
+            top = strip_top
+        bottom = max(bottom, strip_bottom)
+    bands.append((top, bottom))
+
+    for top, bottom in bands:
+        band = _decode_band(img, strips, top, bottom)
+        if carry is not None:
+            joined = Image.new(band.mode, (width, carry.height + band.height))
+            joined.paste(carry, (0, 0))
+            joined.paste(band, (0, carry.height))
+            band = joined
+        # the last band reduces its partial block of rows too
+        usable = band.height if bottom == height else band.height - band.height % factor
+        if usable:
+            block = band if usable == band.height else band.crop((0, 0, width, usable))
+            reduced = block.reduce(factor) if factor > 1 else block
+            if out is None:
+                out = Image.new(reduced.mode, (-(-width // factor), -(-height // factor)))
+            out.paste(reduced, (0, y_out))
+            y_out += reduced.height
+        carry = band.crop((0, usable, width, band.height)) if usable < band.height else None
+        # let the band go before the next one is decoded
+        band = block = reduced = None
+
+    img.tile = []
+    return out
+
+
+def downscale_large_image(img: Image.Image, size, reducing_gap=None):
+    reducing_gap = reducing_gap or LARGE_IMAGE_REDUCING_GAP
+    limit = settings.PHOTO_IMAGE_MEMORY_LIMIT
+    width, height = img.size
+    scale = min(size[0] / width, size[1] / height, 1)
+    img.draft(None, (int(width * scale * reducing_gap), int(height * scale * reducing_gap)))
+
+    # draft may have reduced the decoded size (JPEG); the factor is what is still left to reduce
+    factor = max(1, int(img.width / (width * scale) / reducing_gap))
+    reduced_size = (-(-img.width // factor), -(-img.height // factor))
+    strips = _strips(img, factor)
+    if strips is not None:
+        # a band, the rows carried over from the previous one joined to it and the block cut from that
+        band_budget = int((limit / DECODE_OVERHEAD - decoded_bytes(*reduced_size, _band_mode(img))) / 3)
+        if band_budget <= 0:
+            raise ImageTooLarge(f"Image of {width}x{height} pixels cannot be reduced within {limit} bytes")
+        reduced = _reduce_in_strips(img, strips, factor, band_budget)
+    else:
+        reducing = factor > 1 and _reducible(img)
+        rgb_size = reduced_size if reducing else img.size
+        # the decoded image, its reduced copy and the RGB conversion of that are alive at once
+        needed = int(DECODE_OVERHEAD * (
+            decoded_bytes(img.width, img.height, img.mode)
+            + (decoded_bytes(*reduced_size, img.mode) if reducing else 0)
+            + (decoded_bytes(*rgb_size, "RGB") if img.mode != "RGB" else 0)
+        ))
+        if needed > limit:
+            raise ImageTooLarge(
+                f"Image of {width}x{height} pixels needs {needed} bytes to decode, over the limit of {limit}"
+            )
+        img.load()
+        reduced = img.reduce(factor) if reducing else img
+
+    logger.info(f"Decoded {width}x{height} image in large-image mode, reduced to {reduced.width}x{reduced.height}")
+    rgb = reduced if reduced.mode == "RGB" else reduced.convert("RGB")
+    if rgb is img:
+        # resize into a new image instead of thumbnailing (and copying) the caller's
+        return rgb.resize(_fitted_size(rgb.size, size), Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+    rgb.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+    return rgb
+
+
+def _fitted_size(image_size, size):
+    scale = min(size[0] / image_size[0], size[1] / image_size[1], 1)
+    return max(1, round(image_size[0] * scale)), max(1, round(image_size[1] * scale))
@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+import random
+import resource
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from photos.large_images import ImageTooLarge
+from photos.services import _logo_position, pillow_to_content_file, read_exif_data
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+# synthetic camera-sized photo: gradient background with random shapes so encoders have real work
+def make_sample_image(width=4000, height=3000, seed=0, img_format="JPEG"):
+    rng = random.Random(seed)
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4), y0 + rng.randrange(height // 4)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        draw.ellipse((x0, y0, x1, y1), fill=color)
+
+    buffer = BytesIO()
+    img.save(buffer, format=img_format, quality=90)
+    buffer.seek(0)
+    return buffer
+
+
+# files from images_dir if given, otherwise synthetic JPEGs. Returns (name, BytesIO) pairs
+def load_corpus(images_dir=None, count=10, width=4000, height=3000):
+    if images_dir:
+        paths = sorted(p for p in Path(images_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+        return [(p.name, BytesIO(p.read_bytes())) for p in paths[:count]]
+    return [(f"sample_{i}.jpg", make_sample_image(width, height, seed=i)) for i in range(count)]
+
+
+# corpus entries are file objects, or paths for files that should be read from disk
+def run_timed(fn, corpus):
+    start = time.perf_counter()
+    for _, image in corpus:
+        if not isinstance(image, (str, os.PathLike)):
+            image.seek(0)
+        fn(image)
+    return time.perf_counter() - start
+
+
+def _current_rss_kib():
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def _isolated_worker(fn, corpus, conn):
+    start_rss = _current_rss_kib()
+    start = time.perf_counter()
+    try:
+        run_timed(fn, corpus)
+        refused = False
+    except ImageTooLarge:
+        refused = True
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((elapsed, max(peak_rss - start_rss, 0) / 1024, refused))
+    conn.close()
+
+
+# forked per run so peak RSS is measured per strategy (tracemalloc cannot see Pillow's pixel buffers);
+# returns (elapsed seconds, peak RSS growth in MiB, whether an image was refused as too large)
+def run_isolated(fn, corpus):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_isolated_worker, args=(fn, corpus, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def add_corpus_arguments(parser, default_count=10):
+    parser.add_argument("--images-dir", help="Directory of images to benchmark on (default: synthetic JPEGs)")
+    parser.add_argument("--count", type=int, default=default_count)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+
+
+# The variant path before ImagePipeline and reduced-scale decoding, kept as the baseline the benchmarks
+# compare against: every variant decodes the whole original and resizes it from full resolution
+
+def generate_thumbnail_image(image_file, size=(300, 300)):
+    with Image.open(image_file) as img:
+        img_format = img.format
+        img = img.convert("RGB")
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        return pillow_to_content_file(img, f"thumbnail.{img_format.lower()}", img_format.upper())
+
+
+# the logo is loaded and resized for every photo, as before it was cached
+def generate_watermarked_image(base_image_file, size=1200):
+    with Image.open(base_image_file) as base:
+        img_format = base.format
+        base = base.convert("RGBA")
+        base.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+        with Image.open(settings.PHOTO_WATERMARK_LOGO_PATH) as logo:
+            logo = logo.convert("RGBA")
+            target_width = int(base.width * settings.PHOTO_WATERMARK_SCALE)
+            logo = logo.resize((target_width, max(1, int(logo.height * target_width / logo.width))),
+                               Image.Resampling.LANCZOS)
+        x, y = _logo_position(base.size, logo.size, settings.PHOTO_WATERMARK_POSITION,
+                              settings.PHOTO_WATERMARK_PADDING)
+        base.paste(logo, (x, y), logo)
+        base = base.convert("RGB")
+        return pillow_to_content_file(base, f"watermarked.{img_format.lower()}", img_format.upper())
+
+
+def extract_exif_data(image_bytes: BytesIO):
+    try:
+        image_bytes.seek(0)
+        image = Image.open(image_bytes)
+        width, height = image.size
+        return width, height, read_exif_data(image)
+    except Exception as e:
+        # If EXIF extraction fails, still try to get dimensions
+        try:
+            image_bytes.seek(0)
+            image = Image.open(image_bytes)
+            width, height = image.size
+            return width, height, {}
+        except:
+            raise APIException(f"Error extracting image metadata: {e}")
@@ -0,0 +1,128 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from photos.backfill import behind_photos, missing_stages
+from photos.models import Photo
+from photos.tasks import STAGE_VERSIONS, process_photo_task
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run the pipeline stages that photos are behind on (see photos.tasks.STAGE_VERSIONS), and "
+        "reprocess failed photos. Enqueues at most --rate photos/sec with at most --concurrency in "
+        "flight, and checkpoints its position so an interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stages", default=",".join(STAGE_VERSIONS),
+                            help="Comma-separated stages to bring up to date (default: all)")
+        parser.add_argument("--no-failed", action="store_true", help="Leave FAILED photos alone")
+        parser.add_argument("--rate", type=float, default=10, help="Photos enqueued per second")
+        parser.add_argument("--concurrency", type=int, default=50, help="Photos in the pipeline at once")
+        parser.add_argument("--batch-size", type=int, default=200, help="Photos read (and checkpointed) per query")
+        parser.add_argument("--inflight-timeout", type=float, default=900,
+                            help="Seconds after which an unfinished photo stops counting against --concurrency")
+        parser.add_argument("--checkpoint", default=settings.PHOTO_BACKFILL_CHECKPOINT)
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the photos behind, per stage")
+
+    def handle(self, *args, **options):
+        stages = [stage for stage in options["stages"].split(",") if stage]
+        unknown = set(stages) - set(STAGE_VERSIONS)
+        if unknown:
+            raise CommandError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        include_failed = not options["no_failed"]
+        queryset = behind_photos(stages, include_failed).order_by("pk")
+
+        if options["dry_run"]:
+            for stage in stages:
+                self.stdout.write(f"{stage:>10} (v{STAGE_VERSIONS[stage]}): {behind_photos([stage], include_failed).count()} photos behind")
+            return
+
+        # a checkpoint only applies to a run with the same target
+        target = {"versions": {stage: STAGE_VERSIONS[stage] for stage in stages}, "include_failed": include_failed}
+        checkpoint = {} if options["restart"] else self._load_checkpoint(options["checkpoint"])
+        if checkpoint.get("target") != target:
+            checkpoint = {"target": target, "last_id": None, "enqueued": 0}
+        elif checkpoint["last_id"]:
+            self.stdout.write(f"Resuming after photo {checkpoint['last_id']} ({checkpoint['enqueued']} enqueued before)")
+
+        self.inflight = {}  # photo id -> when it was enqueued
+        started = time.monotonic()
+        enqueued = 0
+        try:
+            while True:
+                page = queryset
+                if checkpoint["last_id"]:
+                    page = page.filter(pk__gt=checkpoint["last_id"])
+                page = list(page.values_list("id", "stage_versions", "status")[:options["batch_size"]])
+                if not page:
+                    break
+
+                for photo_id, stage_versions, photo_status in page:
+                    self._wait_for_capacity(options["concurrency"], options["inflight_timeout"])
+                    delay = enqueued / options["rate"] - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    self._enqueue(photo_id, missing_stages(stage_versions, stages), photo_status)
+                    enqueued += 1
+                    checkpoint["last_id"] = str(photo_id)
+                    checkpoint["enqueued"] += 1
+
+                self._save_checkpoint(options["checkpoint"], checkpoint)
+                self.stdout.write(f"Enqueued {checkpoint['enqueued']} photos, up to {checkpoint['last_id']}")
+        finally:
+            # also on Ctrl-C: resume after the last photo actually enqueued
+            self._save_checkpoint(options["checkpoint"], checkpoint)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfill done: {enqueued} photos enqueued this run, {checkpoint['enqueued']} in total"
+        ))
+
+    def _enqueue(self, photo_id, missing, photo_status):
+        if photo_status == Photo.PhotoStatus.FAILED:
+            Photo.objects.filter(id=photo_id, status=Photo.PhotoStatus.FAILED).update(
+                status=Photo.PhotoStatus.PROCESSING, updated_at=timezone.now(),
+            )
+        self.inflight[photo_id] = timezone.now()
+        # prepare always runs, so only the stages after it are passed on
+        priority = settings.PHOTO_BACKGROUND_PRIORITY
+        process_photo_task.apply_async(
+            (str(photo_id), [stage for stage in missing if stage != "prepare"]), {"priority": priority},
+            priority=priority,
+        )
+
+    def _wait_for_capacity(self, concurrency, timeout):
+        while len(self.inflight) >= concurrency:
+            # finalize (or a failing stage) saves the photo, moving updated_at past its enqueue time
+            rows = Photo.objects.filter(id__in=list(self.inflight)).values_list("id", "updated_at")
+            updated = dict(rows)
+            now = timezone.now()
+            for photo_id, enqueued_at in list(self.inflight.items()):
+                last_update = updated.get(photo_id)
+                if last_update is None or last_update > enqueued_at:
+                    del self.inflight[photo_id]
+                elif (now - enqueued_at).total_seconds() > timeout:
+                    self.stderr.write(f"Photo {photo_id}: not finished after {timeout:.0f}s, no longer waiting on it")
+                    del self.inflight[photo_id]
+            if len(self.inflight) >= concurrency:
+                time.sleep(1)
+
+    def _load_checkpoint(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_checkpoint(self, path, checkpoint):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,75 @@
+import time
+import uuid
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.ann import IVFPQIndex
+from photos.models import Photo
+
+
+# normalized vectors around random cluster centres, roughly the shape of real image embeddings
+def _clustered_vectors(count, dim, clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(clusters, size=count)] + 1.5 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class Command(BaseCommand):
+    help = "Recall@k and latency of the \"more like this\" IVF-PQ index against exact search, per nprobe"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=100000, help="Synthetic vectors to index")
+        parser.add_argument("--dim", type=int, default=512)
+        parser.add_argument("--clusters", type=int, default=500, help="Clusters in the synthetic vectors")
+        parser.add_argument("--from-db", action="store_true", help="Index the stored photo embeddings instead")
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--nlist", type=int, default=0, help="Inverted lists (default: sqrt(count))")
+        parser.add_argument("--nprobe", default="1,2,4,8,16,32,64")
+
+    def handle(self, *args, **options):
+        if options["from_db"]:
+            rows = list(Photo.objects.filter(embedding__isnull=False).values_list("id", "embedding"))
+            if not rows:
+                raise CommandError("No photo embeddings stored")
+            photo_ids = [photo_id for photo_id, _ in rows]
+            vectors = np.stack([np.frombuffer(bytes(e), dtype=np.float16) for _, e in rows]).astype(np.float32)
+        else:
+            vectors = _clustered_vectors(options["count"], options["dim"], options["clusters"])
+            photo_ids = [uuid.UUID(int=i) for i in range(len(vectors))]
+        k = options["k"]
+
+        start = time.perf_counter()
+        index = IVFPQIndex.build(photo_ids, vectors, nlist=options["nlist"] or None)
+        self.stdout.write(
+            f"{len(index)} vectors x {vectors.shape[1]}, {index.nlist} lists, "
+            f"{index.codes.shape[1]} bytes/code, built in {time.perf_counter() - start:.1f}s"
+        )
+
+        # queries are indexed vectors; the query itself counts as a true neighbour
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), size=min(options["queries"], len(vectors)), replace=False)]
+        start = time.perf_counter()
+        truth = []
+        for query in queries:
+            scores = vectors @ query
+            top = np.argpartition(-scores, k - 1)[:k]
+            truth.append({photo_ids[i] for i in top})
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        self.stdout.write(f"{'exact':>16}: recall@{k} 100.0%, {exact_ms:7.2f} ms/query")
+
+        for nprobe in [int(n) for n in options["nprobe"].split(",") if n]:
+            if nprobe > index.nlist:
+                continue
+            for rerank in (False, True):
+                start = time.perf_counter()
+                found = [index.search(query, k, nprobe=nprobe, rerank=rerank) for query in queries]
+                elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+                recall = np.mean([
+                    len({photo_id for photo_id, _ in results} & expected) / k
+                    for results, expected in zip(found, truth)
+                ])
+                label = f"nprobe={nprobe}{'+rerank' if rerank else ''}"
+                self.stdout.write(f"{label:>16}: recall@{k} {recall:6.1%}, {elapsed_ms:7.2f} ms/query")
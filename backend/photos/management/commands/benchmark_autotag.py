@@ -0,0 +1,56 @@
+import clip
+import torch
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from photos.management.commands._bench import add_corpus_arguments, load_corpus, run_timed
+from photos.services import CLIP_TAGS, analyze_image, warm_clip_model
+
+
+# the pre-cache behaviour: load weights and encode the tag vocabulary for every photo
+def _uncached_auto_tag(image_bytes):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = clip.load(settings.CLIP_MODEL_NAME, device=device)
+
+    with Image.open(image_bytes) as img:
+        image = img.convert("RGB")
+
+    image_tensor = preprocess(image).unsqueeze(0).to(device)
+    tokens = clip.tokenize(CLIP_TAGS).to(device)
+    with torch.no_grad():
+        image_features = model.encode_image(image_tensor)
+        text_features = model.encode_text(tokens)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        similarity = image_features @ text_features.T
+    return similarity[0].cpu().tolist()
+
+
+# the current path: the cached model and tag embeddings, through the inference server if one is configured
+def _cached_auto_tag(image_bytes):
+    with Image.open(image_bytes) as img:
+        image = img.convert("RGB")
+    ranked, _ = analyze_image(image)
+    return [tag for tag, _ in ranked]
+
+
+class Command(BaseCommand):
+    help = "Compare auto-tagging photos/sec with and without the per-process CLIP cache"
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser, default_count=10)
+        parser.add_argument("--skip-uncached", action="store_true", help="Only measure the cached path")
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options["images_dir"], options["count"], options["width"], options["height"])
+        n = len(corpus)
+        self.stdout.write(f"Benchmarking {n} photos on {'cuda' if torch.cuda.is_available() else 'cpu'}")
+
+        if not options["skip_uncached"]:
+            elapsed = run_timed(_uncached_auto_tag, corpus)
+            self.stdout.write(f"uncached: {n / elapsed:.2f} photos/sec ({elapsed:.2f}s)")
+
+        warm_clip_model()
+        elapsed = run_timed(_cached_auto_tag, corpus)
+        self.stdout.write(f"cached:   {n / elapsed:.2f} photos/sec ({elapsed:.2f}s)")
@@ -0,0 +1,93 @@
+import time
+
+import clip
+import torch
+from PIL import Image
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.management.commands._bench import load_corpus
+from photos.services import CLIP_INFERENCE_MODES, CLIP_TAGS, configure_torch_threads, load_clip_model
+
+# Reference evaluation set: seeded synthetic images 0..count-1 at this size, the same on every run so
+# overlap numbers compare across modes, machines and commits. CLIP sees them at 224x224 whatever the size
+REFERENCE_SIZE = (640, 480)
+REFERENCE_COUNT = 32
+
+
+# Top-k tag indices for every image, plus the seconds spent in encode_image
+def _top_tags(model, image_tensors, text_features, batch_size, top_k=10):
+    results = []
+    elapsed = 0.0
+    with torch.no_grad():
+        for i in range(0, len(image_tensors), batch_size):
+            batch = image_tensors[i:i + batch_size]
+            start = time.perf_counter()
+            image_features = model.encode_image(batch)
+            elapsed += time.perf_counter() - start
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+            similarity = image_features.float() @ text_features.T
+            results.extend(similarity.topk(top_k, dim=-1).indices.tolist())
+    return results, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare CPU inference modes for CLIP auto-tagging: images/sec, and top-10 tag agreement "
+        "with the fp32 model on the seeded reference set or the photos of --images-dir"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images-dir", help="Directory of photos to evaluate on instead of the reference set")
+        parser.add_argument("--count", type=int, default=REFERENCE_COUNT)
+        parser.add_argument("--modes", default=",".join(CLIP_INFERENCE_MODES))
+        parser.add_argument("--batch-size", type=int, default=1)
+        parser.add_argument("--min-overlap", type=float, default=0.8,
+                            help="Fail if a mode's mean top-10 overlap with fp32 is below this")
+
+    def handle(self, *args, **options):
+        modes = [mode for mode in options["modes"].split(",") if mode]
+        unknown = set(modes) - set(CLIP_INFERENCE_MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown))}")
+
+        corpus = load_corpus(options["images_dir"], options["count"], *REFERENCE_SIZE)
+        source = options["images_dir"] or "reference set"
+        configure_torch_threads()
+        self.stdout.write(f"{len(corpus)} images ({source}), batch size {options['batch_size']}, {torch.get_num_threads()} torch threads")
+
+        reference, preprocess, device = load_clip_model("fp32")
+        if device != "cpu":
+            self.stdout.write(self.style.WARNING("CUDA is available; the inference modes only apply on CPU"))
+
+        images = []
+        for _, image_bytes in corpus:
+            with Image.open(image_bytes) as img:
+                images.append(preprocess(img.convert("RGB")))
+        image_tensors = torch.stack(images).to(device)
+
+        with torch.no_grad():
+            text_features = reference.encode_text(clip.tokenize(CLIP_TAGS).to(device)).float()
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+
+        expected, _ = _top_tags(reference, image_tensors, text_features, options["batch_size"])
+        del reference
+
+        failed = []
+        for mode in modes:
+            model, _, _ = load_clip_model(mode)
+            # first batch triggers lazy init (and graph optimization for torchscript)
+            _top_tags(model, image_tensors[:options["batch_size"]], text_features, options["batch_size"])
+            ranked, elapsed = _top_tags(model, image_tensors, text_features, options["batch_size"])
+            del model
+
+            overlap = sum(len(set(a) & set(b)) / 10 for a, b in zip(ranked, expected)) / len(expected)
+            top1 = sum(a[0] == b[0] for a, b in zip(ranked, expected)) / len(expected)
+            self.stdout.write(
+                f"{mode:>16}: {len(ranked) / elapsed:7.2f} images/sec, "
+                f"top-10 overlap {overlap:.1%}, top-1 agreement {top1:.1%}"
+            )
+            if overlap < options["min_overlap"]:
+                failed.append(mode)
+
+        if failed:
+            raise CommandError(f"Top-10 overlap with fp32 below {options['min_overlap']:.0%}: {', '.join(failed)}")
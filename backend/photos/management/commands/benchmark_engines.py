@@ -0,0 +1,48 @@
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+
+from photos.imaging import ImagePipeline, VipsImagePipeline, pyvips
+from photos.management.commands._bench import add_corpus_arguments, load_corpus, run_isolated
+
+
+# the image work of the prepare and variants stages for one original, as the pipeline runs it
+def _stages(pipeline_class):
+    def run(image_file):
+        with pipeline_class(image_file) as pipeline:
+            pipeline.metadata()
+            working = BytesIO(pipeline.working_copy().read())
+            img_format = pipeline.format
+        with pipeline_class(working, img_format=img_format) as pipeline:
+            for _ in pipeline.variant_ladder():
+                pass
+            pipeline.watermarked()
+            pipeline.thumbnail()
+    return run
+
+
+class Command(BaseCommand):
+    help = "Compare images/sec and peak memory of the Pillow and libvips image engines (PHOTO_IMAGE_ENGINE)"
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser, default_count=20)
+        parser.add_argument("--vips-concurrency", type=int, default=1,
+                            help="libvips worker threads; each celery worker process handles one image at a time")
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options["images_dir"], options["count"], options["width"], options["height"])
+        n = len(corpus)
+        self.stdout.write(f"Benchmarking {n} images")
+
+        engines = [("pillow", ImagePipeline)]
+        if pyvips is None:
+            self.stdout.write("vips: skipped, pyvips/libvips is not installed")
+        else:
+            pyvips.cache_set_max(0)
+            # pyvips has no wrapper for this before 3.1
+            pyvips.vips_lib.vips_concurrency_set(options["vips_concurrency"])
+            engines.append((f"vips {pyvips.version(0)}.{pyvips.version(1)}", VipsImagePipeline))
+
+        for label, pipeline_class in engines:
+            elapsed, peak_mib, _ = run_isolated(_stages(pipeline_class), corpus)
+            self.stdout.write(f"{label:<12} {n / elapsed:6.2f} images/sec  peak RSS +{peak_mib:7.1f} MiB")
@@ -0,0 +1,68 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from django.core.management.base import BaseCommand
+
+from photos.inference import InferenceClient, InferenceServer, _preprocess
+from photos.management.commands._bench import add_corpus_arguments, load_corpus
+
+
+class Command(BaseCommand):
+    help = "Throughput and latency of the shared CLIP inference server at different max batch sizes"
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser, default_count=64)
+        parser.add_argument("--batch-sizes", default="1,8,32")
+        parser.add_argument("--clients", type=int, default=32, help="Concurrent client connections")
+        parser.add_argument("--max-wait-ms", type=float, default=10)
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options["images_dir"], options["count"], options["width"], options["height"])
+        # preprocessing happens on the workers, so it is done up front and left out of the timings
+        tensors = []
+        for _, image_bytes in corpus:
+            with Image.open(image_bytes) as img:
+                tensors.append(_preprocess()(img.convert("RGB")).half().numpy())
+
+        n = len(tensors)
+        self.stdout.write(f"{n} images, {options['clients']} concurrent clients")
+        for max_batch in [int(size) for size in options["batch_sizes"].split(",") if size]:
+            self._run(tensors, max_batch, options["clients"], options["max_wait_ms"])
+
+    def _run(self, tensors, max_batch, clients, max_wait_ms):
+        socket_path = os.path.join(tempfile.mkdtemp(), "clip.sock")
+        server = InferenceServer(socket_path, max_batch, max_wait_ms)
+        server.start()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = InferenceClient(socket_path)
+
+        def request(tensor):
+            start = time.perf_counter()
+            client.analyze_tensor(tensor)
+            return time.perf_counter() - start
+
+        try:
+            # one untimed pass so lazy setup is not attributed to the first batch size
+            request(tensors[0])
+            server.batches = server.batched_requests = 0
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                latencies = sorted(pool.map(request, tensors))
+            elapsed = time.perf_counter() - start
+        finally:
+            server.shutdown()
+            os.rmdir(os.path.dirname(socket_path))
+
+        p50 = statistics.median(latencies) * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        mean_batch = server.batched_requests / max(server.batches, 1)
+        self.stdout.write(
+            f"max batch {max_batch:>3}: {len(tensors) / elapsed:7.2f} images/sec, "
+            f"p50 {p50:7.1f}ms, p95 {p95:7.1f}ms, mean batch {mean_batch:.1f}"
+        )
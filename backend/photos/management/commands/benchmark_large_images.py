@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.imaging import ImagePipeline
+from photos.management.commands._bench import make_sample_image, run_isolated
+
+# format, extension, save options
+FORMATS = {
+    "jpeg": ("JPEG", "jpg", {"quality": 90}),
+    "tiff": ("TIFF", "tif", {}),
+    "png": ("PNG", "png", {"compress_level": 1}),
+}
+
+
+# what the pipeline does below PHOTO_LARGE_IMAGE_PIXELS: decode everything, then resize
+def _full_decode(path):
+    with Image.open(path) as img:
+        rgb = img.convert("RGB")
+        rgb.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
+
+
+def _pipeline(path):
+    with ImagePipeline(path) as pipeline:
+        pipeline.working_copy()
+
+
+class Command(BaseCommand):
+    help = "Peak RSS and time of decoding very large originals, fully and through the pipeline (large-image mode)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", default="50,100", help="Comma-separated image sizes to test")
+        parser.add_argument("--formats", default="jpeg,tiff,png", help=f"Comma-separated, of {', '.join(FORMATS)}")
+        parser.add_argument("--check", action="store_true",
+                            help="Fail if the pipeline grows peak RSS past PHOTO_IMAGE_MEMORY_LIMIT on a large image")
+
+    def handle(self, *args, **options):
+        formats = [name for name in options["formats"].split(",") if name]
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise CommandError(f"Unknown formats: {', '.join(sorted(unknown))}")
+
+        limit_mib = settings.PHOTO_IMAGE_MEMORY_LIMIT / 1024 / 1024
+        self.stdout.write(
+            f"Large-image mode from {settings.PHOTO_LARGE_IMAGE_PIXELS / 1e6:g}MP, memory limit {limit_mib:g} MiB, "
+            f"hard limit {settings.PHOTO_MAX_IMAGE_PIXELS / 1e6:g}MP"
+        )
+        over = []
+        with tempfile.TemporaryDirectory() as tmp:
+            for megapixels in [float(mp) for mp in options["megapixels"].split(",") if mp]:
+                # 3:2 like camera sensors; shapes drawn small and upscaled to keep generation fast
+                width = int((megapixels * 1e6 * 3 / 2) ** 0.5)
+                height = width * 2 // 3
+                paths = {}
+                with Image.open(make_sample_image(width // 8, height // 8, seed=int(megapixels))) as small:
+                    sample = small.resize((width, height))
+                for name in formats:
+                    img_format, extension, save_options = FORMATS[name]
+                    paths[name] = os.path.join(tmp, f"{megapixels:g}mp.{extension}")
+                    sample.save(paths[name], img_format, **save_options)
+                sample.close()
+                del sample
+
+                large = width * height > settings.PHOTO_LARGE_IMAGE_PIXELS
+                for name, path in paths.items():
+                    for label, fn in (("full decode", _full_decode), ("pipeline", _pipeline)):
+                        elapsed, peak_mib, refused = run_isolated(fn, [(name, path)])
+                        self.stdout.write(
+                            f"{f'{megapixels:g}MP {name}':<12} {label:<12} {elapsed:6.2f}s  "
+                            f"peak RSS +{peak_mib:7.1f} MiB{'  refused' if refused else ''}"
+                        )
+                        if fn is _pipeline and large and peak_mib > limit_mib:
+                            over.append(f"{megapixels:g}MP {name}")
+                    os.remove(path)
+
+        if options["check"] and over:
+            raise CommandError(f"Large-image mode went over the memory limit for: {', '.join(over)}")
@@ -0,0 +1,61 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from photos.storage import STORAGE_BACKENDS
+
+
+class Command(BaseCommand):
+    help = "Compare upload and download throughput of storage backends"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend", action="append", dest="backends",
+            help=f"Backend key ({', '.join(STORAGE_BACKENDS)}) or dotted path; repeatable",
+        )
+        parser.add_argument("--count", type=int, default=20)
+        parser.add_argument("--size-kb", type=int, default=2048)
+        parser.add_argument("--concurrency", type=int, default=settings.PHOTO_UPLOAD_CONCURRENCY)
+
+    def handle(self, *args, **options):
+        backends = options["backends"] or [settings.PHOTO_STORAGE_BACKEND]
+        count = options["count"]
+        payload = os.urandom(options["size_kb"] * 1024)
+        total_mb = count * len(payload) / (1024 * 1024)
+
+        for name in backends:
+            backend = import_string(STORAGE_BACKENDS.get(name, name))()
+            prefix = f"benchmark/{uuid.uuid4()}"
+            paths = [f"{prefix}/{i}.bin" for i in range(count)]
+
+            def upload(path):
+                backend.upload(path, BytesIO(payload), content_type="application/octet-stream")
+
+            def download(path):
+                with backend.open(path) as f:
+                    while f.read(1024 * 1024):
+                        pass
+
+            try:
+                with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                    start = time.perf_counter()
+                    list(pool.map(upload, paths))
+                    upload_s = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    list(pool.map(download, paths))
+                    download_s = time.perf_counter() - start
+            finally:
+                for path in paths:
+                    backend.delete(path)
+
+            self.stdout.write(
+                f"{name:<10} upload {count / upload_s:7.1f} obj/s {total_mb / upload_s:8.1f} MB/s   "
+                f"download {count / download_s:7.1f} obj/s {total_mb / download_s:8.1f} MB/s"
+            )
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from photos.imaging import ImagePipeline
+from photos.management.commands._bench import (
+    add_corpus_arguments,
+    load_corpus,
+    run_isolated,
+    generate_watermarked_image,
+    generate_thumbnail_image,
+    extract_exif_data
+)
+from photos.services import DOWNSCALE_REDUCING_GAPS
+
+
+def _separate_decodes(image_file):
+    generate_watermarked_image(image_file)
+    image_file.seek(0)
+    generate_thumbnail_image(image_file)
+    extract_exif_data(image_file)
+
+
+def _single_decode(downscale_mode):
+    def run(image_file):
+        with ImagePipeline(image_file, downscale_mode=downscale_mode) as pipeline:
+            pipeline.metadata()
+            pipeline.watermarked()
+            pipeline.thumbnail()
+    return run
+
+
+class Command(BaseCommand):
+    help = "Compare images/sec and peak memory for variant generation strategies"
+
+    def add_arguments(self, parser):
+        add_corpus_arguments(parser, default_count=10)
+
+    def handle(self, *args, **options):
+        corpus = load_corpus(options["images_dir"], options["count"], options["width"], options["height"])
+        n = len(corpus)
+        self.stdout.write(f"Benchmarking {n} images")
+
+        for label, fn in self.get_strategies():
+            elapsed, peak_mib, _ = run_isolated(fn, corpus)
+            self.stdout.write(f"{label:<24} {n / elapsed:6.2f} images/sec  peak RSS +{peak_mib:7.1f} MiB")
+
+    def get_strategies(self):
+        return [
+            ("separate decodes", _separate_decodes),
+            *[(f"single decode/{mode}", _single_decode(mode)) for mode in DOWNSCALE_REDUCING_GAPS],
+        ]
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.ann import build_similarity_index
+
+
+class Command(BaseCommand):
+    help = "Build the \"more like this\" IVF-PQ index over all stored photo embeddings"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", help="Index directory (default: PHOTO_ANN_INDEX_PATH)")
+
+    def handle(self, *args, **options):
+        try:
+            index = build_similarity_index(options["path"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Indexed {len(index)} photos in {index.nlist} lists")
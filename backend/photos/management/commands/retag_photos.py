@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from photos.retag import retag_photos
+
+
+class Command(BaseCommand):
+    help = "Recompute auto tags of every photo from its stored embedding and the current vocabulary"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Embeddings per matrix multiply (default: PHOTO_RETAG_BATCH_SIZE)")
+        parser.add_argument("--top-k", type=int, default=10)
+
+    def handle(self, *args, **options):
+        updated = retag_photos(batch_size=options["batch_size"], top_k=options["top_k"])
+        self.stdout.write(f"Updated the auto tags of {updated} photos")
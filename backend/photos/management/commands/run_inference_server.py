@@ -0,0 +1,35 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from photos.inference import InferenceServer
+
+
+class Command(BaseCommand):
+    help = "Run the shared CLIP inference server that tagging workers send images to"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.CLIP_INFERENCE_SOCKET, help="Unix socket path")
+        parser.add_argument("--max-batch", type=int, default=settings.CLIP_INFERENCE_MAX_BATCH)
+        parser.add_argument("--max-wait-ms", type=float, default=settings.CLIP_INFERENCE_MAX_WAIT_MS)
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("No socket path: pass --socket or set CLIP_INFERENCE_SOCKET")
+
+        server = InferenceServer(options["socket"], options["max_batch"], options["max_wait_ms"])
+        server.start()
+        self.stdout.write(f"Serving CLIP on {server.socket_path}")
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            self.stdout.write(f"Stopped after {server.batches} batches ({server.batched_requests} images)")
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0016_photo_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:32
+
+from django.db import migrations, models
+
+# the vocabulary as of this migration, so later changes to CLIP_TAGS do not change what it seeds
+TAGS = [
+    "single person", "two people", "group photo", "large group", "crowd", "audience", "people posing",
+    "candid photo", "selfie", "portrait", "side profile", "people walking", "people talking",
+    "people clapping", "speaker on stage", "person at podium", "panel discussion", "presentation slide",
+    "panel seating", "microphone on stage", "stage performance", "award presentation", "certificate handover",
+    "trophy presentation", "speech", "performance", "dance performance", "music performance", "live concert",
+    "question and answer session", "discussion", "celebration", "inauguration ceremony", "closing ceremony",
+    "indoor event", "outdoor event", "auditorium", "conference hall", "classroom", "open ground",
+    "stage lighting", "decorated stage", "banner backdrop", "projection screen", "daytime event",
+    "night event", "low light", "bright lighting", "spotlight on stage", "artificial lighting",
+    "natural lighting", "wide angle shot", "close up shot", "medium shot", "overhead shot", "side angle shot",
+    "front view", "back view", "formal event", "informal gathering", "serious mood", "celebratory mood",
+    "energetic atmosphere", "crowded atmosphere", "focused audience", "college event", "technical event",
+    "cultural event", "seminar", "workshop", "guest lecture", "orientation session", "convocation ceremony",
+    "people holding certificates", "people holding microphones", "people using laptops",
+    "people using mobile phones", "applause moment", "group applause",
+]
+
+
+def seed_vocabulary(apps, schema_editor):
+    AutoTag = apps.get_model("photos", "AutoTag")
+    AutoTag.objects.bulk_create([AutoTag(name=tag) for tag in TAGS], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0017_photo_embedding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AutoTag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('active', models.BooleanField(default=True)),
+                ('text_embedding', models.BinaryField(blank=True, null=True)),
+                ('embedding_model', models.CharField(blank=True, default='', max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='auto_tag_scores',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(seed_vocabulary, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:35
+
+from itertools import product
+
+from django.db import migrations, models
+
+
+def record_existing_stages(apps, schema_editor):
+    # completed photos count as processed with version 1 of each stage whose output they have
+    Photo = apps.get_model("photos", "Photo")
+    completed = Photo.objects.filter(status="CO")
+    for prepared, varied, tagged in product((True, False), repeat=3):
+        versions = {
+            stage: 1 for stage, done in (("prepare", prepared), ("variants", varied), ("tagging", tagged)) if done
+        }
+        qs = completed.filter(width__isnull=not prepared, embedding__isnull=not tagged)
+        qs = qs.filter(phash__isnull=False).exclude(thumbnail_url="") if varied \
+            else qs.filter(models.Q(phash__isnull=True) | models.Q(thumbnail_url=""))
+        qs.update(stage_versions=versions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0018_autotag_vocabulary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='stage_versions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(record_existing_stages, reverse_code=migrations.RunPython.noop),
+    ]
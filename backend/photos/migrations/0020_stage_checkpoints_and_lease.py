@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0019_photo_stage_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='processing_lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='processing_token',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='PhotoStageCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=20)),
+                ('version', models.IntegerField()),
+                ('result', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('photo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stage_checkpoints', to='photos.photo')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('photo', 'stage'), name='unique_stage_checkpoint')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0020_stage_checkpoints_and_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='processing_history',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='redrive_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='PhotoDeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('ST', 'Stuck in processing'), ('FA', 'Failed')])),
+                ('attempts', models.IntegerField(default=0)),
+                ('history', models.JSONField(default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('photo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='dead_letter', to='photos.photo')),
+            ],
+        ),
+    ]
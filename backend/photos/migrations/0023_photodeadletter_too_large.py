@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0022_photo_placeholder'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='photodeadletter',
+            name='reason',
+            field=models.CharField(choices=[('ST', 'Stuck in processing'), ('FA', 'Failed'), ('TL', 'Image too large')]),
+        ),
+    ]
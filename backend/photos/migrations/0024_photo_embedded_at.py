@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:55
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+# the best estimate for existing rows; an index built since then already holds them
+def backfill_embedded_at(apps, schema_editor):
+    Photo = apps.get_model("photos", "Photo")
+    Photo.objects.filter(embedding__isnull=False).update(embedded_at=F("updated_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0023_photodeadletter_too_large'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='embedded_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_embedded_at, migrations.RunPython.noop),
+    ]
@@ -29,10 +29,21 @@ class Photo(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     timestamp = models.DateTimeField(default=timezone.now)
     auto_tags = models.JSONField(default=list)
+    # {tag: CLIP similarity} for auto_tags, so tag search can rank by confidence
+    auto_tag_scores = models.JSONField(default=dict, blank=True)
     user_tags = models.JSONField(default=list)
     meta = models.JSONField(default=dict)
     status = models.CharField(choices=PhotoStatus, default=PhotoStatus.PENDING)
     processing_errors = models.JSONField(default=dict, blank=True)
+    # {stage: version} of the pipeline stages this photo went through, see photos.tasks.STAGE_VERSIONS
+    stage_versions = models.JSONField(default=dict, blank=True)
+    # lease held by the pipeline run processing this photo, so duplicate deliveries do not run concurrently
+    processing_token = models.UUIDField(null=True, blank=True)
+    processing_lease_until = models.DateTimeField(null=True, blank=True)
+    # times the reaper re-enqueued this photo since it last processed cleanly, and what each attempt left
+    # behind ([{"at", "status", "errors"}]); see photos.reaper
+    redrive_count = models.IntegerField(default=0)
+    processing_history = models.JSONField(default=list, blank=True)
     read_perm = models.CharField(choices=ReadPerm, default=ReadPerm.PUBLIC)
     share_perm = models.CharField(choices=SharePerm, default=SharePerm.OWNER_ROLES)
     downloads = models.BigIntegerField(default=0)
@@ -45,8 +56,20 @@ class Photo(models.Model):
     height = models.IntegerField(null=True, blank=True)
 
     original_path = models.TextField(default="")
+    # sha256 of the original's bytes; photos with the same hash share the original and processing results
+    content_hash = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    # 64-bit perceptual hash (dHash) used to group bursts of near-identical frames, see photos.similarity
+    phash = models.BigIntegerField(null=True, blank=True)
+    # normalized CLIP image embedding as float16 bytes, for semantic search (photos.semantic)
+    embedding = models.BinaryField(null=True, blank=True)
+    # when embedding was last written; the search indexes pick up new embeddings by it, not by updated_at
+    embedded_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # tiny blurred JPEG (data: URI) made at upload time, shown until thumbnail_url is ready
+    placeholder = models.TextField(blank=True, default="")
     thumbnail_url = models.TextField(default="")
     watermarked_url = models.TextField(default="")
+    # [{"size", "width", "height", "format", "bytes", "watermarked", "url"}], largest first
+    variants = models.JSONField(default=list, blank=True)
     tagged_users = models.ManyToManyField(
         CustomUser, through="PhotoTag", related_name="tagged_photos"
     )
@@ -54,6 +77,50 @@ class Photo(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
+# Text embeddings are cached on the row, cleared on rename and re-encoded when CLIP_MODEL_NAME changes
+class AutoTag(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    active = models.BooleanField(default=True)
+    # normalized float32 text embedding, and the CLIP model that produced it
+    text_embedding = models.BinaryField(null=True, blank=True)
+    embedding_model = models.CharField(max_length=50, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+# Output of a finished pipeline stage, so a retried or re-driven run can skip that stage
+class PhotoStageCheckpoint(models.Model):
+    photo = models.ForeignKey(Photo, on_delete=models.CASCADE, null=False, related_name="stage_checkpoints")
+    stage = models.CharField(max_length=20)
+    version = models.IntegerField()
+    result = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['photo', 'stage'], name="unique_stage_checkpoint")
+        ]
+
+
+# Photos the reaper gave up on or the pipeline quarantined, kept for inspection and manual reprocessing
+class PhotoDeadLetter(models.Model):
+    class Reason(models.TextChoices):
+        STUCK = "ST", "Stuck in processing"
+        FAILED = "FA", "Failed"
+        TOO_LARGE = "TL", "Image too large"
+
+    photo = models.OneToOneField(Photo, on_delete=models.CASCADE, null=False, related_name="dead_letter")
+    reason = models.CharField(choices=Reason)
+    attempts = models.IntegerField(default=0)
+    # processing_history of the photo plus its final attempt
+    history = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class PhotoTag(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False)
     photo = models.ForeignKey(Photo, on_delete=models.CASCADE, null=False)
@@ -1,3 +1,4 @@
+from django.db.models import Q
 from rest_framework import permissions
 from rest_framework.generics import get_object_or_404
 
@@ -12,6 +13,11 @@ class IsPhotographer(permissions.BasePermission):
         return getattr(obj, "photographer_id", None) == getattr(request.user, "id", None)
 
 
+class IsAdminRole(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return user_is_admin(request.user)
+
+
 def is_event_coordinator(user, event):
     return event.coordinator_id == getattr(user, 'id', None)
 
@@ -34,6 +40,19 @@ def can_read_photo(user, obj):
     return False
 
 
+# queryset counterpart of can_read_photo
+def readable_photos(user, queryset):
+    if user_is_admin(user):
+        return queryset
+    if not user or not user.is_authenticated:
+        return queryset.none()
+
+    q = Q(photographer=user) | Q(event__coordinator_id=user.id) | Q(read_perm=ReadPerm.PUBLIC)
+    if user_is_img(user):
+        q |= Q(read_perm=ReadPerm.IMG)
+    return queryset.filter(q).distinct()
+
+
 def can_share_photo(user: CustomUser, photo: Photo):
     perm = getattr(photo, "share_perm", None)
     if perm == SharePerm.DISABLED:
@@ -0,0 +1,31 @@
+import logging
+
+from celery import current_app
+from django.conf import settings
+from kombu.exceptions import ChannelError
+
+logger = logging.getLogger(__name__)
+
+
+def photo_queues():
+    return [settings.PHOTO_QUEUE_IO, settings.PHOTO_QUEUE_CPU, settings.PHOTO_QUEUE_ML]
+
+
+# messages waiting in each broker queue; None for all of them if the broker is unreachable
+def queue_depths(queues=None):
+    queues = queues or photo_queues()
+    try:
+        with current_app.connection_for_read() as connection:
+            connection.ensure_connection(max_retries=1)
+            channel = connection.default_channel
+            depths = {}
+            for queue in queues:
+                try:
+                    depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+                except ChannelError:
+                    # not declared yet: nothing was ever sent to it
+                    depths[queue] = 0
+            return depths
+    except Exception as e:
+        logger.warning(f"Could not read broker queue depths - {str(e)}")
+        return {queue: None for queue in queues}
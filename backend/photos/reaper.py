@@ -0,0 +1,138 @@
+# Re-driving photos stuck in PROCESSING without a live lease (a dropped message or a dead worker) and
+# FAILED ones. After PHOTO_MAX_REDRIVES attempts a photo goes to the dead-letter store instead
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from photos.models import Photo, PhotoDeadLetter
+
+logger = logging.getLogger(__name__)
+
+
+def stuck_photos(now=None):
+    now = now or timezone.now()
+    return Photo.objects.filter(
+        Q(processing_lease_until__isnull=True) | Q(processing_lease_until__lt=now),
+        status=Photo.PhotoStatus.PROCESSING,
+        updated_at__lt=now - timedelta(seconds=settings.PHOTO_STUCK_AFTER_SECONDS),
+    )
+
+
+def redrivable_failed_photos(now=None):
+    now = now or timezone.now()
+    return Photo.objects.filter(
+        status=Photo.PhotoStatus.FAILED,
+        dead_letter__isnull=True,
+        updated_at__lt=now - timedelta(seconds=settings.PHOTO_REDRIVE_DELAY_SECONDS),
+    )
+
+
+def _attempt(photo, now):
+    errors = photo.processing_errors
+    if photo.status == Photo.PhotoStatus.PROCESSING:
+        errors = {**errors, "reaper": f"stuck in processing since {photo.updated_at.isoformat()}"}
+    return {"at": now.isoformat(), "status": photo.status, "errors": errors}
+
+
+# oldest first, spread out at rate photos/sec
+def reap_photos(batch_size=None, rate=None):
+    from photos.tasks import process_photo_task
+
+    batch_size = batch_size or settings.PHOTO_REAPER_BATCH_SIZE
+    rate = rate or settings.PHOTO_REAPER_RATE
+    now = timezone.now()
+
+    photos = list(stuck_photos(now).order_by("updated_at")[:batch_size])
+    photos += list(redrivable_failed_photos(now).order_by("updated_at")[:batch_size - len(photos)])
+
+    redriven = dead_lettered = 0
+    for photo in photos:
+        if photo.redrive_count >= settings.PHOTO_MAX_REDRIVES:
+            dead_lettered += _dead_letter(photo, now)
+            continue
+
+        # claim the photo only if nothing touched it since it was read, so overlapping sweeps and a
+        # late-finishing pipeline run do not double it up
+        claimed = Photo.objects.filter(id=photo.id, status=photo.status, updated_at=photo.updated_at).update(
+            status=Photo.PhotoStatus.PROCESSING,
+            redrive_count=F("redrive_count") + 1,
+            processing_history=[*photo.processing_history, _attempt(photo, now)],
+            processing_token=None,
+            processing_lease_until=None,
+            updated_at=now,
+        )
+        if not claimed:
+            continue
+        process_photo_task.apply_async((str(photo.id),), {"priority": settings.PHOTO_BACKGROUND_PRIORITY},
+                                       countdown=redriven / rate, priority=settings.PHOTO_BACKGROUND_PRIORITY)
+        logger.info(f"Photo {photo.id}: Re-enqueued ({photo.get_status_display().lower()}), attempt {photo.redrive_count + 1}")
+        redriven += 1
+
+    if redriven or dead_lettered:
+        logger.info("Reaper: %d photos re-enqueued, %d dead-lettered", redriven, dead_lettered)
+    return {"redriven": redriven, "dead_lettered": dead_lettered}
+
+
+def _dead_letter(photo, now):
+    reason = PhotoDeadLetter.Reason.STUCK if photo.status == Photo.PhotoStatus.PROCESSING \
+        else PhotoDeadLetter.Reason.FAILED
+    attempt = _attempt(photo, now)
+    with transaction.atomic():
+        claimed = Photo.objects.filter(id=photo.id, status=photo.status, updated_at=photo.updated_at).update(
+            status=Photo.PhotoStatus.FAILED,
+            processing_errors=attempt["errors"],
+            processing_token=None,
+            processing_lease_until=None,
+            updated_at=now,
+        )
+        if not claimed:
+            return 0
+        PhotoDeadLetter.objects.update_or_create(photo=photo, defaults={
+            "reason": reason,
+            "attempts": photo.redrive_count,
+            "history": [*photo.processing_history, attempt],
+        })
+    logger.warning(f"Photo {photo.id}: Dead-lettered after {photo.redrive_count} re-drives")
+    return 1
+
+
+# Dead-letter a photo the pipeline just failed without waiting for re-drives, for failures they cannot fix
+def quarantine_photo(photo, reason):
+    now = timezone.now()
+    PhotoDeadLetter.objects.update_or_create(photo=photo, defaults={
+        "reason": reason,
+        "attempts": photo.redrive_count,
+        "history": [*photo.processing_history, _attempt(photo, now)],
+    })
+    logger.warning(f"Photo {photo.id}: Quarantined ({PhotoDeadLetter.Reason(reason).label.lower()})")
+
+
+def reprocess_dead_letter(dead_letter):
+    from photos.tasks import process_photo_task
+
+    with transaction.atomic():
+        Photo.objects.filter(id=dead_letter.photo_id).update(
+            status=Photo.PhotoStatus.PROCESSING, redrive_count=0, updated_at=timezone.now(),
+        )
+        dead_letter.delete()
+    transaction.on_commit(lambda: process_photo_task.apply_async(
+        (str(dead_letter.photo_id),), {"priority": settings.PHOTO_BACKGROUND_PRIORITY},
+        priority=settings.PHOTO_BACKGROUND_PRIORITY,
+    ))
+
+
+def pipeline_counts():
+    return {
+        "pending": Photo.objects.filter(status=Photo.PhotoStatus.PENDING).count(),
+        "processing": Photo.objects.filter(status=Photo.PhotoStatus.PROCESSING).count(),
+        "stuck": stuck_photos().count(),
+        "failed": Photo.objects.filter(status=Photo.PhotoStatus.FAILED).count(),
+        "completed_with_errors": Photo.objects.filter(status=Photo.PhotoStatus.COMPLETED)
+        .exclude(processing_errors={}).count(),
+        "dead_lettered": PhotoDeadLetter.objects.count(),
+    }
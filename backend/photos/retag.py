@@ -0,0 +1,116 @@
+# Re-ranking auto tags from stored CLIP embeddings after the vocabulary changes: one matrix multiply
+# per batch of photos and one bulk UPDATE, without downloading or decoding any original
+
+import hashlib
+import logging
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from photos.models import Photo
+from photos.services import get_tag_text_features, get_tag_vocabulary
+
+logger = logging.getLogger(__name__)
+
+# stored embeddings are float16, so recomputed scores drift by about 1e-3 from those taken at ingest
+SCORE_TOLERANCE = 2e-3
+
+
+def vocabulary_signature(vocabulary):
+    return hashlib.sha256("\n".join(vocabulary).encode()).hexdigest()
+
+
+def top_tags(embeddings, text_features, tags, top_k=10):
+    scores = embeddings @ text_features.T
+    k = min(top_k, len(tags))
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    return [
+        [(tags[i], round(score, 4)) for i, score in zip(row, row_scores)]
+        for row, row_scores in zip(top.tolist(), top_scores.tolist())
+    ]
+
+
+def _changed(photo_tags, photo_scores, ranked):
+    if photo_tags != [tag for tag, _ in ranked]:
+        return True
+    return any(abs(photo_scores.get(tag, -1.0) - score) > SCORE_TOLERANCE for tag, score in ranked)
+
+
+# with a signature, a job queued for an older vocabulary does nothing (a later job has the newer one)
+def retag_photos(signature=None, batch_size=None, top_k=10):
+    vocabulary = get_tag_vocabulary()
+    if signature is not None and signature != vocabulary_signature(vocabulary):
+        logger.info("Retag: vocabulary changed since this job was queued, skipping")
+        return 0
+
+    batch_size = batch_size or settings.PHOTO_RETAG_BATCH_SIZE
+    text_features = get_tag_text_features(vocabulary).float().cpu().numpy()
+    started = time.perf_counter()
+
+    rows = Photo.objects.filter(embedding__isnull=False).order_by().values_list(
+        "id", "embedding", "auto_tags", "auto_tag_scores"
+    )
+    scanned = updated = 0
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            updated += _retag_batch(batch, text_features, vocabulary, top_k)
+            scanned += len(batch)
+            batch = []
+    if batch:
+        updated += _retag_batch(batch, text_features, vocabulary, top_k)
+        scanned += len(batch)
+
+    logger.info(
+        "Retag: %d tags, %d photos scanned, %d updated in %.1fs",
+        len(vocabulary), scanned, updated, time.perf_counter() - started,
+    )
+    return updated
+
+
+def _retag_batch(rows, text_features, vocabulary, top_k):
+    embeddings = [np.frombuffer(bytes(embedding), dtype=np.float16) for _, embedding, _, _ in rows]
+    usable = [i for i, embedding in enumerate(embeddings) if len(embedding) == text_features.shape[1]]
+    if len(usable) < len(rows):
+        logger.warning(
+            "Retag: %d embeddings do not match the %d-dimensional text embeddings, skipped",
+            len(rows) - len(usable), text_features.shape[1],
+        )
+    if not usable:
+        return 0
+
+    matrix = np.stack([embeddings[i] for i in usable]).astype(np.float32)
+    ranked_rows = top_tags(matrix, text_features, vocabulary, top_k)
+
+    photos = []
+    for i, ranked in zip(usable, ranked_rows):
+        photo_id, _, auto_tags, auto_tag_scores = rows[i]
+        if _changed(auto_tags, auto_tag_scores or {}, ranked):
+            photos.append(Photo(
+                id=photo_id,
+                auto_tags=[tag for tag, _ in ranked],
+                auto_tag_scores=dict(ranked),
+            ))
+
+    with transaction.atomic():
+        Photo.objects.bulk_update(photos, ["auto_tags", "auto_tag_scores"], batch_size=settings.PHOTO_RETAG_UPDATE_BATCH_SIZE)
+    return len(photos)
+
+
+# queue a retag for the vocabulary as it will be once the current transaction commits
+def schedule_retag():
+    from photos.tasks import retag_photos_task
+
+    def enqueue():
+        signature = vocabulary_signature(get_tag_vocabulary())
+        retag_photos_task.apply_async((signature,), countdown=settings.PHOTO_RETAG_DELAY_SECONDS,
+                                      priority=settings.PHOTO_BACKGROUND_PRIORITY)
+
+    transaction.on_commit(enqueue)
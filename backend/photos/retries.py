@@ -0,0 +1,54 @@
+# Retry policies for the pipeline stages by error class: transient errors (storage or network blips, rate
+# limiting, a dropped database connection) are retried with full-jitter exponential backoff, so photos
+# that failed together do not retry together. Anything else is not retried
+
+import random
+from typing import NamedTuple
+
+import requests
+from django.db import InterfaceError, OperationalError
+from firebase_admin import exceptions as firebase_exceptions
+from google.api_core import exceptions as google_exceptions
+
+
+class RetryPolicy(NamedTuple):
+    name: str
+    max_retries: int
+    base: float
+    cap: float
+
+    def countdown(self, retries):
+        return random.uniform(0, min(self.cap, self.base * 2 ** retries))
+
+
+# first match wins, so permanent errors are listed before the broader transient classes
+RETRY_POLICIES = [
+    (
+        (
+            FileNotFoundError, google_exceptions.NotFound, firebase_exceptions.NotFoundError,
+            firebase_exceptions.PermissionDeniedError, firebase_exceptions.InvalidArgumentError,
+        ),
+        None,
+    ),
+    ((google_exceptions.TooManyRequests,), RetryPolicy("rate_limited", 8, 10, 600)),
+    ((OperationalError, InterfaceError), RetryPolicy("database", 5, 2, 60)),
+    (
+        (
+            ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout,
+            google_exceptions.ServerError, firebase_exceptions.FirebaseError,
+        ),
+        RetryPolicy("storage", 6, 5, 300),
+    ),
+]
+
+
+# the policy for an error, looking through wrapping exceptions (raise ... from e); None if not retryable
+def retry_policy(error):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        for classes, policy in RETRY_POLICIES:
+            if isinstance(error, classes):
+                return policy
+        error = error.__cause__ or error.__context__
+    return None
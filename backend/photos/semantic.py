@@ -0,0 +1,214 @@
+# Semantic search: each process keeps the normalized embeddings in one float32 matrix, loaded on first
+# use and then kept current by embedded_at every PHOTO_SEMANTIC_SYNC_SECONDS. Deleted photos are evicted
+# by the process deleting them and by every process's prune every PHOTO_SEMANTIC_PRUNE_SECONDS
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from photos.models import Photo
+from photos.services import encode_text_query
+
+logger = logging.getLogger(__name__)
+
+# rows committed slightly out of embedded_at order are still picked up by the next sync
+SYNC_OVERLAP = timedelta(minutes=1)
+
+
+class EmbeddingIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._ids = []
+        self._rows = {}  # photo id -> row
+        self._free = []  # rows of evicted photos, reused by the next additions
+        self._matrix = None
+        self._size = 0
+        self._watermark = None
+        self._checked_at = None
+        self._pruned_at = None
+
+    def __len__(self):
+        return self._size - len(self._free)
+
+    @property
+    def loaded(self):
+        return self._checked_at is not None
+
+    # insert or replace the embedding of a photo (float16 bytes or array)
+    def add(self, photo_id, embedding):
+        if not isinstance(embedding, np.ndarray):
+            embedding = np.frombuffer(bytes(embedding), dtype=np.float16)
+        with self._lock:
+            self._add(photo_id, embedding.astype(np.float32))
+
+    def _add(self, photo_id, vector):
+        if self._matrix is None:
+            self._matrix = np.empty((1024, len(vector)), dtype=np.float32)
+        elif len(vector) != self._matrix.shape[1]:
+            logger.warning(f"Photo {photo_id}: Embedding has {len(vector)} dimensions, index has {self._matrix.shape[1]}")
+            return
+
+        row = self._rows.get(photo_id)
+        if row is None and self._free:
+            row = self._free.pop()
+            self._rows[photo_id] = row
+            self._ids[row] = photo_id
+        elif row is None:
+            if self._size == len(self._matrix):
+                # grow by doubling; searches holding the old matrix keep a consistent view
+                grown = np.empty((2 * len(self._matrix), self._matrix.shape[1]), dtype=np.float32)
+                grown[:self._size] = self._matrix[:self._size]
+                self._matrix = grown
+            row = self._size
+            self._rows[photo_id] = row
+            self._ids.append(photo_id)
+            self._size += 1
+        self._matrix[row] = vector
+
+    # the row is left in place, searches skip it until an addition reuses it
+    def remove(self, photo_ids):
+        with self._lock:
+            for photo_id in photo_ids:
+                row = self._rows.pop(photo_id, None)
+                if row is not None:
+                    self._ids[row] = None
+                    self._free.append(row)
+
+    # load every embedding on first use, afterwards only those saved since the last sync
+    def sync(self, force=False):
+        with self._sync_lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None \
+                    and now - self._checked_at < settings.PHOTO_SEMANTIC_SYNC_SECONDS:
+                return
+
+            rows = Photo.objects.filter(embedding__isnull=False)
+            if self._watermark is not None:
+                rows = rows.filter(embedded_at__gte=self._watermark - SYNC_OVERLAP)
+            sync_started = timezone.now()
+
+            added = 0
+            for photo_id, embedding in rows.values_list("id", "embedding").iterator(chunk_size=2000):
+                self.add(photo_id, embedding)
+                added += 1
+            self._watermark = sync_started
+            self._checked_at = now
+
+            removed = 0
+            if self._pruned_at is None or now - self._pruned_at >= settings.PHOTO_SEMANTIC_PRUNE_SECONDS:
+                removed = self._prune()
+                self._pruned_at = now
+        if added or removed:
+            logger.info("Semantic index: synced %d embeddings, evicted %d (%d total)", added, removed, len(self))
+
+    # evict photos deleted (or whose embedding was cleared) in other processes; only reads the ids when
+    # the count shows some are gone
+    def _prune(self):
+        if Photo.objects.filter(embedding__isnull=False).count() >= len(self):
+            return 0
+        stored = Photo.objects.filter(embedding__isnull=False).values_list("id", flat=True)
+        stored = set(stored.iterator(chunk_size=20000))
+        with self._lock:
+            gone = [photo_id for photo_id in self._rows if photo_id not in stored]
+        self.remove(gone)
+        return len(gone)
+
+    # ids and scores of the k rows most similar to a normalized query vector, best first
+    def search(self, vector, k):
+        with self._lock:
+            matrix, size, ids, free = self._matrix, self._size, self._ids, list(self._free)
+        k = min(k, size - len(free))
+        if k <= 0:
+            return [], []
+
+        scores = matrix[:size] @ np.asarray(vector, dtype=np.float32)
+        scores[free] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        # a row evicted since the snapshot above has no id any more
+        top = [i for i in top if ids[i] is not None]
+        return [ids[i] for i in top], scores[top].tolist()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_embedding_index() -> EmbeddingIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = EmbeddingIndex()
+    _index.sync()
+    return _index
+
+
+# add a freshly processed photo to this process's index, if it has one loaded
+def update_embedding_index(photo_id, embedding):
+    if _index is not None and _index.loaded:
+        _index.add(photo_id, embedding)
+
+
+def remove_from_embedding_index(photo_ids):
+    if _index is not None and _index.loaded:
+        _index.remove(photo_ids)
+
+
+# largest candidate set worth checking against a queryset before scoring the queryset itself
+def max_candidates(k, total):
+    return max(k * 4, int(total * settings.PHOTO_SEMANTIC_MAX_CANDIDATE_FRACTION))
+
+
+# exact search over the stored embeddings of queryset: [(photo id, score)], best first
+def search_queryset(vector, queryset, k, chunk_size=2000):
+    rows = queryset.filter(embedding__isnull=False).order_by().values_list("id", "embedding")
+    best_ids, best_scores = [], np.empty(0, dtype=np.float32)
+    ids, vectors = [], []
+    for photo_id, embedding in rows.iterator(chunk_size=chunk_size):
+        embedding = np.frombuffer(bytes(embedding), dtype=np.float16)
+        if len(embedding) == len(vector):
+            ids.append(photo_id)
+            vectors.append(embedding)
+        if len(ids) == chunk_size:
+            best_ids, best_scores = _top(best_ids, best_scores, ids, vectors, vector, k)
+            ids, vectors = [], []
+    if ids:
+        best_ids, best_scores = _top(best_ids, best_scores, ids, vectors, vector, k)
+    return list(zip(best_ids, best_scores.tolist()))
+
+
+def _top(best_ids, best_scores, ids, vectors, vector, k):
+    # the running top k merged with a chunk, so memory stays at one chunk however large the queryset
+    ids = best_ids + ids
+    scores = np.concatenate([best_scores, np.stack(vectors).astype(np.float32) @ vector])
+    top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [ids[i] for i in top], scores[top]
+
+
+# queryset is already filtered to what the user may read. Candidates from the whole index are checked
+# against it, widening up to PHOTO_SEMANTIC_MAX_CANDIDATE_FRACTION of the index; past that the readable
+# photos are few and are scored directly
+def semantic_search(text, queryset, k=20):
+    vector = np.asarray(encode_text_query(text), dtype=np.float32)
+    index = get_embedding_index()
+    limit = max_candidates(k, len(index))
+
+    candidates = k * 4
+    while True:
+        ids, scores = index.search(vector, candidates)
+        visible = set(queryset.filter(id__in=ids).values_list("id", flat=True))
+        results = [(photo_id, score) for photo_id, score in zip(ids, scores) if photo_id in visible][:k]
+        if len(results) >= k or candidates >= len(index):
+            return results
+        if candidates >= limit:
+            return search_queryset(vector, queryset, k)
+        candidates = min(candidates * 4, limit)
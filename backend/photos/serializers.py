@@ -1,19 +1,29 @@
+import re
+
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.serializers import MiniUserSerializer
-from photos.models import Photo, PhotoShare, ReadPerm
+from events.models import Event
+from photos.imaging import image_preview
+from photos.large_images import ImageTooLarge, check_pixels
+from photos.models import Photo, PhotoShare, PhotoTag, ReadPerm
 from photos.permissions import is_admin_or_photographer, is_event_coordinator, can_share_photo
-from photos.services import generate_signed_url, create_photo_tags, upload_to_storage
+from photos.services import generate_signed_url, create_photo_tags, storage_path, create_upload_target, \
+    resolve_tag_users, notify_tagged_users, upload_original, submit_original_upload, find_processed_duplicate, \
+    find_processed_duplicates, reuse_processed_photo, REUSED_FIELDS
+
+HEX_SHA256 = re.compile(r"[0-9a-f]{64}")
 
 
 class PhotoMiniSerializer(serializers.ModelSerializer):
     class Meta:
         model = Photo
         fields = [
-            'id', 'thumbnail_url', 'width', 'height'
+            'id', 'thumbnail_url', 'placeholder', 'width', 'height'
         ]
         read_only_fields = fields
 
@@ -36,6 +46,13 @@ class PhotoBulkUploadSerializer(serializers.Serializer):
         if len(metadata) != len(images):
             raise ValidationError("Metadata length must match images length")
 
+        # refused before any of the batch is read or uploaded; only the opened header is looked at
+        for image in images:
+            try:
+                check_pixels(*image.image.size)
+            except ImageTooLarge as e:
+                raise ValidationError({"images": [f"{image.name}: {e}"]})
+
         meta_map = {}
         for meta in metadata:
             if not isinstance(meta, dict) or "client_id" not in meta:
@@ -45,23 +62,27 @@ class PhotoBulkUploadSerializer(serializers.Serializer):
         attrs['meta_map'] = meta_map
         return attrs
 
+    # items are validated first, the valid ones uploaded concurrently and inserted with one bulk_create;
+    # content that was already processed is reused and marked deduplicated
     def create(self, validated_data):
         req = self.context.get("request")
         event = self.context.get("event")
+        photographer = getattr(req, 'user', None)
 
         images = validated_data.get('images', [])
         meta_map = validated_data.get('meta_map')
-        res = []
+        res = [None] * len(images)
+        items = []
 
-        for image in images:
+        for index, image in enumerate(images):
             client_id = image.name
             meta = meta_map.get(client_id)
             if not meta:
-                res.append({
+                res[index] = {
                     "client_id": client_id,
                     "status": "error",
                     "error": "Missing metadata"
-                })
+                }
                 continue
 
             serializer = PhotoWriteSerializer(
@@ -73,32 +94,83 @@ class PhotoBulkUploadSerializer(serializers.Serializer):
                 context={"request": req},
             )
             if not serializer.is_valid():
-                res.append({
+                res[index] = {
                     "client_id": client_id,
                     "status": "error",
                     "error": serializer.errors
-                })
+                }
+                continue
+            items.append((index, client_id, dict(serializer.validated_data)))
+
+        users_by_name = resolve_tag_users(
+            {username for _, _, data in items for username in data.get('tagged_usernames', [])}
+        )
+
+        uploads = []
+        for index, client_id, data in items:
+            image = data.pop('image')
+            usernames = data.pop('tagged_usernames', [])
+            missing = set(usernames) - set(users_by_name)
+            if missing:
+                res[index] = {
+                    "client_id": client_id,
+                    "status": "error",
+                    "error": {"tagged_usernames": [f"Unknown usernames: {', '.join(sorted(missing))}"]}
+                }
                 continue
 
+            # before the upload pool starts reading the file
+            width, height, placeholder = image_preview(image)
+            data.update(width=width, height=height, placeholder=placeholder)
+            photo = Photo(photographer=photographer, **data)
+            tagged = [users_by_name[username] for username in dict.fromkeys(usernames)]
+            uploads.append((index, client_id, photo, tagged, submit_original_upload(image)))
+
+        created = []
+        for index, client_id, photo, tagged, upload in uploads:
             try:
-                photo = serializer.save()
-                res.append({
-                    "client_id": client_id,
-                    "photo_id": photo.id,
-                    "status": "created"
-                })
-            except ValidationError as e:
-                res.append({
+                photo.original_path, photo.content_hash = upload.result()
+            except Exception:
+                res[index] = {
                     "client_id": client_id,
                     "status": "error",
-                    "error": e.detail
-                })
-            except Exception as e:
-                res.append({
+                    "error": ["Image upload failed"]
+                }
+                continue
+            created.append((index, client_id, photo, tagged))
+
+        duplicates = find_processed_duplicates(photo.content_hash for _, _, photo, _ in created)
+        for _, _, photo, _ in created:
+            source = duplicates.get(photo.content_hash)
+            if source:
+                reuse_processed_photo(photo, source)
+            else:
+                # as for single uploads, so the reaper re-drives it if the message is lost
+                photo.status = Photo.PhotoStatus.PROCESSING
+
+        try:
+            with transaction.atomic():
+                Photo.objects.bulk_create([photo for _, _, photo, _ in created])
+                PhotoTag.objects.bulk_create(
+                    [PhotoTag(photo=photo, user=user) for _, _, photo, tagged in created for user in tagged]
+                )
+        except Exception as e:
+            for index, client_id, _, _ in created:
+                res[index] = {
                     "client_id": client_id,
                     "status": "error",
                     "error": str(e)
-                })
+                }
+            return res
+
+        for index, client_id, photo, tagged in created:
+            notify_tagged_users(photo, tagged, photographer)
+            res[index] = {
+                "client_id": client_id,
+                "photo_id": photo.id,
+                "status": "created",
+                "deduplicated": photo.status == Photo.PhotoStatus.COMPLETED,
+            }
 
         return res
 
@@ -117,8 +189,9 @@ class PhotoReadSerializer(serializers.ModelSerializer):
         model = Photo
         fields = [
             'id', 'timestamp', 'meta', 'photographer', 'event', 'tagged_users', 'downloads', 'views',
-            'read_perm', 'watermarked_url', 'thumbnail_url', 'likes_count', 'width',
-            'height', 'is_liked', 'can_edit', 'can_delete', 'can_share', 'auto_tags', 'user_tags'
+            'read_perm', 'watermarked_url', 'thumbnail_url', 'placeholder', 'variants', 'likes_count', 'width',
+            'height', 'is_liked', 'can_edit', 'can_delete', 'can_share', 'auto_tags', 'auto_tag_scores',
+            'user_tags'
         ]
         read_only_fields = fields
 
@@ -168,15 +241,20 @@ class PhotoListSerializer(serializers.ModelSerializer):
     can_delete = serializers.SerializerMethodField(read_only=True)
     can_edit = serializers.SerializerMethodField(read_only=True)
     can_share = serializers.SerializerMethodField(read_only=True)
+    burst_count = serializers.SerializerMethodField(read_only=True)
 
     class Meta:
         model = Photo
         fields = [
-            'id', 'timestamp', 'photographer', 'thumbnail_url', 'width', 'height', 'is_liked', 'can_edit', 'can_delete',
-            'can_share'
+            'id', 'timestamp', 'photographer', 'thumbnail_url', 'placeholder', 'variants', 'width', 'height',
+            'is_liked', 'can_edit', 'can_delete', 'can_share', 'burst_count'
         ]
         read_only_fields = fields
 
+    def get_burst_count(self, obj: Photo):
+        # only set when the list collapses bursts: number of frames this photo stands for
+        return self.context.get('burst_counts', {}).get(obj.id)
+
     def get_is_liked(self, obj: Photo):
         user = getattr(self.context.get('request'), 'user', None)
         if not user or not user.is_authenticated:
@@ -196,6 +274,17 @@ class PhotoListSerializer(serializers.ModelSerializer):
         return can_share_photo(user, obj)
 
 
+class PhotoSemanticResultSerializer(PhotoListSerializer):
+    score = serializers.SerializerMethodField(read_only=True)
+
+    class Meta(PhotoListSerializer.Meta):
+        fields = PhotoListSerializer.Meta.fields + ['score']
+        read_only_fields = fields
+
+    def get_score(self, obj: Photo):
+        return self.context.get('scores', {}).get(obj.id)
+
+
 class PhotoWriteSerializer(serializers.ModelSerializer):
     image = serializers.ImageField(write_only=True, required=True)
     tagged_usernames = serializers.ListField(
@@ -212,11 +301,22 @@ class PhotoWriteSerializer(serializers.ModelSerializer):
             'tagged_usernames', 'tagged_users', 'image', 'width', 'height', 'user_tags'
         ]
 
+    def validate_image(self, value):
+        # ImageField leaves the opened header on the file; the pixels have not been decoded yet
+        try:
+            check_pixels(*value.image.size)
+        except ImageTooLarge as e:
+            raise ValidationError(str(e))
+        return value
+
     def create(self, validated_data):
         tagged_usernames = validated_data.pop('tagged_usernames', [])
         request = self.context.get('request')
         photographer = getattr(request, 'user', None)
         image_file = validated_data.pop('image', None)
+        # grids can show the photo right away; the pipeline fills in the real variants later
+        width, height, placeholder = image_preview(image_file)
+        validated_data.update(width=width, height=height, placeholder=placeholder)
 
         with transaction.atomic():
             photo = Photo.objects.create(
@@ -226,15 +326,23 @@ class PhotoWriteSerializer(serializers.ModelSerializer):
             create_photo_tags(photo, usernames=tagged_usernames, actor=photographer)
 
         try:
-            original_path, _ = upload_to_storage(photo.id, image_file)
-            photo.original_path = original_path
-            photo.save(update_fields=['original_path'])
+            original_path, content_hash = upload_original(image_file)
         except Exception:
             photo.delete()
             raise serializers.ValidationError(
                 "Image upload failed"
             )
 
+        photo.original_path = original_path
+        photo.content_hash = content_hash
+        update_fields = ['original_path', 'content_hash']
+
+        source = find_processed_duplicate(content_hash)
+        if source:
+            reuse_processed_photo(photo, source)
+            update_fields += [*REUSED_FIELDS, 'status', 'processing_errors', 'updated_at']
+        photo.save(update_fields=update_fields)
+
         return photo
 
     def update(self, instance, validated_data):
@@ -250,6 +358,66 @@ class PhotoWriteSerializer(serializers.ModelSerializer):
         return instance
 
 
+# First phase of a direct upload. If content_hash matches a processed photo of the photographer, the
+# photo is completed from it and no upload target is returned
+class PhotoUploadInitiateSerializer(PhotoWriteSerializer):
+    CONTENT_TYPES = {
+        "image/jpeg": "jpg",
+        "image/png": "png",
+        "image/webp": "webp",
+        "image/heic": "heic",
+    }
+
+    image = None
+    content_type = serializers.ChoiceField(choices=list(CONTENT_TYPES), write_only=True)
+    upload = serializers.SerializerMethodField(read_only=True)
+
+    class Meta(PhotoWriteSerializer.Meta):
+        fields = [
+            'id', 'timestamp', 'meta', 'read_perm', 'share_perm', 'event', 'status',
+            'tagged_usernames', 'tagged_users', 'content_type', 'content_hash', 'user_tags', 'upload'
+        ]
+        read_only_fields = ['status']
+
+    def validate_content_hash(self, value):
+        value = value.lower()
+        if value and not HEX_SHA256.fullmatch(value):
+            raise ValidationError("content_hash must be a hex encoded sha256")
+        return value
+
+    def create(self, validated_data):
+        tagged_usernames = validated_data.pop('tagged_usernames', [])
+        content_type = validated_data.pop('content_type')
+        content_hash = validated_data.pop('content_hash', "")
+        request = self.context.get('request')
+        photographer = getattr(request, 'user', None)
+
+        # the client's hash is only trusted against photos it has uploaded itself
+        source = None
+        if content_hash:
+            source = find_processed_duplicate(content_hash, Photo.objects.filter(photographer=photographer))
+
+        with transaction.atomic():
+            photo = Photo.objects.create(
+                photographer=photographer,
+                status=Photo.PhotoStatus.PENDING,
+                **validated_data,
+            )
+            if source:
+                reuse_processed_photo(photo, source)
+                photo.original_path = source.original_path
+            else:
+                photo.original_path = storage_path(photo.id, "original", self.CONTENT_TYPES[content_type])
+            photo.save()
+            create_photo_tags(photo, usernames=tagged_usernames, actor=photographer)
+
+        self._upload = None if source else create_upload_target(photo.original_path, content_type)
+        return photo
+
+    def get_upload(self, obj: Photo):
+        return getattr(self, "_upload", None)
+
+
 class PhotoShareSerializer(serializers.ModelSerializer):
     share_url = serializers.SerializerMethodField(read_only=True)
 
@@ -280,6 +448,25 @@ class PhotoShareSerializer(serializers.ModelSerializer):
         return url
 
 
+class PhotoHashCheckSerializer(serializers.Serializer):
+    hashes = serializers.ListField(
+        child=serializers.CharField(),
+        min_length=1,
+        max_length=500,
+    )
+    event = serializers.PrimaryKeyRelatedField(
+        queryset=Event.objects.all(),
+        required=False,
+    )
+
+    def validate_hashes(self, value):
+        hashes = {h.lower() for h in value}
+        invalid = [h for h in hashes if not HEX_SHA256.fullmatch(h)]
+        if invalid:
+            raise ValidationError(f"Not hex encoded sha256 hashes: {', '.join(sorted(invalid))}")
+        return hashes
+
+
 class PhotoSearchSerializer(serializers.Serializer):
     event_name = serializers.CharField(
         required=False,
@@ -334,3 +521,11 @@ class PhotoSearchSerializer(serializers.Serializer):
             raise ValidationError("Start date must be before end date")
 
         return data
+
+
+class PhotoSemanticSearchSerializer(PhotoSearchSerializer):
+    q = serializers.CharField(max_length=300)
+    k = serializers.IntegerField(required=False, min_value=1, default=20)
+
+    def validate_k(self, value):
+        return min(value, settings.PHOTO_SEMANTIC_MAX_RESULTS)
@@ -1,25 +1,38 @@
+import hashlib
+import logging
+import mimetypes
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 from io import BytesIO
 
 import clip
+import numpy as np
 import torch
-from PIL import Image
+from PIL import Image, features
 from PIL.ExifTags import TAGS
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
-from django.db.models import Q, QuerySet
+from django.db.models import Case, FloatField, Q, QuerySet, Value, When
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast, Coalesce, Greatest
 from django.utils import timezone
 from dotenv import load_dotenv
-from firebase_admin import storage
 from firebase_admin.exceptions import FirebaseError
 from rest_framework.exceptions import APIException
 
 from accounts.models import CustomUser
 from notifications.models import Notification
 from notifications.services import create_notification
-from photos.models import Photo
+from photos.large_images import check_pixels, downscale_large_image, is_large
+from photos.models import AutoTag, Photo
 from photos.models import PhotoTag
+from photos.storage import get_storage_backend
+
+logger = logging.getLogger(__name__)
 
 
 class PhotoSearchService:
@@ -66,10 +79,14 @@ class PhotoSearchService:
                 return qs.distinct()
 
             tag_query = None
+            confidences = []
             for tag in cleaned_tags:
                 condition = Q(user_tags__contains=[tag]) | Q(auto_tags__contains=[tag])
                 tag_query = condition if tag_query is None else (tag_query | condition)
-            qs = qs.filter(tag_query)
+                confidences.append(self._tag_confidence(tag))
+            # best match first: user tags count as certain, auto tags by their CLIP score
+            confidence = Greatest(*confidences) if len(confidences) > 1 else confidences[0]
+            qs = qs.filter(tag_query).annotate(tag_confidence=confidence).order_by("-tag_confidence", "-timestamp")
 
         if read_perm:
             qs = qs.filter(read_perm=read_perm)
@@ -77,6 +94,15 @@ class PhotoSearchService:
         final_qs = qs.distinct()
         return final_qs
 
+    @staticmethod
+    def _tag_confidence(tag):
+        score = Cast(KeyTextTransform(tag, "auto_tag_scores"), FloatField())
+        return Case(
+            When(user_tags__contains=[tag], then=Value(1.0)),
+            default=Coalesce(score, Value(-1.0)),
+            output_field=FloatField(),
+        )
+
     def search_combined(self, filters: dict) -> QuerySet:
         return self.search(**filters)
 
@@ -84,6 +110,7 @@ class PhotoSearchService:
 load_dotenv()
 image_ttl = int(os.getenv("DEFAULT_IMAGE_TTL"))
 
+# initial auto-tag vocabulary; the live one is the AutoTag table, seeded from this list
 CLIP_TAGS = [
     # People & composition
     "single person", "two people", "group photo", "large group", "crowd",
@@ -131,34 +158,202 @@ CLIP_TAGS = [
 ]
 
 
-def generate_auto_tag_photo(image_bytes: BytesIO):
-    import logging
-    logger = logging.getLogger(__name__)
+_clip_lock = threading.Lock()
+_clip_model = None
+_clip_preprocess = None
+_clip_device = None
+_tag_features = None  # (vocabulary tuple, normalized text feature matrix)
+
 
+CLIP_INFERENCE_MODES = ("fp32", "int8", "torchscript", "int8-torchscript")
+
+_torch_threads_configured = False
+
+
+# apply CLIP_TORCH_THREADS / CLIP_TORCH_INTEROP_THREADS once per process (0 keeps torch's default)
+def configure_torch_threads():
+    global _torch_threads_configured
+    if _torch_threads_configured:
+        return
+    _torch_threads_configured = True
+
+    if settings.CLIP_TORCH_THREADS:
+        torch.set_num_threads(settings.CLIP_TORCH_THREADS)
+    if settings.CLIP_TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(settings.CLIP_TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            # only possible before the first parallel op in the process
+            logger.warning("Could not set torch inter-op threads - %s", e)
+
+
+# int8: dynamic quantization of the encoder's Linear layers; torchscript: a traced graph of it.
+# The text encoder stays fp32, tag embeddings are computed once per vocabulary
+def optimize_image_encoder(model, mode):
+    if mode not in CLIP_INFERENCE_MODES:
+        raise ValueError(f"Unknown CLIP inference mode {mode}, expected one of {', '.join(CLIP_INFERENCE_MODES)}")
+    parts = mode.split("-")
+    visual = model.visual
+
+    if "int8" in parts:
+        visual = torch.ao.quantization.quantize_dynamic(visual, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if "torchscript" in parts:
+        resolution = visual.input_resolution
+        example = torch.zeros(1, 3, resolution, resolution, dtype=model.dtype)
+        with torch.no_grad():
+            # traced rather than frozen: the module keeps conv1, which CLIP.dtype reads
+            traced = torch.jit.trace(visual.eval(), example)
+        traced.input_resolution = resolution
+        visual = traced
+
+    model.visual = visual
+    return model
+
+
+# build a CLIP model for the given inference mode (default CLIP_INFERENCE_MODE); not cached
+def load_clip_model(mode=None):
+    configure_torch_threads()
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device)
+    model, preprocess = clip.load(settings.CLIP_MODEL_NAME, device=device)
+    model.eval()
+
+    mode = mode or settings.CLIP_INFERENCE_MODE
+    if device == "cpu" and mode != "fp32":
+        model = optimize_image_encoder(model, mode)
+    return model, preprocess, device
+
+
+def get_clip_model():
+    global _clip_model, _clip_preprocess, _clip_device
+
+    if _clip_model is None:
+        with _clip_lock:
+            if _clip_model is None:
+                model, preprocess, device = load_clip_model()
+                _clip_device = device
+                _clip_preprocess = preprocess
+                _clip_model = model
+    return _clip_model, _clip_preprocess, _clip_device
+
+
+# active AutoTag names, or CLIP_TAGS before the vocabulary has been seeded
+def get_tag_vocabulary():
+    vocabulary = list(AutoTag.objects.filter(active=True).order_by("name").values_list("name", flat=True))
+    return vocabulary or list(CLIP_TAGS)
+
+
+# normalized text features for the tag vocabulary, rebuilt only when the vocabulary changes
+def get_tag_text_features(tags=None):
+    global _tag_features
+
+    vocabulary = tuple(tags if tags is not None else get_tag_vocabulary())
+    cached = _tag_features
+    if cached is not None and cached[0] == vocabulary:
+        return cached[1]
+
+    model, _, device = get_clip_model()
+    with _clip_lock:
+        cached = _tag_features
+        if cached is not None and cached[0] == vocabulary:
+            return cached[1]
+
+        text_features = torch.from_numpy(_tag_text_embeddings(model, device, vocabulary)).to(device)
+        _tag_features = (vocabulary, text_features)
+    return text_features
+
+
+# tags without a cached embedding for the current model are encoded in one pass and cached on their rows
+def _tag_text_embeddings(model, device, vocabulary):
+    stored = dict(
+        AutoTag.objects.filter(
+            name__in=vocabulary, embedding_model=settings.CLIP_MODEL_NAME, text_embedding__isnull=False,
+        ).values_list("name", "text_embedding")
+    )
+    embeddings = {name: np.frombuffer(bytes(value), dtype=np.float32) for name, value in stored.items()}
+
+    missing = [tag for tag in vocabulary if tag not in embeddings]
+    if missing:
+        tokens = clip.tokenize(missing, truncate=True).to(device)
+        with torch.no_grad():
+            features = model.encode_text(tokens).float()
+            features = features / features.norm(dim=-1, keepdim=True)
+        embeddings.update(zip(missing, features.cpu().numpy()))
+
+        rows = list(AutoTag.objects.filter(name__in=missing))
+        for row in rows:
+            row.text_embedding = embeddings[row.name].tobytes()
+            row.embedding_model = settings.CLIP_MODEL_NAME
+        AutoTag.objects.bulk_update(rows, ["text_embedding", "embedding_model"])
+        logger.info("Encoded %d tag text embeddings", len(missing))
+
+    return np.stack([embeddings[tag] for tag in vocabulary])
+
+
+def warm_clip_model():
+    get_clip_model()
+    get_tag_text_features()
 
-    image_bytes.seek(0)
-    with Image.open(image_bytes) as img:
-        image = img.convert("RGB")
-        image.load()
 
-    image_tensor = preprocess(image).unsqueeze(0).to(device)
-    tokens = clip.tokenize(CLIP_TAGS).to(device)
+# (tag ranking, normalized float16 embedding), from the inference server when one is configured
+def analyze_image(image: Image.Image, tags=None, top_k=10):
+    if settings.CLIP_INFERENCE_SOCKET:
+        from photos.inference import InferenceClient
+        try:
+            return InferenceClient().analyze(image, tags, top_k)
+        except OSError as e:
+            if not settings.CLIP_INFERENCE_FALLBACK_LOCAL:
+                raise
+            logger.warning("CLIP inference server unavailable, tagging in-process - %s", e)
+
+    _, preprocess, _ = get_clip_model()
+    image_features = encode_image_tensors(preprocess(image).unsqueeze(0))
+    ranked = rank_tags(image_features, tags, top_k)[0]
+    return ranked, image_features[0].cpu().numpy().astype(np.float16)
+
+
+# normalized CLIP embeddings for a batch of preprocessed inputs (N x 3 x H x W), one encode_image pass
+def encode_image_tensors(image_tensors):
+    model, _, device = get_clip_model()
+    with torch.no_grad():
+        image_features = model.encode_image(image_tensors.to(device)).float()
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+
+def rank_tags(image_features, tags=None, top_k=10):
+    tags = list(tags if tags is not None else get_tag_vocabulary())
+    text_features = get_tag_text_features(tags)
 
     with torch.no_grad():
-        image_features = model.encode_image(image_tensor)
-        text_features = model.encode_text(tokens)
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        similarity = image_features @ text_features.T
+        similarity = image_features @ text_features.float().T
+        scores, indices = similarity.topk(min(top_k, len(tags)), dim=-1)
 
-    scores = similarity[0].cpu().tolist()
-    ranked = sorted(((CLIP_TAGS[i], score) for i, score in enumerate(scores)), key=lambda x: x[1], reverse=True)
-    top_tags = [tag for tag, _ in ranked[:10]]
+    return [
+        [(tags[i], score) for i, score in zip(row_indices, row_scores)]
+        for row_indices, row_scores in zip(indices.cpu().tolist(), scores.cpu().tolist())
+    ]
 
-    logger.info("Generated %d auto tags (top scores)", len(top_tags))
-    return top_tags
+
+# normalized CLIP text embedding (float32 numpy vector) of a free-text query
+@lru_cache(maxsize=256)
+def encode_text_query(text):
+    if settings.CLIP_INFERENCE_SOCKET:
+        from photos.inference import InferenceClient
+        try:
+            return InferenceClient().encode_text(text).astype(np.float32)
+        except OSError as e:
+            if not settings.CLIP_INFERENCE_FALLBACK_LOCAL:
+                raise
+            logger.warning("CLIP inference server unavailable, encoding query in-process - %s", e)
+    return encode_text(text)
+
+
+def encode_text(text):
+    model, _, device = get_clip_model()
+    with torch.no_grad():
+        features = model.encode_text(clip.tokenize([text], truncate=True).to(device)).float()
+        features = features / features.norm(dim=-1, keepdim=True)
+    return features[0].cpu().numpy()
 
 
 def create_photo_tags(photo, usernames, actor):
@@ -186,7 +381,11 @@ def create_photo_tags(photo, usernames, actor):
     PhotoTag.objects.bulk_create(
         [PhotoTag(photo=photo, user=u) for u in new_users]
     )
-    for user in new_users:
+    notify_tagged_users(photo, new_users, actor)
+
+
+def notify_tagged_users(photo, users, actor):
+    for user in users:
         create_notification(
             recipient=user,
             actor=actor,
@@ -196,138 +395,319 @@ def create_photo_tags(photo, usernames, actor):
         )
 
 
-def pillow_to_content_file(image, filename="img.webp", format="WEBP"):
+# map username -> user for every name in one query; unknown names are simply absent
+def resolve_tag_users(usernames):
+    if not usernames:
+        return {}
+    return {u.username: u for u in CustomUser.objects.filter(username__in=set(usernames))}
+
+
+def pillow_to_content_file(image, filename="img.webp", format="WEBP", **save_kwargs):
     buffer = BytesIO()
-    image.save(buffer, format=format)
+    image.save(buffer, format=format, **save_kwargs)
     buffer.seek(0)
 
     file = ContentFile(buffer.read(), name=filename)
     return file
 
 
-def download_image_from_firebase(image_path):
-    try:
-        bucket = storage.bucket()
-    except FirebaseError as e:
-        raise APIException(f"Storage config error {e}")
+_upload_lock = threading.Lock()
+_upload_pid = None
+_upload_executor = None
+
+
+# bounded per-process pool for storage uploads, rebuilt after a fork
+def get_upload_executor():
+    global _upload_pid, _upload_executor
+
+    pid = os.getpid()
+    if _upload_pid != pid:
+        with _upload_lock:
+            if _upload_pid != pid:
+                _upload_executor = ThreadPoolExecutor(
+                    max_workers=settings.PHOTO_UPLOAD_CONCURRENCY,
+                    thread_name_prefix="storage-upload",
+                )
+                _upload_pid = pid
+    return _upload_executor
+
 
-    blob = bucket.blob(image_path)
+# remote backends stream into a temporary file in chunks, so memory does not grow with the original
+def download_original(image_path):
     try:
-        d = blob.download_as_bytes()
+        return get_storage_backend().open(image_path)
     except Exception as e:
-        raise APIException(f"Error downloading image {e}")
-    return BytesIO(d)
+        raise APIException(f"Error downloading image {e}") from e
 
 
 def generate_signed_url(path: str, ttl_seconds=image_ttl):
-    ttl_seconds = min(image_ttl, ttl_seconds)
-    bucket = storage.bucket()
-    blob = bucket.blob(path)
-    return blob.generate_signed_url(
-        expiration=timezone.now() + timedelta(seconds=ttl_seconds),
-        method="GET",
-    )
+    ttl_seconds = min(image_ttl, ttl_seconds or image_ttl)
+    return get_storage_backend().signed_url(path, ttl_seconds)
 
 
-def upload_to_storage(photo_id, file: ImageFile, variant="original"):
+# variants that are only reachable through signed URLs; everything else is uploaded public-read
+PRIVATE_VARIANTS = ("original", "working")
+
+
+def storage_path(photo_id, variant, extension):
+    return f"media/{photo_id}/{variant}.{extension}"
+
+
+# signed target the client uploads an original to directly, see StorageBackend.signed_upload_url
+def create_upload_target(path, content_type):
+    ttl_seconds = settings.PHOTO_UPLOAD_URL_TTL
     try:
-        bucket = storage.bucket()
-    except FirebaseError as e:
-        raise APIException(f"Storage config error {e}")
+        target = get_storage_backend().signed_upload_url(path, ttl_seconds, content_type)
+    except Exception as e:
+        raise APIException(f"Error creating upload url {e}")
+    target["expires_at"] = timezone.now() + timedelta(seconds=ttl_seconds)
+    return target
+
 
+def _file_extension(file):
     try:
-        extension = file.name.split(".")[-1].lower()
+        return file.name.split(".")[-1].lower()
     except Exception:
-        extension = "jpg"
+        return "jpg"
 
-    path = f"media/{photo_id}/{variant}.{extension}"
-    blob = bucket.blob(path)
+
+def upload_to_storage(photo_id, file: ImageFile, variant="original"):
+    path = storage_path(photo_id, variant, _file_extension(file))
+    is_public = variant not in PRIVATE_VARIANTS
 
     try:
-        file.seek(0)
-        blob.upload_from_file(file)
-        if variant in ["watermarked", "thumbnail"]:
-            blob.make_public()
+        download_url = get_storage_backend().upload(
+            path,
+            file,
+            public=is_public,
+            content_type=mimetypes.guess_type(path)[0],
+        )
     except FirebaseError as e:
-        raise APIException(f"Firebase uploading error {e}")
+        raise APIException(f"Firebase uploading error {e}") from e
     except Exception as e:
-        raise APIException(f"Unexpected server error during upload {e}")
+        raise APIException(f"Unexpected server error during upload {e}") from e
+
+    return path, download_url
+
 
-    if variant in ["watermarked", "thumbnail"]:
-        download_url = blob.public_url
+# queue upload_to_storage on this process's bounded upload pool; returns a Future of (path, url)
+def submit_upload(photo_id, file: ImageFile, variant="original"):
+    return get_upload_executor().submit(upload_to_storage, photo_id, file, variant)
+
+
+# sha256 of an upload: computed while it streamed in (photos.uploadhandlers), else read in chunks
+def content_hash_of(file):
+    content_hash = getattr(file, "content_hash", None)
+    if content_hash:
+        return content_hash
+
+    digest = hashlib.sha256()
+    file.seek(0)
+    if hasattr(file, "chunks"):
+        for chunk in file.chunks():
+            digest.update(chunk)
     else:
-        download_url = None
+        while chunk := file.read(settings.PHOTO_DOWNLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
 
-    return path, download_url
 
+def content_path(content_hash, extension):
+    return f"originals/{content_hash[:2]}/{content_hash}.{extension}"
+
+
+# stored under its content hash, so identical files are stored once; returns (path, content_hash)
+def upload_original(file: ImageFile):
+    content_hash = content_hash_of(file)
+    path = content_path(content_hash, _file_extension(file))
+    backend = get_storage_backend()
+
+    try:
+        if not backend.exists(path):
+            backend.upload(path, file, public=False, content_type=mimetypes.guess_type(path)[0])
+    except FirebaseError as e:
+        raise APIException(f"Firebase uploading error {e}") from e
+    except Exception as e:
+        raise APIException(f"Unexpected server error during upload {e}") from e
 
-def generate_thumbnail_image(image_file, size=(300, 300)):
-    with Image.open(image_file) as img:
-        img_format = img.format
-        img = img.convert('RGB')
-        img.thumbnail(size, Image.Resampling.LANCZOS)
+    return path, content_hash
 
-        return pillow_to_content_file(img, f"thumbnail.{img_format.lower()}", img_format.upper())
 
+# queue upload_original on the upload pool; returns a Future of (path, content_hash)
+def submit_original_upload(file: ImageFile):
+    return get_upload_executor().submit(upload_original, file)
 
-def _prepare_logo(target_width, logo_path="pixel-i.png"):
-    with Image.open(logo_path).convert("RGBA") as logo:
-        w, h = logo.size
-        scale = target_width / float(w)
-        new_size = (target_width, int(h * scale))
-        logo_resized = logo.resize(new_size, Image.Resampling.LANCZOS)
-        return logo_resized
 
+# processing results a duplicate photo takes over from the photo it matches
+REUSED_FIELDS = (
+    "width", "height", "meta", "watermarked_url", "thumbnail_url", "variants", "auto_tags", "auto_tag_scores",
+    "phash", "embedding", "stage_versions",
+)
 
-def generate_watermarked_image(base_image_file, size=1200):
-    with Image.open(base_image_file) as base:
-        img_format = base.format
-        base = base.convert("RGBA")
 
-        base.thumbnail((size, size), Image.Resampling.LANCZOS)
+# map each hash to the earliest successfully processed photo with that content
+def find_processed_duplicates(content_hashes, queryset=None):
+    hashes = {h for h in content_hashes if h}
+    if not hashes:
+        return {}
 
-        bw, bh = base.size
-        logo_rgba = _prepare_logo(int(bw * 0.25))
-        lw, lh = logo_rgba.size
+    qs = queryset if queryset is not None else Photo.objects.all()
+    matches = qs.filter(
+        content_hash__in=hashes,
+        status=Photo.PhotoStatus.COMPLETED,
+        processing_errors={},
+    ).order_by("-created_at")
 
-        padding = 20
-        x = bw - lw - padding
-        y = bh - lh - padding
+    # later rows overwrite earlier ones, so the oldest photo per hash wins
+    return {photo.content_hash: photo for photo in matches}
 
-        base.paste(logo_rgba, (x, y), logo_rgba)
-        base = base.convert("RGB")
-        return pillow_to_content_file(base, f"watermarked.{img_format.lower()}", img_format.upper())
 
+def find_processed_duplicate(content_hash, queryset=None):
+    return find_processed_duplicates([content_hash], queryset).get(content_hash)
 
-def extract_exif_data(image_bytes: BytesIO):
-    exif_data = {}
 
-    try:
-        image_bytes.seek(0)
-        image = Image.open(image_bytes)
-        width, height = image.size
+# copy source's variants, tags and metadata onto photo and mark it done; the caller saves it
+def reuse_processed_photo(photo, source):
+    for field in REUSED_FIELDS:
+        setattr(photo, field, getattr(source, field))
+    photo.content_hash = source.content_hash
+    # a new row for the search indexes, whenever the source was embedded
+    photo.embedded_at = timezone.now() if source.embedding else None
+    photo.status = Photo.PhotoStatus.COMPLETED
+    photo.processing_errors = {}
+    return photo
 
-        try:
-            exif = image.getexif()
-            if exif:
-                for tag_id, value in exif.items():
-                    tag_name = TAGS.get(tag_id, str(tag_id))
-                    if isinstance(value, bytes):
-                        try:
-                            value = value.decode('utf-8', errors='ignore')
-                        except:
-                            value = str(value)
-                    exif_data[tag_name] = str(value)
-        except (AttributeError, KeyError):
-            pass
-
-        return width, height, exif_data
-    except Exception as e:
-        # If EXIF extraction fails, still try to get dimensions
-        try:
-            image_bytes.seek(0)
-            image = Image.open(image_bytes)
-            width, height = image.size
-            return width, height, {}
-        except:
-            raise APIException(f"Error extracting image metadata: {e}")
+
+# reducing_gap passed to Pillow per downscale mode: JPEGs are decoded at 1/2, 1/4 or 1/8 scale with
+# draft() and other formats are shrunk with reduce() until they are within gap x target, then LANCZOS
+# finishes the resize. None disables both and resamples from the full-resolution decode.
+DOWNSCALE_REDUCING_GAPS = {
+    "quality": None,
+    "balanced": 2.0,
+    "fast": 1.0,
+}
+
+
+# decodes at reduced scale when the mode allows; very large images go through photos.large_images
+def downscale_image(img: Image.Image, size, mode=None):
+    mode = mode or settings.PHOTO_DOWNSCALE_MODE
+    if mode not in DOWNSCALE_REDUCING_GAPS:
+        raise ValueError(f"Unknown downscale mode {mode}")
+    reducing_gap = DOWNSCALE_REDUCING_GAPS[mode]
+
+    check_pixels(*img.size)
+    if is_large(img):
+        return downscale_large_image(img, size, reducing_gap)
+
+    w, h = img.size
+    scale = min(size[0] / w, size[1] / h)
+    if reducing_gap is not None and scale < 1:
+        img.draft(None, (int(w * scale * reducing_gap), int(h * scale * reducing_gap)))
+
+    rgb = img.convert("RGB")
+    rgb.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=reducing_gap)
+    return rgb
+
+
+def thumbnail_from_image(img: Image.Image, img_format, size=(300, 300)):
+    img = img.copy()
+    img.thumbnail(size, Image.Resampling.LANCZOS)
+    return pillow_to_content_file(img, f"thumbnail.{img_format.lower()}", img_format.upper())
+
+
+@lru_cache(maxsize=4)
+def _load_logo(logo_path):
+    with Image.open(logo_path) as logo:
+        return logo.convert("RGBA")
+
+
+@lru_cache(maxsize=16)
+def _scaled_logo(logo_path, target_width):
+    logo = _load_logo(logo_path)
+    w, h = logo.size
+    scale = target_width / float(w)
+    new_size = (target_width, max(1, int(h * scale)))
+    return logo.resize(new_size, Image.Resampling.LANCZOS)
+
+
+# logo widths are snapped to PHOTO_WATERMARK_WIDTH_BUCKET so that bases of similar size share a cached resize
+def _logo_width(target_width):
+    bucket = settings.PHOTO_WATERMARK_WIDTH_BUCKET
+    return max(bucket, round(target_width / bucket) * bucket)
+
+
+# resized RGBA logo for the given width. The returned image is shared and must not be modified
+def _prepare_logo(target_width, logo_path=None):
+    logo_path = str(logo_path or settings.PHOTO_WATERMARK_LOGO_PATH)
+    return _scaled_logo(logo_path, _logo_width(target_width))
+
+
+def _logo_position(base_size, logo_size, position, padding):
+    bw, bh = base_size
+    lw, lh = logo_size
+    vertical, horizontal = position.split("-")
+
+    x = {"left": padding, "center": (bw - lw) // 2, "right": bw - lw - padding}[horizontal]
+    y = {"top": padding, "center": (bh - lh) // 2, "bottom": bh - lh - padding}[vertical]
+    return x, y
+
+
+def watermark_from_image(base: Image.Image, img_format, size=1200, encode=True):
+    base = base.copy()
+    base.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+    logo_rgba = _prepare_logo(int(base.width * settings.PHOTO_WATERMARK_SCALE))
+    x, y = _logo_position(
+        base.size,
+        logo_rgba.size,
+        settings.PHOTO_WATERMARK_POSITION,
+        settings.PHOTO_WATERMARK_PADDING,
+    )
+
+    base.paste(logo_rgba, (x, y), logo_rgba)
+    if not encode:
+        return base
+    return pillow_to_content_file(base, f"watermarked.{img_format.lower()}", img_format.upper())
+
+
+VARIANT_FORMATS = {
+    "WEBP": ("webp", "webp"),
+    "AVIF": ("avif", "avif"),
+}
+
+
+def variant_format_supported(img_format):
+    if img_format not in VARIANT_FORMATS:
+        return False
+    return features.check(VARIANT_FORMATS[img_format][0])
+
+
+# encode an already-sized image as a responsive variant, stamping the watermark on a copy if asked
+def encode_variant(img: Image.Image, img_format, name, watermark=False):
+    if watermark:
+        img = watermark_from_image(img, img_format, max(img.size), encode=False)
+
+    extension = VARIANT_FORMATS[img_format][1]
+    return pillow_to_content_file(
+        img, f"{name}.{extension}", img_format, quality=settings.PHOTO_VARIANT_QUALITY
+    )
+
+
+# decode=False keeps the pixels undecoded but misses EXIF stored after them (PNG decodes everything to find it)
+def read_exif_data(image: Image.Image, decode=True):
+    exif_data = {}
+    try:
+        exif = image.getexif() if decode else Image.Image.getexif(image)
+        if exif:
+            for tag_id, value in exif.items():
+                tag_name = TAGS.get(tag_id, str(tag_id))
+                if isinstance(value, bytes):
+                    try:
+                        value = value.decode('utf-8', errors='ignore')
+                    except:
+                        value = str(value)
+                exif_data[tag_name] = str(value)
+    except (AttributeError, KeyError):
+        pass
+    return exif_data
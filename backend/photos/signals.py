@@ -0,0 +1,14 @@
+# Keeps this process's semantic index in step with deleted photos; other processes prune theirs on sync
+
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from photos.models import Photo
+from photos.semantic import remove_from_embedding_index
+
+
+@receiver(post_delete, sender=Photo)
+def evict_deleted_photo(sender, instance, **kwargs):
+    photo_id = instance.id
+    transaction.on_commit(lambda: remove_from_embedding_index([photo_id]))
@@ -0,0 +1,156 @@
+# Perceptual hashes (64-bit dHash) and per-event near-duplicate lookup, to collapse bursts of frames.
+# EventHashIndex uses multi-index hashing: split into max_distance + 1 chunks, two hashes within
+# max_distance bits agree exactly on at least one chunk, so only pairs sharing a chunk are compared
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+from django.db.models import Count, Max
+
+from photos.models import Photo
+
+HASH_BITS = 64
+
+
+# dHash of a 9x8 grayscale thumbnail, as a signed 64-bit int (the range of Photo.phash)
+def perceptual_hash(image: Image.Image, hash_size=8):
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, :-1] > pixels[:, 1:]
+    return int(np.packbits(bits).view(">i8")[0])
+
+
+def _popcount(values: np.ndarray):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # numpy < 2.0: per-byte lookup table
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray):
+    return _popcount(np.bitwise_xor(a, b))
+
+
+# Multi-index Hamming lookup over the hashed photos of one event
+class EventHashIndex:
+    def __init__(self, photo_ids, hashes):
+        self.photo_ids = list(photo_ids)
+        # signed database values reinterpreted as the unsigned bit patterns
+        self.hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+        self._groups = {}
+
+    def __len__(self):
+        return len(self.photo_ids)
+
+    # one row per chunk: the chunk's bits of every hash. Bits past the last full chunk are not indexed
+    def _chunk_keys(self, max_distance):
+        chunks = max_distance + 1
+        width = HASH_BITS // chunks
+        mask = np.uint64((1 << width) - 1)
+        return [(self.hashes >> np.uint64(i * width)) & mask for i in range(chunks)]
+
+    # index pairs (i, j), i < j, whose hashes differ in at most max_distance bits
+    def near_duplicate_pairs(self, max_distance):
+        if max_distance >= HASH_BITS // 2 or len(self) < 2:
+            # chunks would be too narrow to narrow anything down; compare every pair
+            i, j = np.triu_indices(len(self), k=1)
+            keep = hamming_distance(self.hashes[i], self.hashes[j]) <= max_distance
+            return i[keep], j[keep]
+
+        matches_i, matches_j = [], []
+        for keys in self._chunk_keys(max_distance):
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            # photos sharing this chunk are adjacent after sorting; pair each with the ones 1, 2, ...
+            # positions further on until no bucket is that large
+            for offset in range(1, len(self)):
+                same = np.flatnonzero(sorted_keys[:-offset] == sorted_keys[offset:])
+                if not len(same):
+                    break
+                i, j = order[same], order[same + offset]
+                keep = hamming_distance(self.hashes[i], self.hashes[j]) <= max_distance
+                matches_i.append(i[keep])
+                matches_j.append(j[keep])
+
+        if not matches_i:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty
+
+        i = np.concatenate(matches_i)
+        j = np.concatenate(matches_j)
+        i, j = np.minimum(i, j), np.maximum(i, j)
+        # a pair sharing several chunks shows up once per chunk
+        pairs = np.unique(i.astype(np.int64) * len(self) + j)
+        return pairs // len(self), pairs % len(self)
+
+    # connected components of the near-duplicate graph, so a slowly drifting burst stays one group
+    def groups(self, max_distance):
+        if max_distance in self._groups:
+            return self._groups[max_distance]
+
+        parent = np.arange(len(self))
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        i, j = self.near_duplicate_pairs(max_distance)
+        for a, b in zip(i.tolist(), j.tolist()):
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        members = np.unique(np.concatenate([i, j]))
+        groups = {self.photo_ids[m]: self.photo_ids[find(m)] for m in members.tolist()}
+        self._groups[max_distance] = groups
+        return groups
+
+
+_index_lock = threading.Lock()
+_event_indexes = OrderedDict()  # event id -> (signature, EventHashIndex), least recently used first
+
+
+# per process, rebuilt when the event's photos change; bounded to PHOTO_HASH_INDEX_CACHE_SIZE events
+def get_event_hash_index(event_id):
+    photos = Photo.objects.filter(event_id=event_id)
+    signature = tuple(photos.aggregate(Count("id"), Count("phash"), Max("created_at")).values())
+
+    with _index_lock:
+        cached = _event_indexes.get(event_id)
+        if cached is not None and cached[0] == signature:
+            _event_indexes.move_to_end(event_id)
+            return cached[1]
+
+    rows = photos.filter(phash__isnull=False).values_list("id", "phash")
+    photo_ids = [photo_id for photo_id, _ in rows]
+    index = EventHashIndex(photo_ids, [phash for _, phash in rows])
+
+    with _index_lock:
+        _event_indexes[event_id] = (signature, index)
+        _event_indexes.move_to_end(event_id)
+        while len(_event_indexes) > settings.PHOTO_HASH_INDEX_CACHE_SIZE:
+            _event_indexes.popitem(last=False)
+    return index
+
+
+# one representative per burst, the earliest visible frame; returns (queryset, {representative id: frames})
+def collapse_bursts(event_id, queryset, max_distance=None):
+    max_distance = settings.PHOTO_BURST_MAX_DISTANCE if max_distance is None else max_distance
+    groups = get_event_hash_index(event_id).groups(max_distance)
+
+    representatives = {}
+    counts = {}
+    for photo_id, timestamp in queryset.values_list("id", "timestamp"):
+        group = groups.get(photo_id, photo_id)
+        counts[group] = counts.get(group, 0) + 1
+        if group not in representatives or timestamp < representatives[group][1]:
+            representatives[group] = (photo_id, timestamp)
+
+    burst_counts = {photo_id: counts[group] for group, (photo_id, _) in representatives.items()}
+    return queryset.filter(id__in=list(burst_counts)), burst_counts
@@ -0,0 +1,277 @@
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+# Paths are bucket-relative, e.g. media/<photo_id>/original.jpg
+class StorageBackend:
+    # store file at path; returns the permanent public URL when public, otherwise None
+    def upload(self, path, file, public=False, content_type=None):
+        raise NotImplementedError
+
+    # a readable binary file whose .name is a path on local disk; closing it releases it
+    def open(self, path):
+        raise NotImplementedError
+
+    def signed_url(self, path, ttl_seconds):
+        raise NotImplementedError
+
+    # {"url", "method", "headers"}; the client must send exactly those headers
+    def signed_upload_url(self, path, ttl_seconds, content_type):
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+
+# The HTTP connection pool is sized to PHOTO_UPLOAD_CONCURRENCY and rebuilt after a fork
+class FirebaseStorageBackend(StorageBackend):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._bucket
+        with self._lock:
+            if self._pid != pid:
+                self._bucket = self._build_bucket()
+                self._pid = pid
+        return self._bucket
+
+    def _build_bucket(self):
+        import firebase_admin
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import storage as gcs
+        from requests.adapters import HTTPAdapter
+
+        app = firebase_admin.get_app()
+        credentials = app.credential.get_credential()
+        concurrency = settings.PHOTO_UPLOAD_CONCURRENCY
+
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        session.mount("https://", adapter)
+        client = gcs.Client(project=app.project_id, credentials=credentials, _http=session)
+
+        bucket_name = app.options.get("storageBucket")
+        if not bucket_name:
+            raise ValueError("Storage bucket name not specified")
+        return client.bucket(bucket_name)
+
+    def upload(self, path, file, public=False, content_type=None):
+        blob = self.bucket.blob(path)
+        file.seek(0)
+        # ACL is applied as part of the upload request, no separate make_public() round trip
+        blob.upload_from_file(
+            file,
+            content_type=content_type,
+            predefined_acl="publicRead" if public else None,
+        )
+        return blob.public_url if public else None
+
+    def open(self, path):
+        # streamed in chunks so memory use does not grow with the size of the object
+        blob = self.bucket.blob(path, chunk_size=settings.PHOTO_DOWNLOAD_CHUNK_SIZE)
+        local = tempfile.NamedTemporaryFile(
+            suffix=os.path.splitext(path)[1],
+            dir=settings.PHOTO_DOWNLOAD_TMP_DIR,
+        )
+        try:
+            blob.download_to_file(local)
+            local.flush()
+            local.seek(0)
+        except Exception:
+            local.close()
+            raise
+        return local
+
+    def signed_url(self, path, ttl_seconds):
+        return self.bucket.blob(path).generate_signed_url(
+            expiration=timezone.now() + timedelta(seconds=ttl_seconds),
+            method="GET",
+        )
+
+    def signed_upload_url(self, path, ttl_seconds, content_type):
+        headers = {
+            "Content-Type": content_type,
+            "x-goog-content-length-range": f"0,{settings.PHOTO_UPLOAD_MAX_BYTES}",
+        }
+        url = self.bucket.blob(path).generate_signed_url(
+            version="v4",
+            expiration=timedelta(seconds=ttl_seconds),
+            method="PUT",
+            content_type=content_type,
+            headers={"x-goog-content-length-range": headers["x-goog-content-length-range"]},
+        )
+        return {"url": url, "method": "PUT", "headers": headers}
+
+    def exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def delete(self, path):
+        self.bucket.blob(path).delete()
+
+
+# Files under PHOTO_STORAGE_LOCAL_ROOT, served and accepted by LocalMediaView with HMAC-signed URLs.
+# Uploads already on disk are hard-linked (or copied with sendfile) instead of re-read
+class LocalStorageBackend(StorageBackend):
+    def __init__(self, root=None, base_url=None, signing_key=None):
+        self.root = os.path.abspath(root or settings.PHOTO_STORAGE_LOCAL_ROOT)
+        self.base_url = base_url or settings.PHOTO_STORAGE_LOCAL_BASE_URL
+        key = signing_key or settings.PHOTO_STORAGE_SIGNING_KEY or settings.SECRET_KEY
+        self._key = key.encode() if isinstance(key, str) else key
+
+    def _local_path(self, path):
+        full = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise ValueError(f"Path {path} escapes the storage root")
+        return full
+
+    def _sign(self, path, expires=None, method="GET"):
+        message = path if expires is None else f"{method}:{path}:{expires}"
+        return hmac.new(self._key, message.encode(), hashlib.sha256).hexdigest()
+
+    def _url(self, path, **params):
+        return f"{self.base_url}{quote(path)}?{urlencode(params)}"
+
+    def verify(self, path, signature, expires=None, method="GET"):
+        if expires is not None:
+            try:
+                if int(expires) < time.time():
+                    return False
+            except (TypeError, ValueError):
+                return False
+        elif method != "GET":
+            return False
+        return hmac.compare_digest(self._sign(path, expires, method), signature or "")
+
+    def upload(self, path, file, public=False, content_type=None):
+        target = self._local_path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        source = _local_file_path(file)
+        if source:
+            _link_or_copy(source, target)
+        else:
+            file.seek(0)
+            fd, tmp_target = _temp_path(target)
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    shutil.copyfileobj(file, out, settings.PHOTO_DOWNLOAD_CHUNK_SIZE)
+                os.replace(tmp_target, target)
+            finally:
+                if os.path.exists(tmp_target):
+                    os.remove(tmp_target)
+        return self._url(path, signature=self._sign(path)) if public else None
+
+    # objects are written once (FileExistsError), so a signed upload URL cannot replace a finalized original
+    def write_stream(self, path, stream, max_bytes):
+        target = self._local_path(path)
+        if os.path.exists(target):
+            raise FileExistsError(f"{path} already exists")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_target = _temp_path(target)
+        written = 0
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := stream.read(1024 * 1024):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise ValueError(f"Upload exceeds {max_bytes} bytes")
+                    out.write(chunk)
+            # unlike os.replace, fails if a concurrent PUT got there first
+            os.link(tmp_target, target)
+        finally:
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+        return written
+
+    def open(self, path):
+        return open(self._local_path(path), "rb")
+
+    def signed_url(self, path, ttl_seconds):
+        expires = int(time.time()) + int(ttl_seconds)
+        return self._url(path, expires=expires, signature=self._sign(path, str(expires)))
+
+    def signed_upload_url(self, path, ttl_seconds, content_type):
+        expires = int(time.time()) + int(ttl_seconds)
+        url = self._url(path, expires=expires, signature=self._sign(path, str(expires), "PUT"))
+        return {"url": url, "method": "PUT", "headers": {"Content-Type": content_type}}
+
+    def exists(self, path):
+        return os.path.exists(self._local_path(path))
+
+    def delete(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except FileNotFoundError:
+            pass
+
+
+# path of an upload that already sits on local disk (TemporaryUploadedFile, temp files), if any
+def _local_file_path(file):
+    if hasattr(file, "temporary_file_path"):
+        return file.temporary_file_path()
+    name = getattr(file, "name", None)
+    if isinstance(name, str) and os.path.isabs(name) and os.path.isfile(name):
+        return name
+    return None
+
+
+# a new, uniquely named file next to target (fd, path), so concurrent writers never share one
+def _temp_path(target):
+    return tempfile.mkstemp(dir=os.path.dirname(target), prefix=f".{os.path.basename(target)}.", suffix=".tmp")
+
+
+def _link_or_copy(source, target):
+    fd, tmp_target = _temp_path(target)
+    os.close(fd)
+    try:
+        try:
+            # a link needs a free name: give back the one just reserved
+            os.remove(tmp_target)
+            os.link(source, tmp_target)
+        except OSError:
+            # different filesystem: copyfile uses sendfile on Linux, so no userspace copy
+            shutil.copyfile(source, tmp_target)
+        os.replace(tmp_target, target)
+    finally:
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+
+
+STORAGE_BACKENDS = {
+    "firebase": "photos.storage.FirebaseStorageBackend",
+    "local": "photos.storage.LocalStorageBackend",
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+# the configured backend, built once per process. PHOTO_STORAGE_BACKEND is a key or dotted path
+def get_storage_backend() -> StorageBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.PHOTO_STORAGE_BACKEND
+                _backend = import_string(STORAGE_BACKENDS.get(name, name))()
+    return _backend
@@ -1,84 +1,456 @@
+import base64
 import logging
+import uuid
+from datetime import timedelta
 
-from celery import shared_task
+from celery import shared_task, chain, chord
+from celery.signals import celeryd_init, worker_process_init
+from PIL import Image
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 
-from photos.models import Photo
+from photos.admission import release_in_flight
+from photos.ann import build_similarity_index
+from photos.imaging import open_image_pipeline
+from photos.large_images import ImageTooLarge
+from photos.models import Photo, PhotoDeadLetter, PhotoStageCheckpoint
+from photos.reaper import quarantine_photo, reap_photos
+from photos.retag import retag_photos
+from photos.retries import retry_policy
 from photos.services import (
-    generate_watermarked_image,
-    generate_thumbnail_image,
+    submit_upload,
     upload_to_storage,
-    download_image_from_firebase,
-    generate_auto_tag_photo,
-    extract_exif_data
+    download_original,
+    warm_clip_model,
+    content_hash_of,
+    find_processed_duplicate,
+    reuse_processed_photo,
+    REUSED_FIELDS
 )
+from photos.semantic import update_embedding_index
+from photos.storage import get_storage_backend
 
 logger = logging.getLogger(__name__)
 
+# Bump a stage's version when its output changes (new variant sizes, an EXIF fix, another CLIP
+# model, ...). Photos record the versions they were processed with in Photo.stage_versions, and
+# manage.py backfill_photos re-runs the stages they are behind on.
+STAGE_VERSIONS = {
+    "prepare": 1,
+    "variants": 1,
+    "tagging": 1,
+}
+# processing_errors keys written by the prepare stage
+PREPARE_ERRORS = ("download", "decode", "prepare")
 
+_worker_queues = None
+
+
+@celeryd_init.connect
+def remember_worker_queues(options=None, **kwargs):
+    global _worker_queues
+    queues = (options or {}).get("queues")
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    _worker_queues = [q.strip() for q in queues] if queues else None
+
+
+@worker_process_init.connect
+def preload_clip_model(**kwargs):
+    # only workers that consume the ML queue (or every queue) need CLIP in memory, and none do
+    # when tagging goes through the shared inference server
+    if settings.CLIP_INFERENCE_SOCKET:
+        return
+    if _worker_queues is not None and settings.PHOTO_QUEUE_ML not in _worker_queues:
+        return
+    try:
+        warm_clip_model()
+        logger.info("CLIP model and tag embeddings loaded for worker process")
+    except Exception as e:
+        logger.error(f"Failed to preload CLIP model - {str(e)}")
+
+
+# prepare (cpu) -> [variants (cpu), tagging (ml)] -> finalize (io), each stage on its own queue.
+# prepare stores a downscaled working copy for the later stages. The run holds a lease on the photo
+# until finalize, each stage checkpoints its output, and priority is carried to every stage
+@shared_task
+def process_photo_task(photo_id, stages=None, priority=None):
+    token = _acquire_lease(photo_id)
+    if token is None:
+        logger.info(f"Photo {photo_id}: Already being processed, skipping duplicate run")
+        return None
+
+    stage_tasks = {"variants": variants_photo_task, "tagging": tag_photo_task}
+    stages = ["prepare", *(stage for stage in stage_tasks if stages is None or stage in stages)]
+
+    options = {} if priority is None else {"priority": priority}
+    prepare = prepare_photo_task.s(str(photo_id), stages, token).set(**options)
+    finalize = finalize_photo_task.s().set(**options)
+    header = [stage_tasks[stage].s().set(**options) for stage in stages[1:]]
+    if not header:
+        return chain(prepare, finalize).apply_async()
+    return chain(prepare, chord(header, finalize)).apply_async()
+
+
+# rebuild the "more like this" index; schedule periodically so new photos leave the exact-scored delta
+@shared_task
+def build_similarity_index_task():
+    index = build_similarity_index()
+    return len(index)
+
+
+# Re-rank auto tags from stored embeddings after a vocabulary change, see photos.retag
 @shared_task
-def process_photo_task(photo_id):
+def retag_photos_task(signature=None):
+    return retag_photos(signature)
+
+
+# periodic (CELERY_BEAT_SCHEDULE): re-enqueue stuck and failed photos, dead-letter hopeless ones
+@shared_task
+def reap_stuck_photos_task():
+    return reap_photos()
+
+
+# take the photo's processing lease if nobody holds an unexpired one; returns its token or None
+def _acquire_lease(photo_id):
+    token = uuid.uuid4()
+    now = timezone.now()
+    acquired = Photo.objects.filter(id=photo_id).filter(
+        Q(processing_lease_until__isnull=True) | Q(processing_lease_until__lt=now)
+    ).update(
+        processing_token=token,
+        processing_lease_until=now + timedelta(seconds=settings.PHOTO_PROCESSING_LEASE_SECONDS),
+    )
+    return str(token) if acquired else None
+
+
+# extend the lease; False if the run no longer holds it (it expired and another run took over)
+def _renew_lease(photo_id, token):
+    if token is None:
+        return True
+    lease_until = timezone.now() + timedelta(seconds=settings.PHOTO_PROCESSING_LEASE_SECONDS)
+    return bool(Photo.objects.filter(id=photo_id, processing_token=token).update(processing_lease_until=lease_until))
+
+
+# called when a run ends, successfully or not; also frees the photo's admission slot
+def _release_lease(photo):
+    photo.processing_token = None
+    photo.processing_lease_until = None
+    release_in_flight(photo.id, photo.photographer_id)
+
+
+def _superseded(context):
+    logger.warning(f"Photo {context['photo_id']}: Processing lease lost to another run, dropping this one")
+    return {**context, "superseded": True}
+
+
+def _load_checkpoint(photo_id, stage):
+    return PhotoStageCheckpoint.objects.filter(
+        photo_id=photo_id, stage=stage, version=STAGE_VERSIONS[stage]
+    ).values_list("result", flat=True).first()
+
+
+def _save_checkpoint(photo_id, stage, result):
+    PhotoStageCheckpoint.objects.update_or_create(
+        photo_id=photo_id, stage=stage, defaults={"version": STAGE_VERSIONS[stage], "result": result},
+    )
+
+
+# retry the running stage task after a jittered backoff if the error class allows another attempt
+def _retry_if_transient(task, photo_id, stage, error):
+    policy = retry_policy(error)
+    if policy is None or task.request.retries >= policy.max_retries:
+        return
+    countdown = policy.countdown(task.request.retries)
+    logger.warning(
+        f"Photo {photo_id}: {stage} failed ({policy.name}), retry {task.request.retries + 1}/{policy.max_retries} "
+        f"in {countdown:.1f}s - {str(error)}"
+    )
+    raise task.retry(exc=error, countdown=countdown, max_retries=policy.max_retries)
+
+
+def _mark_failed(photo, stage, error):
+    logger.error(f"Photo {photo.id}: Failed at {stage} stage - {str(error)}")
+    photo.status = Photo.PhotoStatus.FAILED
+    photo.processing_errors = {stage: str(error)}
+    _release_lease(photo)
+    photo.save(update_fields=[
+        "status", "processing_errors", "processing_token", "processing_lease_until", "updated_at"
+    ])
+
+
+# originals over the size limits fail the same way on every attempt, so they skip the re-drives
+def _quarantine(photo, stage, error):
+    _mark_failed(photo, stage, error)
+    quarantine_photo(photo, PhotoDeadLetter.Reason.TOO_LARGE)
+
+
+@shared_task(bind=True)
+def prepare_photo_task(self, photo_id, stages=None, lock=None):
+    context = {"photo_id": photo_id, "stages": stages or list(STAGE_VERSIONS), "lock": lock}
+    if not _renew_lease(photo_id, lock):
+        return _superseded(context)
+
+    saved = _load_checkpoint(photo_id, "prepare")
+    if saved and get_storage_backend().exists(saved["working_path"]):
+        logger.info(f"Photo {photo_id}: Reusing checkpointed working copy and metadata")
+        return {**context, **saved}
+
     photo = Photo.objects.get(id=photo_id)
-    processing_errors = {}
 
     try:
-        original_img = download_image_from_firebase(photo.original_path)
+        original_img = download_original(photo.original_path)
     except Exception as e:
-        logger.error(f"Photo {photo_id}: Failed to download original image - {str(e)}")
-        photo.status = Photo.PhotoStatus.FAILED
-        photo.processing_errors = {"download": str(e)}
-        photo.save(update_fields=["status", "processing_errors"])
+        _retry_if_transient(self, photo_id, "download", e)
+        _mark_failed(photo, "download", e)
         raise
 
-    try:
-        watermarked = generate_watermarked_image(original_img)
-        thumbnail = generate_thumbnail_image(original_img)
+    # the original is a file on local disk; leaving this block releases it
+    with original_img:
+        # direct uploads are hashed here, multipart uploads were hashed as they streamed in
+        if not photo.content_hash:
+            photo.content_hash = content_hash_of(original_img)
+            source = find_processed_duplicate(photo.content_hash, Photo.objects.exclude(id=photo.id))
+            if source:
+                return _reuse_duplicate(photo, source)
+            photo.save(update_fields=["content_hash"])
+
+        try:
+            pipeline = open_image_pipeline(original_img.name)
+        except (ImageTooLarge, Image.DecompressionBombError) as e:
+            _quarantine(photo, "decode", e)
+            raise
+        except Exception as e:
+            _mark_failed(photo, "decode", e)
+            raise
+
+        with pipeline:
+            width, height, exif_data = pipeline.metadata()
+            try:
+                working_path, _ = upload_to_storage(photo_id, pipeline.working_copy(), "working")
+            except ImageTooLarge as e:
+                _quarantine(photo, "prepare", e)
+                raise
+            except Exception as e:
+                _retry_if_transient(self, photo_id, "prepare", e)
+                _mark_failed(photo, "prepare", e)
+                raise
+
+    result = {
+        "format": pipeline.format,
+        "working_path": working_path,
+        "width": width,
+        "height": height,
+        "meta": exif_data,
+    }
+    _save_checkpoint(photo_id, "prepare", result)
+    logger.info(f"Photo {photo_id}: Prepared working copy and metadata")
+    return {**context, **result}
+
+
+def _reuse_duplicate(photo, source):
+    uploaded_path = photo.original_path
+    reuse_processed_photo(photo, source)
+    photo.original_path = source.original_path
+    _release_lease(photo)
+    photo.save(update_fields=[
+        *REUSED_FIELDS, "embedded_at", "content_hash", "original_path", "status", "processing_errors",
+        "processing_token", "processing_lease_until", "updated_at",
+    ])
+
+    # the content is already stored under the source's path
+    if uploaded_path and uploaded_path != source.original_path:
+        try:
+            get_storage_backend().delete(uploaded_path)
+        except Exception as e:
+            logger.warning(f"Photo {photo.id}: Failed to delete duplicate original - {str(e)}")
+
+    logger.info(f"Photo {photo.id}: Duplicate of photo {source.id}, reused its processing results")
+    return {"photo_id": str(photo.id), "reused_from": str(source.id)}
+
 
-        wp, watermarked_url = upload_to_storage(photo_id, watermarked, "watermarked")
-        tp, thumbnail_url = upload_to_storage(photo_id, thumbnail, 'thumbnail')
+def _passes_through(context):
+    return "reused_from" in context or "superseded" in context
+
+
+@shared_task(bind=True)
+def variants_photo_task(self, context):
+    if _passes_through(context):
+        return context
+    photo_id = context["photo_id"]
+    if not _renew_lease(photo_id, context.get("lock")):
+        return _superseded(context)
+
+    saved = _load_checkpoint(photo_id, "variants")
+    if saved:
+        logger.info(f"Photo {photo_id}: Reusing checkpointed image variants")
+        return {**context, **saved}
+
+    try:
+        with download_original(context["working_path"]) as working:
+            with open_image_pipeline(working.name, img_format=context["format"]) as pipeline:
+                # uploads run on the storage pool while the next variant is being encoded
+                watermarked_upload = submit_upload(photo_id, pipeline.watermarked(), "watermarked")
+                thumbnail_upload = submit_upload(photo_id, pipeline.thumbnail(), "thumbnail")
+                ladder_uploads = [
+                    (descriptor, submit_upload(photo_id, file, f"variants/{descriptor['size']}"))
+                    for descriptor, file in pipeline.variant_ladder()
+                ]
 
-        photo.watermarked_url = watermarked_url
-        photo.thumbnail_url = thumbnail_url
-        logger.info(f"Photo {photo_id}: Successfully generated image variants")
+                _, watermarked_url = watermarked_upload.result()
+                _, thumbnail_url = thumbnail_upload.result()
+                variants = [
+                    {**descriptor, "url": upload.result()[1]} for descriptor, upload in ladder_uploads
+                ]
+                phash = pipeline.perceptual_hash()
     except Exception as e:
+        _retry_if_transient(self, photo_id, "variants", e)
         logger.error(f"Photo {photo_id}: Failed to generate image variants - {str(e)}")
-        processing_errors["variants"] = str(e)
+        return {**context, "errors": {"variants": str(e)}}
+
+    result = {
+        "watermarked_url": watermarked_url,
+        "thumbnail_url": thumbnail_url,
+        "variants": variants,
+        "phash": phash,
+    }
+    _save_checkpoint(photo_id, "variants", result)
+    logger.info(f"Photo {photo_id}: Successfully generated image variants")
+    return {**context, **result}
+
+
+@shared_task(bind=True)
+def tag_photo_task(self, context):
+    if _passes_through(context):
+        return context
+    photo_id = context["photo_id"]
+    if not _renew_lease(photo_id, context.get("lock")):
+        return _superseded(context)
+
+    saved = _load_checkpoint(photo_id, "tagging")
+    if saved:
+        logger.info(f"Photo {photo_id}: Reusing checkpointed auto tags")
+        return {**context, **saved}
 
     try:
-        original_img.seek(0)
-        tags = generate_auto_tag_photo(original_img)
-        photo.auto_tags = tags
-        logger.info(f"Photo {photo_id}: Successfully generated auto tags")
+        with download_original(context["working_path"]) as working:
+            # CLIP only looks at 224px, so the working copy is decoded at reduced scale
+            with open_image_pipeline(working.name, base_size=448) as pipeline:
+                ranked, embedding = pipeline.analyze()
     except Exception as e:
+        _retry_if_transient(self, photo_id, "tagging", e)
         logger.error(f"Photo {photo_id}: Failed to generate auto tags - {str(e)}")
-        processing_errors["tagging"] = str(e)
+        return {**context, "errors": {"tagging": str(e)}}
+
+    result = {
+        "auto_tags": [tag for tag, _ in ranked],
+        "auto_tag_scores": {tag: round(score, 4) for tag, score in ranked},
+        "embedding": base64.b64encode(embedding.tobytes()).decode(),
+    }
+    _save_checkpoint(photo_id, "tagging", result)
+    logger.info(f"Photo {photo_id}: Successfully generated auto tags")
+    return {**context, **result}
 
+
+# chord callback: merges the stage results (each carrying the prepare context) into one Photo update
+@shared_task(bind=True)
+def finalize_photo_task(self, results):
+    if isinstance(results, dict):
+        # prepare only, no chord
+        results = [results]
+    merged = {}
+    processing_errors = {}
+    for result in results:
+        processing_errors.update(result.pop("errors", {}))
+        merged.update(result)
+
+    if _passes_through(merged):
+        return
+
+    photo_id = merged["photo_id"]
+    token = merged.get("lock")
     try:
-        original_img.seek(0)
-        width, height, exif_data = extract_exif_data(original_img)
-        photo.width = width
-        photo.height = height
-        photo.meta = exif_data
-        logger.info(f"Photo {photo_id}: Successfully extracted metadata")
+        photo = Photo.objects.get(id=photo_id)
     except Exception as e:
-        logger.error(f"Photo {photo_id}: Failed to extract metadata - {str(e)}")
-        processing_errors["metadata"] = str(e)
+        _retry_if_transient(self, photo_id, "finalize", e)
+        raise
+    if token is not None and str(photo.processing_token) != token:
+        _superseded(merged)
+        return
 
+    photo.width = merged.get("width")
+    photo.height = merged.get("height")
+    photo.meta = merged.get("meta", {})
+    photo.watermarked_url = merged.get("watermarked_url", photo.watermarked_url)
+    photo.thumbnail_url = merged.get("thumbnail_url", photo.thumbnail_url)
+    photo.variants = merged.get("variants", photo.variants)
+    photo.phash = merged.get("phash", photo.phash)
+    photo.auto_tags = merged.get("auto_tags", photo.auto_tags)
+    photo.auto_tag_scores = merged.get("auto_tag_scores", photo.auto_tag_scores)
+    if "embedding" in merged:
+        photo.embedding = base64.b64decode(merged["embedding"])
+        photo.embedded_at = timezone.now()
+
+    # errors of stages that did not run this time (a partial re-run) still stand
+    stages = merged.get("stages", list(STAGE_VERSIONS))
+    ran = set(stages) | set(PREPARE_ERRORS)
+    processing_errors = {
+        **{stage: error for stage, error in photo.processing_errors.items() if stage not in ran},
+        **processing_errors,
+    }
+    photo.stage_versions = {
+        **photo.stage_versions,
+        **{stage: STAGE_VERSIONS[stage] for stage in stages if stage not in processing_errors},
+    }
+
+    # a partial failure still completes: the photo is usable, and backfill_photos re-runs the failed stages
+    photo.status = Photo.PhotoStatus.COMPLETED
     if processing_errors:
-        photo.status = Photo.PhotoStatus.COMPLETED
         photo.processing_errors = processing_errors
         logger.warning(f"Photo {photo_id}: Partial processing - completed with errors: {processing_errors}")
     else:
-        photo.status = Photo.PhotoStatus.COMPLETED
         photo.processing_errors = {}
+        photo.redrive_count = 0
+        photo.processing_history = []
         logger.info(f"Photo {photo_id}: Successfully completed all processing steps")
+    _release_lease(photo)
 
-    photo.save(update_fields=[
-        "watermarked_url",
-        "thumbnail_url",
-        "auto_tags",
-        "width",
-        "height",
-        "meta",
-        "status",
-        "processing_errors"
-    ])
+    try:
+        photo.save(update_fields=[
+            "watermarked_url",
+            "thumbnail_url",
+            "variants",
+            "phash",
+            "auto_tags",
+            "auto_tag_scores",
+            "embedding",
+            "embedded_at",
+            "width",
+            "height",
+            "meta",
+            "status",
+            "processing_errors",
+            "stage_versions",
+            "processing_token",
+            "processing_lease_until",
+            "redrive_count",
+            "processing_history",
+            "updated_at"
+        ])
+    except Exception as e:
+        _retry_if_transient(self, photo_id, "finalize", e)
+        raise
+    if photo.embedding:
+        update_embedding_index(photo.id, photo.embedding)
+
+    if processing_errors:
+        # keep the working copy and the finished stages' checkpoints for re-running the failed stages
+        return
+    PhotoStageCheckpoint.objects.filter(photo_id=photo_id).delete()
+    working_path = merged.get("working_path")
+    if working_path:
+        try:
+            get_storage_backend().delete(working_path)
+        except Exception as e:
+            logger.warning(f"Photo {photo_id}: Failed to delete working copy - {str(e)}")
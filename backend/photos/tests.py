@@ -1,3 +1,447 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import redis
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import CustomUser
+from events.models import Event
+from photos.ann import _LoadedIndex, build_similarity_index
+from photos.large_images import ImageTooLarge, _reduce_in_strips, _strips, check_pixels
+from photos.management.commands._bench import make_sample_image, run_isolated
+from photos.models import Photo, PhotoDeadLetter
+from photos.reaper import reap_photos, stuck_photos
+from photos.semantic import EmbeddingIndex
+from photos.services import content_path, downscale_image
+from photos.storage import LocalStorageBackend
+from photos.tasks import _acquire_lease, finalize_photo_task, prepare_photo_task, process_photo_task
+
+MIB = 1024 * 1024
+
+
+def _write_sample(path, width, height, img_format, palette=False, **options):
+    # shapes drawn small and upscaled, as in benchmark_large_images
+    with Image.open(make_sample_image(width // 8, height // 8, seed=width)) as small:
+        sample = small.resize((width, height))
+    if palette:
+        sample = sample.quantize(64)
+    sample.save(path, img_format, **options)
+    sample.close()
+
+
+def _downscale(path):
+    with Image.open(path) as img:
+        thumb = downscale_image(img, (1024, 1024))
+    if thumb.size != (1024, 683):
+        raise AssertionError(f"Unexpected size {thumb.size}")
+
+
+@override_settings(PHOTO_LARGE_IMAGE_PIXELS=4_000_000, PHOTO_IMAGE_MEMORY_LIMIT=48 * MIB)
+class LargeImageTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def _path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_raw_formats_decode_within_memory_limit(self):
+        # 24MP decodes to 96MB of pixels, twice the memory limit
+        for img_format, extension in (("TIFF", "tif"), ("PPM", "ppm"), ("BMP", "bmp")):
+            with self.subTest(img_format=img_format):
+                path = self._path(f"limit.{extension}")
+                _write_sample(path, 6000, 4000, img_format)
+                _, peak_mib, refused = run_isolated(_downscale, [(extension, path)])
+                os.remove(path)
+                self.assertFalse(refused)
+                self.assertLess(peak_mib, 48)
+
+    def test_palette_image_decodes_within_memory_limit(self):
+        # bands of a P image are converted to RGB, 4 bytes a pixel rather than the 1 it is stored in
+        for img_format, extension in (("TIFF", "tif"), ("BMP", "bmp")):
+            with self.subTest(img_format=img_format):
+                path = self._path(f"palette.{extension}")
+                _write_sample(path, 6000, 4000, img_format, palette=True)
+                _, peak_mib, refused = run_isolated(_downscale, [(extension, path)])
+                os.remove(path)
+                self.assertFalse(refused)
+                self.assertLess(peak_mib, 48)
+
+    def test_strip_reduce_matches_full_reduce(self):
+        # neither dimension a multiple of the factor, and a budget small enough for many bands
+        for img_format, extension in (("TIFF", "tif"), ("PPM", "ppm"), ("BMP", "bmp")):
+            with self.subTest(img_format=img_format):
+                path = self._path(f"exact.{extension}")
+                _write_sample(path, 2003, 1501, img_format)
+                with Image.open(path) as img:
+                    strips = _strips(img, 3)
+                    self.assertIsNotNone(strips)
+                    reduced = _reduce_in_strips(img, strips, 3, 2003 * 4 * 100)
+                with Image.open(path) as img:
+                    expected = img.convert("RGB").reduce(3)
+                self.assertEqual(reduced.size, expected.size)
+                self.assertEqual(reduced.convert("RGB").tobytes(), expected.tobytes())
+
+    @override_settings(PHOTO_MAX_IMAGE_PIXELS=2_000_000)
+    def test_over_hard_limit_is_refused(self):
+        with self.assertRaises(ImageTooLarge):
+            check_pixels(2000, 1001)
+        path = self._path("hard.jpg")
+        _write_sample(path, 2000, 1200, "JPEG")
+        with Image.open(path) as img, self.assertRaises(ImageTooLarge):
+            downscale_image(img, (1024, 1024))
+
+    def test_compressed_image_over_memory_limit_is_refused(self):
+        # a PNG can only be decoded whole, and 24MP does not fit in 48MiB
+        path = self._path("whole.png")
+        _write_sample(path, 6000, 4000, "PNG", compress_level=1)
+        _, _, refused = run_isolated(_downscale, [("png", path)])
+        self.assertTrue(refused)
+
+
+def _sample_upload(name, seed):
+    return SimpleUploadedFile(name, make_sample_image(320, 240, seed=seed).read(), content_type="image/jpeg")
+
+
+# Photos saved to a temporary local storage, with the pipeline's enqueues mocked out
+@override_settings(PHOTO_ADMISSION_ENABLED=False)
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.storage = LocalStorageBackend(root=self.tmp.name)
+        self.enqueue = self.patch("photos.tasks.process_photo_task.apply_async")
+        self.patch("photos.storage._backend", new=self.storage)
+
+        self.user = CustomUser.objects.create(username="photographer", email="photographer@example.com")
+        self.event = Event.objects.create(title="Pipeline", coordinator=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def make_photo(self, **fields):
+        return Photo.objects.create(photographer=self.user, event=self.event, **fields)
+
+    def initiate_upload(self, **data):
+        data = {"event": str(self.event.id), "content_type": "image/jpeg", **data}
+        return self.client.post("/photos/initiate-upload/", data, format="json")
+
+    def bulk_upload(self, *names, seed=0):
+        images = [_sample_upload(name, seed + i) for i, name in enumerate(names)]
+        metadata = json.dumps([{"client_id": name} for name in names])
+        return self.client.post(f"/events/{self.event.id}/photos/bulk-upload/",
+                                {"images": images, "metadata": metadata}, format="multipart")
+
+
+class ReaperTests(PipelineTestCase):
+    @override_settings(PHOTO_STUCK_AFTER_SECONDS=600)
+    def test_bulk_upload_is_redriven_when_message_is_lost(self):
+        response = self.bulk_upload("a.jpg", "b.jpg")
+        self.assertEqual(response.status_code, 207)
+        ids = [result["photo_id"] for result in response.json()["results"]]
+        self.assertEqual(self.enqueue.call_count, 2)
+        self.assertEqual(set(Photo.objects.filter(id__in=ids).values_list("status", flat=True)),
+                         {Photo.PhotoStatus.PROCESSING})
+
+        Photo.objects.filter(id__in=ids).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual({str(photo.id) for photo in stuck_photos()}, set(ids))
+
+    @override_settings(PHOTO_STUCK_AFTER_SECONDS=600)
+    def test_photo_with_stale_lease_is_redriven(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        stale = self.make_photo(status=Photo.PhotoStatus.PROCESSING)
+        live = self.make_photo(status=Photo.PhotoStatus.PROCESSING)
+        _acquire_lease(stale.id)
+        _acquire_lease(live.id)
+        Photo.objects.filter(id=stale.id).update(processing_lease_until=an_hour_ago, updated_at=an_hour_ago)
+        Photo.objects.filter(id=live.id).update(updated_at=an_hour_ago)
+
+        self.assertEqual(reap_photos(), {"redriven": 1, "dead_lettered": 0})
+        self.enqueue.assert_called_once()
+        self.assertEqual(self.enqueue.call_args.args[0], (str(stale.id),))
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, Photo.PhotoStatus.PROCESSING)
+        self.assertEqual(stale.redrive_count, 1)
+        self.assertIsNone(stale.processing_token)
+        self.assertIn("reaper", stale.processing_history[0]["errors"])
+
+        # the re-driven photo is not picked up again by an overlapping sweep
+        self.assertEqual(reap_photos(), {"redriven": 0, "dead_lettered": 0})
+
+    @override_settings(PHOTO_STUCK_AFTER_SECONDS=600, PHOTO_REDRIVE_DELAY_SECONDS=600, PHOTO_MAX_REDRIVES=3)
+    def test_photo_is_dead_lettered_after_redrive_limit(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        stuck = self.make_photo(status=Photo.PhotoStatus.PROCESSING, redrive_count=3)
+        failed = self.make_photo(status=Photo.PhotoStatus.FAILED, redrive_count=3,
+                                 processing_errors={"decode": "broken"})
+        retried = self.make_photo(status=Photo.PhotoStatus.FAILED, redrive_count=2,
+                                  processing_errors={"download": "timed out"})
+        Photo.objects.filter(id__in=[stuck.id, failed.id, retried.id]).update(updated_at=an_hour_ago)
+
+        self.assertEqual(reap_photos(), {"redriven": 1, "dead_lettered": 2})
+        self.assertEqual(self.enqueue.call_args.args[0], (str(retried.id),))
+
+        stuck.refresh_from_db()
+        self.assertEqual(stuck.status, Photo.PhotoStatus.FAILED)
+        self.assertEqual(stuck.dead_letter.reason, PhotoDeadLetter.Reason.STUCK)
+        failed.refresh_from_db()
+        self.assertEqual(failed.dead_letter.reason, PhotoDeadLetter.Reason.FAILED)
+        self.assertEqual(failed.dead_letter.attempts, 3)
+        self.assertEqual(failed.dead_letter.history[-1]["errors"], {"decode": "broken"})
+
+        # dead-lettered photos are left alone by later sweeps
+        Photo.objects.filter(id__in=[stuck.id, failed.id]).update(updated_at=an_hour_ago)
+        self.assertEqual(reap_photos(), {"redriven": 0, "dead_lettered": 0})
+
+
+class DirectUploadTests(PipelineTestCase):
+    def test_finalize_enqueues_once(self):
+        photo = Photo.objects.get(id=self.initiate_upload().json()["id"])
+        self.storage.upload(photo.original_path, make_sample_image(320, 240))
+        Photo.objects.filter(id=photo.id).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        response = self.client.post(f"/photos/{photo.id}/finalize/")
+        self.assertEqual(response.status_code, 200)
+        finalized = Photo.objects.get(id=photo.id)
+        self.assertEqual(finalized.status, Photo.PhotoStatus.PROCESSING)
+        self.assertGreater(finalized.updated_at, timezone.now() - timedelta(minutes=1))
+
+        response = self.client.post(f"/photos/{photo.id}/finalize/")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.enqueue.call_count, 1)
+
+    def test_concurrent_finalize_enqueues_once(self):
+        photo = Photo.objects.get(id=self.initiate_upload().json()["id"])
+        self.storage.upload(photo.original_path, make_sample_image(320, 240))
+
+        # another finalize moves the photo on between this one's status check and its update
+        def exists(path):
+            Photo.objects.filter(id=photo.id).update(status=Photo.PhotoStatus.PROCESSING)
+            return True
+
+        with mock.patch.object(self.storage, "exists", exists):
+            response = self.client.post(f"/photos/{photo.id}/finalize/")
+        self.assertEqual(response.status_code, 400)
+        self.enqueue.assert_not_called()
+
+
+class LeaseTests(PipelineTestCase):
+    def test_duplicate_delivery_is_skipped_while_lease_is_held(self):
+        photo = self.make_photo(status=Photo.PhotoStatus.PROCESSING)
+        with mock.patch("photos.tasks.chain") as chain:
+            process_photo_task(str(photo.id))
+            self.assertIsNone(process_photo_task(str(photo.id)))
+        self.assertEqual(chain.call_count, 1)
+
+    def test_expired_lease_is_taken_over(self):
+        photo = self.make_photo(status=Photo.PhotoStatus.PROCESSING)
+        first = _acquire_lease(photo.id)
+        self.assertIsNone(_acquire_lease(photo.id))
+
+        Photo.objects.filter(id=photo.id).update(processing_lease_until=timezone.now() - timedelta(seconds=1))
+        second = _acquire_lease(photo.id)
+        self.assertIsNotNone(second)
+        self.assertNotEqual(first, second)
+
+    def test_finalize_of_superseded_run_is_dropped(self):
+        photo = self.make_photo(status=Photo.PhotoStatus.PROCESSING)
+        stale = _acquire_lease(photo.id)
+        Photo.objects.filter(id=photo.id).update(processing_lease_until=timezone.now() - timedelta(seconds=1))
+        current = _acquire_lease(photo.id)
+
+        finalize_photo_task([{"photo_id": str(photo.id), "lock": stale, "width": 320, "height": 240}])
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.PhotoStatus.PROCESSING)
+        self.assertIsNone(photo.width)
+        self.assertEqual(str(photo.processing_token), current)
+
+        finalize_photo_task([{"photo_id": str(photo.id), "lock": current, "width": 320, "height": 240}])
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.PhotoStatus.COMPLETED)
+        self.assertEqual(photo.width, 320)
+        self.assertIsNone(photo.processing_token)
+
+
+@override_settings(PHOTO_ADMISSION_ENABLED=True, PHOTO_ADMISSION_MAX_QUEUED=100, PHOTO_ADMISSION_MAX_BULK_QUEUED=10,
+                   PHOTO_ADMISSION_MAX_IN_FLIGHT=1000, PHOTO_ADMISSION_MAX_IN_FLIGHT_PER_USER=5,
+                   PHOTO_ADMISSION_RETRY_AFTER=30)
+class AdmissionTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backlog = self.patch("photos.admission.backlog", return_value=(0, 0))
+        self.own = self.patch("photos.admission.user_in_flight", return_value=0)
+        self.track = self.patch("photos.views.track_in_flight")
+
+    def assertRefused(self, response, status_code):
+        self.assertEqual(response.status_code, status_code)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertFalse(Photo.objects.exists())
+        self.enqueue.assert_not_called()
+
+    def test_upload_is_refused_while_queues_are_backed_up(self):
+        self.backlog.return_value = (100, 0)
+        self.assertRefused(self.initiate_upload(), 503)
+
+    def test_upload_is_refused_while_too_many_photos_are_in_flight(self):
+        self.backlog.return_value = (0, 1000)
+        self.assertRefused(self.initiate_upload(), 503)
+
+    def test_bulk_upload_has_a_lower_queue_limit(self):
+        self.backlog.return_value = (10, 0)
+        self.assertRefused(self.bulk_upload("a.jpg"), 503)
+        self.assertEqual(self.initiate_upload().status_code, 201)
+
+    def test_photographer_over_own_limit_is_throttled(self):
+        self.own.return_value = 4
+        self.assertRefused(self.bulk_upload("a.jpg", "b.jpg"), 429)
+        self.assertEqual(self.bulk_upload("a.jpg").status_code, 207)
+
+    def test_batch_over_limit_is_admitted_with_nothing_in_flight(self):
+        names = [f"{i}.jpg" for i in range(6)]
+        self.assertEqual(self.bulk_upload(*names).status_code, 207)
+        self.assertEqual(self.enqueue.call_count, 6)
+        self.assertEqual(len(self.track.call_args.args[0]), 6)
+
+    def test_upload_is_admitted_when_redis_is_unreachable(self):
+        self.backlog.side_effect = redis.ConnectionError("refused")
+        self.assertEqual(self.initiate_upload().status_code, 201)
+
+
+class DeduplicationTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = make_sample_image(320, 240, seed=1).read()
+        self.content_hash = hashlib.sha256(self.content).hexdigest()
+
+    def processed_photo(self, photographer=None):
+        photo = Photo.objects.create(
+            photographer=photographer or self.user, event=self.event, status=Photo.PhotoStatus.COMPLETED,
+            content_hash=self.content_hash, original_path=content_path(self.content_hash, "jpg"),
+            width=320, height=240, variants=[{"size": 320}], auto_tags=["dog"],
+        )
+        self.storage.upload(photo.original_path, SimpleUploadedFile("a.jpg", self.content))
+        return photo
+
+    def test_direct_upload_reuses_processed_duplicate(self):
+        source = self.processed_photo()
+        photo = Photo.objects.get(id=self.initiate_upload().json()["id"])
+        uploaded_path = photo.original_path
+        self.storage.upload(uploaded_path, SimpleUploadedFile("b.jpg", self.content))
+
+        result = prepare_photo_task(str(photo.id))
+        self.assertEqual(result["reused_from"], str(source.id))
+        photo.refresh_from_db()
+        self.assertEqual(photo.status, Photo.PhotoStatus.COMPLETED)
+        self.assertEqual((photo.variants, photo.auto_tags), (source.variants, source.auto_tags))
+        self.assertEqual(photo.original_path, source.original_path)
+        # the redundant upload is deleted, the shared original is kept
+        self.assertFalse(self.storage.exists(uploaded_path))
+        self.assertTrue(self.storage.exists(source.original_path))
+
+    def test_bulk_upload_reuses_processed_duplicate(self):
+        source = self.processed_photo()
+        response = self.client.post(f"/events/{self.event.id}/photos/bulk-upload/", {
+            "images": [SimpleUploadedFile("a.jpg", self.content, content_type="image/jpeg")],
+            "metadata": json.dumps([{"client_id": "a.jpg"}]),
+        }, format="multipart")
+        result = response.json()["results"][0]
+        self.assertTrue(result["deduplicated"])
+        self.enqueue.assert_not_called()
+        photo = Photo.objects.get(id=result["photo_id"])
+        self.assertEqual(photo.original_path, source.original_path)
+        self.assertEqual(photo.auto_tags, source.auto_tags)
+
+    def test_client_hash_is_trusted_for_own_photos(self):
+        source = self.processed_photo()
+        response = self.initiate_upload(content_hash=self.content_hash.upper())
+        self.assertEqual(response.json()["status"], Photo.PhotoStatus.COMPLETED)
+        self.assertIsNone(response.json()["upload"])
+        self.assertEqual(Photo.objects.get(id=response.json()["id"]).variants, source.variants)
+
+    def test_client_hash_is_not_trusted_for_other_photographers_photos(self):
+        other = CustomUser.objects.create(username="other", email="other@example.com")
+        self.processed_photo(photographer=other)
+        response = self.initiate_upload(content_hash=self.content_hash)
+        self.assertEqual(response.json()["status"], Photo.PhotoStatus.PENDING)
+        self.assertIsNotNone(response.json()["upload"])
+        photo = Photo.objects.get(id=response.json()["id"])
+        self.assertEqual(photo.variants, [])
+        self.assertEqual(photo.content_hash, "")
+
+
+def _embedding(seed):
+    vector = np.random.default_rng(seed).standard_normal(64).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).astype(np.float16)
+
+
+class EmbeddingIndexTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photos = [self.make_photo(embedding=_embedding(seed).tobytes()) for seed in range(10)]
+        self.index = EmbeddingIndex()
+        self.index.sync(force=True)
+
+    def search_all(self, seed):
+        ids, _ = self.index.search(_embedding(seed).astype(np.float32), 20)
+        return ids
+
+    def test_deleted_photo_is_evicted_in_deleting_process(self):
+        self.patch("photos.semantic._index", new=self.index)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.photos[3].delete()
+        self.assertEqual(len(self.index), 9)
+        self.assertNotIn(self.photos[3].id, self.search_all(3))
+        self.assertEqual(len(self.search_all(3)), 9)
+
+    @override_settings(PHOTO_SEMANTIC_PRUNE_SECONDS=0)
+    def test_photos_deleted_elsewhere_are_pruned_on_sync(self):
+        Photo.objects.filter(id__in=[self.photos[0].id, self.photos[5].id]).delete()
+        Photo.objects.filter(id=self.photos[7].id).update(embedding=None)
+        self.index.sync(force=True)
+        self.assertEqual(len(self.index), 7)
+        self.assertFalse({self.photos[0].id, self.photos[5].id, self.photos[7].id} & set(self.search_all(0)))
+
+    def test_evicted_rows_are_reused(self):
+        self.index.remove([self.photos[2].id])
+        photo = self.make_photo(embedding=_embedding(99).tobytes())
+        self.index.add(photo.id, photo.embedding)
+        self.assertEqual(len(self.index), 10)
+        self.assertEqual(self.search_all(99)[0], photo.id)
+        self.assertNotIn(self.photos[2].id, self.search_all(2))
+
+
+class SimilarityIndexTests(PipelineTestCase):
+    def test_delta_holds_only_photos_embedded_since_the_build(self):
+        photos = [self.make_photo(embedding=_embedding(seed).tobytes(), embedded_at=timezone.now())
+                  for seed in range(40)]
+        with override_settings(PHOTO_ANN_INDEX_PATH=os.path.join(self.tmp.name, "ann"), PHOTO_ANN_PQ_M=8):
+            index = build_similarity_index()
+
+            # an edit that leaves the embedding alone moves updated_at, but stays out of the delta
+            photos[0].save()
+            photos[1].embedding = _embedding(100).tobytes()
+            photos[1].embedded_at = timezone.now()
+            photos[1].save()
+
+            delta_ids, delta_vectors = _LoadedIndex().delta(index)
+        self.assertEqual(delta_ids, [photos[1].id])
+        self.assertEqual(len(delta_vectors), 1)
@@ -0,0 +1,38 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+# Hashes uploads as their chunks arrive, so deduplication does not read them a second time
+class ContentHashMixin:
+    def new_file(self, *args, **kwargs):
+        # before super(): the memory handler claims the file by raising StopFutureHandlers
+        self.content_hash = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.hashing:
+            self.content_hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.content_hash.hexdigest()
+        return file
+
+    @property
+    def hashing(self):
+        return True
+
+
+class HashingMemoryFileUploadHandler(ContentHashMixin, MemoryFileUploadHandler):
+
+    @property
+    def hashing(self):
+        # files over FILE_UPLOAD_MAX_MEMORY_SIZE pass through to the temporary file handler, which hashes them
+        return self.activated
+
+
+class HashingTemporaryFileUploadHandler(ContentHashMixin, TemporaryFileUploadHandler):
+    pass
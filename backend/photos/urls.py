@@ -1,7 +1,8 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from photos.views import PhotoView, PhotoShareCreateView, PhotoShareDetailView, PhotoSearchView, PhotosTaggedInView
+from photos.views import PhotoView, PhotoShareCreateView, PhotoShareDetailView, PhotoSearchView, PhotosTaggedInView, \
+    LocalMediaView, PhotoSemanticSearchView, PhotoPipelineStatusView
 
 router = DefaultRouter()
 router.register('', PhotoView, 'photos')
@@ -11,6 +12,11 @@ urlpatterns = [
         PhotoSearchView.as_view(),
         name="photo-search",
     ),
+    path(
+        "search/semantic/",
+        PhotoSemanticSearchView.as_view(),
+        name="photo-semantic-search",
+    ),
     path(
         "<uuid:photo_id>/share/",
         PhotoShareCreateView.as_view(),
@@ -21,6 +27,12 @@ urlpatterns = [
         PhotoShareDetailView.as_view(),
         name="photo-share-detail",
     ),
+    path(
+        "pipeline/status/",
+        PhotoPipelineStatusView.as_view(),
+        name="photo-pipeline-status",
+    ),
     path('photos-tagged-in/', PhotosTaggedInView.as_view(), name='photos_tagged_in'),
+    path('local-media/<path:path>', LocalMediaView.as_view(), name='photo-local-media'),
     path('', include(router.urls)),
 ]
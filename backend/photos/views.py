@@ -1,10 +1,16 @@
+import mimetypes
+
+from django.conf import settings
 from django.db.models import Q
+from django.http import FileResponse, Http404
 from django.utils import timezone
 from rest_framework import viewsets, parsers, generics, permissions, status
+from rest_framework.decorators import action
 from rest_framework.generics import get_object_or_404
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from events.models import Event
 from events.permissions import EventPermission
@@ -12,10 +18,18 @@ from notifications.models import Notification
 from notifications.services import create_notification
 from photos.models import Photo, PhotoShare
 from photos.permissions import PhotoReadPermission, ReadPerm, IsPhotographer, PhotoShareCreatePermission, \
-    PhotoShareRevokePermission, PhotoUploadPermission, PhotoDeletePermission
+    PhotoShareRevokePermission, PhotoUploadPermission, PhotoDeletePermission, IsAdminRole, readable_photos
 from photos.serializers import PhotoReadSerializer, PhotoListSerializer, PhotoWriteSerializer, PhotoShareSerializer, \
-    PhotoBulkUploadSerializer, PhotoSearchSerializer
-from photos.services import PhotoSearchService
+    PhotoBulkUploadSerializer, PhotoSearchSerializer, PhotoUploadInitiateSerializer, PhotoHashCheckSerializer, \
+    PhotoSemanticSearchSerializer, PhotoSemanticResultSerializer
+from photos.services import PhotoSearchService, find_processed_duplicates
+from photos.admission import check_admission, track_in_flight
+from photos.ann import similar_photos
+from photos.queues import queue_depths
+from photos.reaper import pipeline_counts
+from photos.semantic import semantic_search
+from photos.similarity import collapse_bursts
+from photos.storage import get_storage_backend, LocalStorageBackend
 from photos.tasks import process_photo_task
 from utils.user_utils import user_is_admin, user_is_img
 
@@ -25,7 +39,11 @@ class PhotoView(viewsets.ModelViewSet):
     parser_classes = [parsers.MultiPartParser, parsers.FormParser]
 
     def perform_create(self, serializer):
+        check_admission(self.request.user)
         photo = serializer.save(status=Photo.PhotoStatus.PROCESSING)
+        self._start_processing(photo)
+
+    def _start_processing(self, photo):
         create_notification(
             recipient=photo.event.coordinator,
             verb=Notification.NotificationVerb.EVENT_PHOTO_ADDED,
@@ -35,13 +53,88 @@ class PhotoView(viewsets.ModelViewSet):
             dedupe_key=f"event_add:{photo.event.id}:actor:{self.request.user.id}",
             data={"count": 1}
         )
-        process_photo_task.delay(photo.id)
+        # duplicates of already processed content are completed from the original's results
+        if photo.status == Photo.PhotoStatus.PROCESSING:
+            process_photo_task.apply_async((photo.id,), {"priority": settings.PHOTO_UPLOAD_PRIORITY},
+                                           priority=settings.PHOTO_UPLOAD_PRIORITY)
+            track_in_flight([photo.id], photo.photographer_id)
+
+    @action(detail=False, methods=['post'], url_path='initiate-upload', parser_classes=[parsers.JSONParser])
+    def initiate_upload(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        check_admission(request.user)
+        photo = serializer.save()
+        if photo.status == Photo.PhotoStatus.COMPLETED:
+            self._start_processing(photo)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    # more like this: visually similar photos the user can read, across events. ?k= (default 20)
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        photo = self.get_object()
+        if not photo.embedding:
+            return Response({"detail": "Photo has not been processed yet"}, status=status.HTTP_409_CONFLICT)
+
+        try:
+            k = min(int(request.query_params.get("k", 20)), settings.PHOTO_SEMANTIC_MAX_RESULTS)
+        except ValueError:
+            return Response({"k": ["A valid integer is required."]}, status=status.HTTP_400_BAD_REQUEST)
+        if k < 1:
+            return Response({"k": ["Must be at least 1."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        matches = similar_photos(photo, readable_photos(request.user, Photo.objects.all()), k)
+        scores = dict(matches)
+        photos = {p.id: p for p in Photo.objects.filter(id__in=scores)}
+        ordered = [photos[photo_id] for photo_id, _ in matches if photo_id in photos]
+        context = {**self.get_serializer_context(), 'scores': scores}
+        return Response({
+            'count': len(ordered),
+            'results': PhotoSemanticResultSerializer(ordered, many=True, context=context).data,
+        })
+
+    # "existing" hashes can be created through initiate-upload without an upload; "in_event" ones are
+    # already in the event
+    @action(detail=False, methods=['post'], url_path='check-hashes', parser_classes=[parsers.JSONParser])
+    def check_hashes(self, request):
+        serializer = PhotoHashCheckSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        hashes = serializer.validated_data["hashes"]
+        event = serializer.validated_data.get("event")
+
+        own = Photo.objects.filter(photographer=request.user)
+        existing = find_processed_duplicates(hashes, own)
+        in_event = set()
+        if event is not None:
+            in_event = set(own.filter(event=event, content_hash__in=hashes).values_list("content_hash", flat=True))
+
+        return Response({"existing": sorted(existing), "in_event": sorted(in_event)})
+
+    @action(detail=True, methods=['post'], parser_classes=[parsers.JSONParser])
+    def finalize(self, request, pk=None):
+        photo = self.get_object()
+        if photo.status != Photo.PhotoStatus.PENDING:
+            return Response({"detail": "Upload is already finalized"}, status=status.HTTP_400_BAD_REQUEST)
+        if not photo.original_path or not get_storage_backend().exists(photo.original_path):
+            return Response({"detail": "Uploaded image not found in storage"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # only one of concurrent finalize calls moves the photo on and enqueues it
+        now = timezone.now()
+        if not Photo.objects.filter(id=photo.id, status=Photo.PhotoStatus.PENDING).update(
+                status=Photo.PhotoStatus.PROCESSING, updated_at=now):
+            return Response({"detail": "Upload is already finalized"}, status=status.HTTP_400_BAD_REQUEST)
+        photo.status = Photo.PhotoStatus.PROCESSING
+        photo.updated_at = now
+        self._start_processing(photo)
+        return Response(PhotoReadSerializer(photo, context={"request": request}).data)
 
     def get_serializer_class(self):
         if self.action == 'list':
             return PhotoListSerializer
         elif self.action == 'retrieve':
             return PhotoReadSerializer
+        elif self.action == 'initiate_upload':
+            return PhotoUploadInitiateSerializer
         return PhotoWriteSerializer
 
     def get_permissions(self):
@@ -50,11 +143,11 @@ class PhotoView(viewsets.ModelViewSet):
 
         if self.action == 'create':
             return [IsAuthenticated()]
-        elif self.action == 'retrieve':
+        elif self.action in ('retrieve', 'similar'):
             return [PhotoReadPermission()]
         elif self.action == 'list':
             return [IsAuthenticated()]
-        elif self.action in ("update", "partial_update"):
+        elif self.action in ("update", "partial_update", "finalize"):
             return [IsPhotographer()]
         elif self.action == 'destroy':
             return [PhotoDeletePermission()]
@@ -93,6 +186,16 @@ class EventPhotosView(generics.ListAPIView):
             return qs.filter(q_coord | q_img | q_public | q_photographer).distinct()
         return qs.filter(q_coord | q_public | q_photographer).distinct()
 
+    # ?collapse_bursts=true lists one photo per burst of near-identical frames, with burst_count
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get("collapse_bursts", "").lower() not in ("1", "true"):
+            return super().list(request, *args, **kwargs)
+
+        qs, burst_counts = collapse_bursts(self.kwargs["event_id"], self.filter_queryset(self.get_queryset()))
+        context = {**self.get_serializer_context(), "burst_counts": burst_counts}
+        serializer = self.get_serializer_class()(qs, many=True, context=context)
+        return Response(serializer.data)
+
 
 class PhotosTaggedInView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
@@ -121,14 +224,21 @@ class PhotoBulkUploadView(generics.CreateAPIView):
             context={'event': event, 'request': request}
         )
         serializer.is_valid(raise_exception=True)
+        check_admission(request.user, count=len(serializer.validated_data["images"]), bulk=True)
         results = serializer.save()
 
         count = 0
+        enqueued = []
         for r in results:
             if r.get("status") != "created":
                 continue
             count += 1
-            process_photo_task.delay(r['photo_id'])
+            if not r.get("deduplicated"):
+                # behind single uploads, see CELERY_BROKER_TRANSPORT_OPTIONS
+                process_photo_task.apply_async((r['photo_id'],), {"priority": settings.PHOTO_BULK_UPLOAD_PRIORITY},
+                                               priority=settings.PHOTO_BULK_UPLOAD_PRIORITY)
+                enqueued.append(r['photo_id'])
+        track_in_flight(enqueued, request.user.id)
 
         if count > 0:
             create_notification(
@@ -223,3 +333,86 @@ class PhotoSearchView(generics.ListAPIView):
         }
 
         return Response(response_data)
+
+
+# ?q=guitarist under red lights&k=20, with the filters of PhotoSearchView
+class PhotoSemanticSearchView(PhotoSearchView):
+    serializer_class = PhotoSemanticResultSerializer
+
+    def list(self, request, *args, **kwargs):
+        search_params = request.query_params.dict()
+        tags = request.query_params.getlist('tags')
+        if tags:
+            search_params['tags'] = tags
+
+        serializer = PhotoSemanticSearchSerializer(data=search_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = dict(serializer.validated_data)
+        text = filters.pop('q')
+        k = filters.pop('k')
+
+        filtered_qs = PhotoSearchService(self.get_queryset()).search(**filters)
+        matches = semantic_search(text, filtered_qs, k)
+
+        scores = dict(matches)
+        photos = {photo.id: photo for photo in Photo.objects.filter(id__in=scores)}
+        ordered = [photos[photo_id] for photo_id, _ in matches if photo_id in photos]
+        context = {**self.get_serializer_context(), 'scores': scores}
+        serialized = self.get_serializer_class()(ordered, many=True, context=context)
+        return Response({
+            'count': len(ordered),
+            'results': serialized.data,
+        })
+
+
+# Admin overview of the processing pipeline: broker queue depths and photo counts by state
+class PhotoPipelineStatusView(APIView):
+    permission_classes = [IsAuthenticated, IsAdminRole]
+
+    def get(self, request):
+        return Response({
+            "queues": queue_depths(),
+            **pipeline_counts(),
+        })
+
+
+# Serves objects of the local storage backend to holders of a valid signed URL
+class LocalMediaView(APIView):
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, path):
+        backend = get_storage_backend()
+        if not isinstance(backend, LocalStorageBackend):
+            raise Http404()
+
+        signature = request.query_params.get("signature")
+        expires = request.query_params.get("expires")
+        if not backend.verify(path, signature, expires):
+            return Response({"detail": "Invalid or expired signature"}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            file = backend.open(path)
+        except (FileNotFoundError, ValueError):
+            raise Http404()
+        return FileResponse(file, content_type=mimetypes.guess_type(path)[0])
+
+    def put(self, request, path):
+        backend = get_storage_backend()
+        if not isinstance(backend, LocalStorageBackend):
+            raise Http404()
+
+        signature = request.query_params.get("signature")
+        expires = request.query_params.get("expires")
+        if not backend.verify(path, signature, expires, method="PUT"):
+            return Response({"detail": "Invalid or expired signature"}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            backend.write_stream(path, request.stream, settings.PHOTO_UPLOAD_MAX_BYTES)
+        except FileExistsError:
+            return Response({"detail": "Object already uploaded"}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        return Response(status=status.HTTP_200_OK)
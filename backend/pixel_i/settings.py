@@ -145,3 +145,177 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+CLIP_MODEL_NAME = os.getenv("CLIP_MODEL_NAME", "ViT-B/32")
+
+# Loading CLIP in worker_process_init takes longer than celery's default 4s
+CELERY_WORKER_PROC_ALIVE_TIMEOUT = int(os.getenv("CELERY_WORKER_PROC_ALIVE_TIMEOUT", "120"))
+
+# quality | balanced | fast: how aggressively originals are decoded at reduced scale before resizing
+PHOTO_DOWNSCALE_MODE = os.getenv("PHOTO_DOWNSCALE_MODE", "balanced")
+
+PHOTO_WATERMARK_LOGO_PATH = os.getenv("PHOTO_WATERMARK_LOGO_PATH", str(BASE_DIR / "pixel-i.png"))
+# <top|center|bottom>-<left|center|right>
+PHOTO_WATERMARK_POSITION = os.getenv("PHOTO_WATERMARK_POSITION", "bottom-right")
+PHOTO_WATERMARK_SCALE = float(os.getenv("PHOTO_WATERMARK_SCALE", "0.25"))
+PHOTO_WATERMARK_PADDING = int(os.getenv("PHOTO_WATERMARK_PADDING", "20"))
+PHOTO_WATERMARK_WIDTH_BUCKET = int(os.getenv("PHOTO_WATERMARK_WIDTH_BUCKET", "16"))
+
+# Responsive variant ladder: longest-edge sizes in pixels, encoded in each format Pillow supports
+PHOTO_VARIANT_SIZES = [int(size) for size in os.getenv("PHOTO_VARIANT_SIZES", "160,320,640,1280,2048").split(",") if size]
+PHOTO_VARIANT_FORMATS = [fmt.strip().upper() for fmt in os.getenv("PHOTO_VARIANT_FORMATS", "WEBP").split(",") if fmt]
+PHOTO_VARIANT_QUALITY = int(os.getenv("PHOTO_VARIANT_QUALITY", "80"))
+PHOTO_VARIANT_WATERMARK_MIN_SIZE = int(os.getenv("PHOTO_VARIANT_WATERMARK_MIN_SIZE", "640"))
+
+# Concurrent storage uploads per process; also the size of the storage client's connection pool
+PHOTO_UPLOAD_CONCURRENCY = int(os.getenv("PHOTO_UPLOAD_CONCURRENCY", "8"))
+
+# Originals are streamed to a temporary file in chunks (must be a multiple of 256 KiB)
+PHOTO_DOWNLOAD_CHUNK_SIZE = int(os.getenv("PHOTO_DOWNLOAD_CHUNK_SIZE_MB", "8")) * 1024 * 1024
+PHOTO_DOWNLOAD_TMP_DIR = os.getenv("PHOTO_DOWNLOAD_TMP_DIR") or None
+
+# firebase | local | dotted path to a photos.storage.StorageBackend subclass
+PHOTO_STORAGE_BACKEND = os.getenv("PHOTO_STORAGE_BACKEND", "firebase")
+PHOTO_STORAGE_LOCAL_ROOT = os.getenv("PHOTO_STORAGE_LOCAL_ROOT", str(BASE_DIR / "storage"))
+PHOTO_STORAGE_LOCAL_BASE_URL = os.getenv("PHOTO_STORAGE_LOCAL_BASE_URL", "/photos/local-media/")
+# HMAC key for local storage URLs; falls back to SECRET_KEY
+PHOTO_STORAGE_SIGNING_KEY = os.getenv("PHOTO_STORAGE_SIGNING_KEY", "")
+
+# Direct-to-storage uploads: lifetime of the signed upload URL and the largest accepted original
+PHOTO_UPLOAD_URL_TTL = int(os.getenv("PHOTO_UPLOAD_URL_TTL", "900"))
+PHOTO_UPLOAD_MAX_BYTES = int(os.getenv("PHOTO_UPLOAD_MAX_MB", "50")) * 1024 * 1024
+
+# Chords in the photo pipeline need a result backend
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/1")
+CELERY_RESULT_EXPIRES = timedelta(hours=6)
+
+# process_photo_task fans out into stages on separate queues so each can be scaled on its own, e.g.
+#   celery -A pixel_i worker -Q photos.io  -c 16 --prefetch-multiplier 4
+#   celery -A pixel_i worker -Q photos.cpu -c <cores> --prefetch-multiplier 1
+#   celery -A pixel_i worker -Q photos.ml  -c 1 --prefetch-multiplier 1
+PHOTO_QUEUE_IO = os.getenv("PHOTO_QUEUE_IO", "photos.io")
+PHOTO_QUEUE_CPU = os.getenv("PHOTO_QUEUE_CPU", "photos.cpu")
+PHOTO_QUEUE_ML = os.getenv("PHOTO_QUEUE_ML", "photos.ml")
+CELERY_TASK_ROUTES = {
+    "photos.tasks.process_photo_task": {"queue": PHOTO_QUEUE_IO},
+    "photos.tasks.prepare_photo_task": {"queue": PHOTO_QUEUE_CPU},
+    "photos.tasks.variants_photo_task": {"queue": PHOTO_QUEUE_CPU},
+    "photos.tasks.tag_photo_task": {"queue": PHOTO_QUEUE_ML},
+    "photos.tasks.finalize_photo_task": {"queue": PHOTO_QUEUE_IO},
+    "photos.tasks.build_similarity_index_task": {"queue": PHOTO_QUEUE_CPU},
+    "photos.tasks.retag_photos_task": {"queue": PHOTO_QUEUE_ML},
+    "photos.tasks.reap_stuck_photos_task": {"queue": PHOTO_QUEUE_IO},
+}
+
+# Shared CLIP inference server (manage.py run_inference_server). When the socket is set, tagging
+# workers send preprocessed tensors there instead of loading CLIP themselves.
+CLIP_INFERENCE_SOCKET = os.getenv("CLIP_INFERENCE_SOCKET", "")
+CLIP_INFERENCE_FALLBACK_LOCAL = os.getenv("CLIP_INFERENCE_FALLBACK_LOCAL", "true").lower() == "true"
+CLIP_INFERENCE_TIMEOUT = float(os.getenv("CLIP_INFERENCE_TIMEOUT", "30"))
+CLIP_INFERENCE_MAX_BATCH = int(os.getenv("CLIP_INFERENCE_MAX_BATCH", "32"))
+CLIP_INFERENCE_MAX_WAIT_MS = float(os.getenv("CLIP_INFERENCE_MAX_WAIT_MS", "10"))
+CLIP_INPUT_RESOLUTION = int(os.getenv("CLIP_INPUT_RESOLUTION", "224"))
+
+# CPU inference mode for the CLIP image encoder: fp32 | int8 | torchscript | int8-torchscript
+# (compare accuracy and speed with manage.py benchmark_clip_modes). Ignored on GPU.
+CLIP_INFERENCE_MODE = os.getenv("CLIP_INFERENCE_MODE", "fp32")
+# torch intra-op / inter-op threads per process; 0 keeps torch's default (all cores). Set this to
+# cores / worker concurrency so prefork children do not oversubscribe the CPU.
+CLIP_TORCH_THREADS = int(os.getenv("CLIP_TORCH_THREADS", "0"))
+CLIP_TORCH_INTEROP_THREADS = int(os.getenv("CLIP_TORCH_INTEROP_THREADS", "0"))
+
+# Uploads are hashed while they stream in (photos.uploadhandlers) for content-hash deduplication
+FILE_UPLOAD_HANDLERS = [
+    "photos.uploadhandlers.HashingMemoryFileUploadHandler",
+    "photos.uploadhandlers.HashingTemporaryFileUploadHandler",
+]
+
+# Burst grouping: photos whose perceptual hashes differ in at most this many of 64 bits are one burst
+PHOTO_BURST_MAX_DISTANCE = int(os.getenv("PHOTO_BURST_MAX_DISTANCE", "6"))
+# Events whose near-duplicate index is kept in memory per process
+PHOTO_HASH_INDEX_CACHE_SIZE = int(os.getenv("PHOTO_HASH_INDEX_CACHE_SIZE", "32"))
+
+# Semantic search: how often each process picks up embeddings saved by other processes, and the
+# largest number of results one query may ask for. Candidates from the whole index are checked against
+# what the user may read until they cover this fraction of it; past that the readable photos are few,
+# and their embeddings are scored directly. PRUNE is how often photos deleted elsewhere are evicted
+PHOTO_SEMANTIC_SYNC_SECONDS = int(os.getenv("PHOTO_SEMANTIC_SYNC_SECONDS", "10"))
+PHOTO_SEMANTIC_PRUNE_SECONDS = int(os.getenv("PHOTO_SEMANTIC_PRUNE_SECONDS", "300"))
+PHOTO_SEMANTIC_MAX_RESULTS = int(os.getenv("PHOTO_SEMANTIC_MAX_RESULTS", "100"))
+PHOTO_SEMANTIC_MAX_CANDIDATE_FRACTION = float(os.getenv("PHOTO_SEMANTIC_MAX_CANDIDATE_FRACTION", "0.05"))
+
+# "More like this" IVF-PQ index (photos.ann), memory-mapped from this directory by every process.
+# NLIST 0 picks sqrt(photo count) lists; PQ_M sub-vectors per embedding (must divide its size);
+# NPROBE lists scanned per query; RERANK re-scores the shortlist with the exact float16 vectors.
+PHOTO_ANN_INDEX_PATH = os.getenv("PHOTO_ANN_INDEX_PATH", str(BASE_DIR / "ann_index"))
+PHOTO_ANN_NLIST = int(os.getenv("PHOTO_ANN_NLIST", "0"))
+PHOTO_ANN_PQ_M = int(os.getenv("PHOTO_ANN_PQ_M", "32"))
+PHOTO_ANN_NPROBE = int(os.getenv("PHOTO_ANN_NPROBE", "16"))
+PHOTO_ANN_RERANK = os.getenv("PHOTO_ANN_RERANK", "true").lower() == "true"
+
+# Retagging from stored embeddings after the AutoTag vocabulary changes (photos.retag). Jobs wait
+# DELAY_SECONDS so a series of admin edits runs one retag; BATCH_SIZE embeddings are scored per
+# matrix multiply and UPDATE_BATCH_SIZE rows written per UPDATE.
+PHOTO_RETAG_DELAY_SECONDS = int(os.getenv("PHOTO_RETAG_DELAY_SECONDS", "60"))
+PHOTO_RETAG_BATCH_SIZE = int(os.getenv("PHOTO_RETAG_BATCH_SIZE", "20000"))
+PHOTO_RETAG_UPDATE_BATCH_SIZE = int(os.getenv("PHOTO_RETAG_UPDATE_BATCH_SIZE", "500"))
+
+# Where manage.py backfill_photos records how far it got, so an interrupted run can resume
+PHOTO_BACKFILL_CHECKPOINT = os.getenv("PHOTO_BACKFILL_CHECKPOINT", str(BASE_DIR / "backfill_checkpoint.json"))
+
+# How long a pipeline run holds a photo before another delivery may take it over; each stage
+# renews it when it starts, so this only has to cover the longest wait in a queue plus one stage
+PHOTO_PROCESSING_LEASE_SECONDS = int(os.getenv("PHOTO_PROCESSING_LEASE_SECONDS", "3600"))
+
+# Stuck-photo reaper (photos.reaper), run by celery beat: celery -A pixel_i beat. Photos PROCESSING
+# for STUCK_AFTER_SECONDS without a live lease, and FAILED ones after REDRIVE_DELAY_SECONDS, are
+# re-enqueued, at most BATCH_SIZE per sweep spread out at RATE photos/sec. After MAX_REDRIVES
+# attempts a photo goes to the dead-letter store instead.
+PHOTO_STUCK_AFTER_SECONDS = int(os.getenv("PHOTO_STUCK_AFTER_SECONDS", "1800"))
+PHOTO_REDRIVE_DELAY_SECONDS = int(os.getenv("PHOTO_REDRIVE_DELAY_SECONDS", "900"))
+PHOTO_MAX_REDRIVES = int(os.getenv("PHOTO_MAX_REDRIVES", "3"))
+PHOTO_REAPER_INTERVAL_SECONDS = int(os.getenv("PHOTO_REAPER_INTERVAL_SECONDS", "300"))
+PHOTO_REAPER_BATCH_SIZE = int(os.getenv("PHOTO_REAPER_BATCH_SIZE", "100"))
+PHOTO_REAPER_RATE = float(os.getenv("PHOTO_REAPER_RATE", "5"))
+CELERY_BEAT_SCHEDULE = {
+    "reap-stuck-photos": {
+        "task": "photos.tasks.reap_stuck_photos_task",
+        "schedule": PHOTO_REAPER_INTERVAL_SECONDS,
+    },
+}
+
+# Placeholder (LQIP) stored on each photo at upload: longest edge in pixels and JPEG quality
+PHOTO_PLACEHOLDER_SIZE = int(os.getenv("PHOTO_PLACEHOLDER_SIZE", "32"))
+PHOTO_PLACEHOLDER_QUALITY = int(os.getenv("PHOTO_PLACEHOLDER_QUALITY", "60"))
+
+# Redis priorities, 0 is the highest: bulk uploads are processed after single uploads queued before them,
+# and background work (re-drives, backfills, retags) after both
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+}
+PHOTO_UPLOAD_PRIORITY = int(os.getenv("PHOTO_UPLOAD_PRIORITY", "0"))
+PHOTO_BULK_UPLOAD_PRIORITY = int(os.getenv("PHOTO_BULK_UPLOAD_PRIORITY", "6"))
+PHOTO_BACKGROUND_PRIORITY = int(os.getenv("PHOTO_BACKGROUND_PRIORITY", "9"))
+
+# Upload admission control: queued messages in the photo queues and photos in flight (admitted, not yet done)
+PHOTO_ADMISSION_ENABLED = os.getenv("PHOTO_ADMISSION_ENABLED", "true").lower() == "true"
+PHOTO_ADMISSION_REDIS_URL = os.getenv("PHOTO_ADMISSION_REDIS_URL", CELERY_BROKER_URL)
+PHOTO_ADMISSION_REDIS_TIMEOUT = float(os.getenv("PHOTO_ADMISSION_REDIS_TIMEOUT", "0.5"))
+PHOTO_ADMISSION_MAX_QUEUED = int(os.getenv("PHOTO_ADMISSION_MAX_QUEUED", "5000"))
+PHOTO_ADMISSION_MAX_BULK_QUEUED = int(os.getenv("PHOTO_ADMISSION_MAX_BULK_QUEUED", "1500"))
+PHOTO_ADMISSION_MAX_IN_FLIGHT = int(os.getenv("PHOTO_ADMISSION_MAX_IN_FLIGHT", "5000"))
+PHOTO_ADMISSION_MAX_IN_FLIGHT_PER_USER = int(os.getenv("PHOTO_ADMISSION_MAX_IN_FLIGHT_PER_USER", "500"))
+PHOTO_ADMISSION_IN_FLIGHT_TTL = int(os.getenv("PHOTO_ADMISSION_IN_FLIGHT_TTL", "3600"))
+PHOTO_ADMISSION_RETRY_AFTER = int(os.getenv("PHOTO_ADMISSION_RETRY_AFTER", "30"))
+PHOTO_ADMISSION_CACHE_SECONDS = float(os.getenv("PHOTO_ADMISSION_CACHE_SECONDS", "1"))
+
+# Very large originals (photos.large_images): refused above the hard pixel limit, decoded within the
+# memory limit (bytes) above the large-image threshold. PhotosConfig.ready sets Image.MAX_IMAGE_PIXELS
+# to the hard limit, so Pillow only raises DecompressionBombError at twice that
+PHOTO_MAX_IMAGE_PIXELS = int(os.getenv("PHOTO_MAX_IMAGE_PIXELS", "250000000"))
+PHOTO_LARGE_IMAGE_PIXELS = int(os.getenv("PHOTO_LARGE_IMAGE_PIXELS", "40000000"))
+PHOTO_IMAGE_MEMORY_LIMIT = int(os.getenv("PHOTO_IMAGE_MEMORY_LIMIT", str(384 * 1024 * 1024)))
+
+# pillow | vips: image engine of the pipeline stages (photos.imaging); vips needs pyvips and libvips
+PHOTO_IMAGE_ENGINE = os.getenv("PHOTO_IMAGE_ENGINE", "pillow").lower()